@@ -1,5 +1,11 @@
+import email
+import email.policy
 import json
 import os
+import select
+import shlex
+import socketserver
+import threading
 from typing import List, Tuple
 
 import pytest
@@ -22,3 +28,296 @@ def accounts(here) -> List[Tuple] or None:
         raw = f.read()
 
     return json.loads(raw)
+
+
+class FakeSMTPHandler(socketserver.StreamRequestHandler):
+    """A minimal SMTP server, records commands and received messages."""
+
+    def reply(self, *lines):
+        self.wfile.write(''.join('{}{}{}\r\n'.format(line[:3], '-' if idx < len(lines) - 1 else ' ', line[4:])
+                                 for idx, line in enumerate(lines)).encode())
+
+    def handle(self):
+        srv = self.server
+        received = accepted = 0
+        self.reply('220 fake.smtp ESMTP')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            cmd = line.rstrip(b'\r\n').decode()
+            verb = cmd.split(' ', 1)[0].upper()
+            srv.commands.append(cmd)
+            if verb == 'EHLO':
+                self.reply('250 fake.smtp', *['250 ' + extension for extension in srv.extensions])
+            elif verb == 'AUTH':
+                self.reply('235 Authentication successful')
+            elif verb == 'MAIL' and srv.max_messages is not None and received >= srv.max_messages:
+                self.reply('421 Too many messages in this session')
+                return
+            elif verb == 'MAIL':
+                accepted = 0
+                self.reply('250 OK')
+            elif verb == 'RCPT' and 'bad' in cmd:
+                self.reply('550 No such user')
+            elif verb == 'RCPT':
+                accepted += 1
+                self.reply('250 OK')
+            elif verb == 'DATA' and not accepted:
+                self.reply('554 No valid recipients')
+            elif verb == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                data = []
+                while True:
+                    line = self.rfile.readline()
+                    if line == b'.\r\n':
+                        break
+                    data.append(line[1:] if line.startswith(b'..') else line)
+                with srv.lock:
+                    transient = srv.transient_failures > 0
+                    srv.transient_failures -= transient
+                if transient:
+                    self.reply('451 Try again later')
+                    continue
+                srv.messages.append(b''.join(data))
+                received += 1
+                self.reply('250 OK')
+            elif verb == 'BDAT':
+                size, *last = cmd.split()[1:]
+                srv.chunks.append(self.rfile.read(int(size)))
+                if last:
+                    srv.messages.append(b''.join(srv.chunks))
+                    srv.chunks.clear()
+                self.reply('250 OK')
+            elif verb == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('250 OK')
+
+
+class FakePOPHandler(socketserver.StreamRequestHandler):
+    """A minimal POP3 server serving mails of server.mails."""
+
+    def write_long(self, lines):
+        self.wfile.write(b'+OK\r\n' + b''.join((b'.' + line if line.startswith(b'.') else line) + b'\r\n'
+                                               for line in lines) + b'.\r\n')
+
+    def handle(self):
+        srv = self.server
+        srv.connections.append(self.connection)
+        self.wfile.write(b'+OK fake.pop ready\r\n')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            cmd = line.rstrip(b'\r\n').decode()
+            verb, *args = cmd.split()
+            verb = verb.upper()
+            srv.commands.append(cmd)
+            mails = srv.mails
+            if verb in ('TOP', 'RETR') and not 0 < int(args[0]) <= len(mails):
+                self.wfile.write(b'-ERR no such message\r\n')
+            elif verb == 'STAT':
+                self.wfile.write('+OK {} {}\r\n'.format(len(mails), sum(len(b'\r\n'.join(m)) for m in mails)).encode())
+            elif verb == 'CAPA':
+                self.write_long([c.encode() for c in srv.capabilities])
+            elif verb == 'UIDL':
+                self.write_long(['{} uid-{}'.format(idx + 1, idx + 1).encode() for idx in range(len(mails))])
+            elif verb == 'TOP':
+                mail = mails[int(args[0]) - 1]
+                self.write_long(mail[:mail.index(b'') + 1] if b'' in mail else mail)
+            elif verb == 'RETR':
+                self.write_long(mails[int(args[0]) - 1])
+            elif verb == 'QUIT':
+                self.wfile.write(b'+OK bye\r\n')
+                return
+            else:
+                self.wfile.write(b'+OK\r\n')
+
+
+def bodystructure(part) -> bytes:
+    if part.is_multipart():
+        return b'(' + b''.join(bodystructure(p) for p in part.get_payload()) + \
+            ' "{}")'.format(part.get_content_subtype().upper()).encode()
+    params = ' '.join('"{}" "{}"'.format(k.upper(), v) for k, v in part.get_params()[1:])
+    body = part.get_payload().encode()
+    fields = '"{}" "{}" ({}) NIL NIL "{}" {}'.format(part.get_content_maintype().upper(),
+                                                    part.get_content_subtype().upper(), params,
+                                                    part.get('Content-Transfer-Encoding', '7BIT'), len(body))
+    if part.get_content_maintype() == 'text':
+        fields += ' {}'.format(body.count(b'\n') + 1)
+    disposition = '("ATTACHMENT" NIL)' if part.get('Content-Disposition', '').startswith('attachment') else 'NIL'
+    return '({} NIL {} NIL)'.format(fields, disposition).encode()
+
+
+def fetch_section(mail: bytes, section: str) -> bytes:
+    header, body = mail.split(b'\r\n\r\n', 1)
+    if section == '':
+        return mail
+    if section == 'HEADER':
+        return header + b'\r\n\r\n'
+    path, mime, _ = section.partition('.MIME')
+    part = email.message_from_bytes(mail)
+    if part.is_multipart():
+        for n in path.split('.'):
+            part = part.get_payload()[int(n) - 1]
+    header, body = part.as_bytes(policy=email.policy.compat32.clone(linesep='\r\n')).split(b'\r\n\r\n', 1)
+    return header + b'\r\n\r\n' if mime else body
+
+
+class FakeIMAPHandler(socketserver.StreamRequestHandler):
+    """A minimal IMAP4rev1 server serving mails of server.mails in INBOX."""
+
+    def untagged(self, line):
+        self.wfile.write(b'* ' + line + b'\r\n')
+
+    def read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None, None
+        line = line.rstrip(b'\r\n')
+        literal = None
+        if line.endswith(b'}'):
+            line, size = line[:-1].rsplit(b' {', 1)
+            self.wfile.write(b'+ go ahead\r\n')
+            literal = self.rfile.read(int(size))
+            self.rfile.readline()
+        return line.decode(), literal
+
+    def header(self, mail, name):
+        for line in mail[:mail.index(b'')]:
+            if line.lower().startswith(name.lower().encode() + b':'):
+                return line.split(b':', 1)[1].strip().decode('utf-8').lower()
+        return ''
+
+    def search(self, args, literal):
+        if args[:1] == ['CHARSET']:
+            args = args[2:]
+        if literal is not None:
+            args.append(literal.decode('utf-8'))
+        result = []
+        for idx, mail in enumerate(self.server.mails, 1):
+            keys = iter(args)
+            matched = True
+            for key in keys:
+                key = key.upper()
+                if key in ('SUBJECT', 'FROM'):
+                    matched &= next(keys).lower() in self.header(mail, key)
+                elif key in ('SENTSINCE', 'SENTBEFORE'):
+                    next(keys)
+            if matched:
+                result.append(str(idx))
+        return ' '.join(result).encode()
+
+    def fetch_item(self, which, item, mail):
+        if item == 'UID':
+            return 'UID {}'.format(which * 10).encode()
+        if item == 'RFC822.SIZE':
+            return 'RFC822.SIZE {}'.format(len(mail)).encode()
+        if item == 'BODYSTRUCTURE':
+            return b'BODYSTRUCTURE ' + bodystructure(email.message_from_bytes(mail))
+        section = item[len('BODY.PEEK['):-1]
+        self.server.sections.append(section)
+        data = fetch_section(mail, section)
+        return 'BODY[{}] {{{}}}'.format(section, len(data)).encode() + b'\r\n' + data
+
+    def handle(self):
+        srv = self.server
+        selected = None
+        self.wfile.write(b'* OK fake.imap ready\r\n')
+        while True:
+            cmd, literal = self.read_command()
+            if cmd is None:
+                return
+            tag, verb, *args = shlex.split(cmd)
+            verb = verb.upper()
+            srv.commands.append(cmd.split(None, 1)[1])
+            mails = srv.mails
+            if verb == 'CAPABILITY':
+                self.untagged(b'CAPABILITY ' + ' '.join(srv.capabilities).encode())
+            elif verb == 'SELECT':
+                selected = len(mails)
+                self.untagged('{} EXISTS'.format(len(mails)).encode())
+                self.untagged(b'OK [UIDVALIDITY 7] UIDs valid')
+            elif verb == 'SEARCH':
+                self.untagged(b'SEARCH ' + self.search(args, literal))
+            elif verb == 'UID' and args[0].upper() == 'SEARCH':
+                first = int(args[2].split(':')[0])
+                uids = [idx * 10 for idx in range(1, len(mails) + 1) if idx * 10 >= first]
+                if not uids and mails:
+                    # n:* always matches the latest mail.
+                    uids = [len(mails) * 10]
+                self.untagged(b'SEARCH ' + ' '.join(str(uid) for uid in uids).encode())
+            elif verb == 'IDLE':
+                exists = len(mails)
+                # Mails arrived since SELECT are reported in the same segment as the continuation.
+                self.wfile.write(b'+ idling\r\n' + (b'* ' + str(exists).encode() + b' EXISTS\r\n'
+                                                      if exists != selected else b''))
+                while not select.select([self.connection], [], [], 0.05)[0]:
+                    if len(srv.mails) != exists:
+                        exists = len(srv.mails)
+                        self.untagged('{} EXISTS'.format(exists).encode())
+                self.rfile.readline()
+            elif verb in ('FETCH', 'UID'):
+                if verb == 'UID':
+                    # UID of mail n is n * 10.
+                    args = [str(int(args[1]) // 10)] + args[2:]
+                seqs = range(1, len(mails) + 1) if args[0] == '1:*' else [int(i) for i in args[0].split(',')]
+                items = ' '.join(args[1:]).strip('()').split()
+                for which in seqs:
+                    mail = b'\r\n'.join(mails[which - 1]) + b'\r\n'
+                    self.untagged('{} FETCH ('.format(which).encode()
+                                  + b' '.join(self.fetch_item(which, item, mail) for item in items) + b')')
+            elif verb == 'STORE':
+                srv.deleted.add(int(args[0]))
+            elif verb == 'CLOSE':
+                srv.mails = [m for idx, m in enumerate(mails, 1) if idx not in srv.deleted]
+                srv.deleted.clear()
+            elif verb == 'LOGOUT':
+                self.untagged(b'BYE')
+                self.wfile.write('{} OK LOGOUT completed\r\n'.format(tag).encode())
+                return
+            self.wfile.write('{} OK {} completed\r\n'.format(tag, verb).encode())
+
+
+def _serve(handler, **attrs):
+    srv = socketserver.ThreadingTCPServer(('127.0.0.1', 0), handler)
+    srv.daemon_threads = True
+    srv.commands = []
+    for k, v in attrs.items():
+        setattr(srv, k, v)
+    srv.port = srv.server_address[1]
+    threading.Thread(target=srv.serve_forever, kwargs={'poll_interval': 0.05}, daemon=True).start()
+    return srv
+
+
+@pytest.fixture
+def fake_smtp():
+    srv = _serve(FakeSMTPHandler, extensions=['AUTH PLAIN LOGIN'], messages=[], chunks=[], max_messages=None,
+                 transient_failures=0, lock=threading.Lock())
+    yield srv
+    srv.shutdown()
+    srv.server_close()
+
+
+@pytest.fixture
+def fake_pop():
+    mails = [[b'Subject: mail ' + str(i).encode(), b'Content-Type: text/plain', b'', b'body ' + str(i).encode(),
+              b'.dot line'] for i in range(1, 4)]
+    srv = _serve(FakePOPHandler, mails=mails, capabilities=['TOP', 'UIDL'], connections=[])
+    yield srv
+    srv.shutdown()
+    srv.server_close()
+
+
+@pytest.fixture
+def fake_imap():
+    mails = [[b'Subject: mail ' + str(i).encode(), b'From: <user' + str(i).encode() + b'@example.com>',
+              b'Date: Sun, 0' + str(i).encode() + b' Aug 2020 08:00:00 +0800',
+              b'Content-Type: text/plain', b'', b'body ' + str(i).encode()] for i in range(1, 4)]
+    srv = _serve(FakeIMAPHandler, mails=mails, capabilities=['IMAP4rev1'], deleted=set(),
+                 sections=[])
+    yield srv
+    srv.shutdown()
+    srv.server_close()
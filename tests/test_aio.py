@@ -0,0 +1,78 @@
+import asyncio
+
+import pytest
+
+from zmail.aio import AsyncMailServer, AsyncPOPServer
+from zmail.exceptions import InvalidArguments
+from zmail.mime import RawMail
+from zmail.parser import parse_mail
+
+
+@pytest.fixture
+def async_mail_server(fake_smtp, fake_pop) -> AsyncMailServer:
+    return AsyncMailServer('zmail@example.com', 'password',
+                           smtp_host='127.0.0.1', smtp_port=fake_smtp.port,
+                           pop_host='127.0.0.1', pop_port=fake_pop.port,
+                           smtp_ssl=False, pop_ssl=False, smtp_tls=False, pop_tls=False, timeout=5)
+
+
+def test_async_send_mail(async_mail_server: AsyncMailServer, fake_smtp):
+    mail = {'subject': 'zmail', 'content_text': '.leading dot'}
+    assert asyncio.run(async_mail_server.send_mail(['a@example.com', 'b@example.com'], mail))
+
+    assert fake_smtp.commands[1].startswith('AUTH PLAIN')
+    assert fake_smtp.commands[2:5] == ['MAIL FROM:<zmail@example.com>',
+                                       'RCPT TO:<a@example.com>', 'RCPT TO:<b@example.com>']
+    assert fake_smtp.commands[-1] == 'QUIT'
+    assert b'Subject: zmail\r\n' in fake_smtp.messages[0]
+
+    # Generated as bytes, not as an ascii string.
+    mail = {'subject': '中文', 'content_text': '中文\r\n.dot', 'attachments': [('中文.txt', b'\x00\xff')]}
+    assert asyncio.run(async_mail_server.send_mail('a@example.com', mail))
+    received = parse_mail(fake_smtp.messages[1].split(b'\r\n'), 1)
+    assert received['subject'] == '中文'
+    assert received['content_text'] == ['中文\r\n.dot']
+    assert received['attachments'] == [('中文.txt', b'\x00\xff')]
+
+    raw = 'Subject: raw\r\nContent-Type: text/plain; charset=utf-8\r\n\r\n中文\r\n'.encode('utf-8')
+    assert asyncio.run(async_mail_server.send_mail('a@example.com', RawMail(raw)))
+    assert fake_smtp.messages[2].endswith(raw)
+
+
+def test_async_get_mails(async_mail_server: AsyncMailServer):
+    async def run():
+        return await asyncio.gather(async_mail_server.stat(),
+                                    async_mail_server.get_mail(2),
+                                    async_mail_server.get_mails(subject='mail 3'),
+                                    async_mail_server.get_mails(start_index=2),
+                                    async_mail_server.get_headers(),
+                                    async_mail_server.get_latest())
+
+    stat, mail, mails, mails_with_index, headers, latest = asyncio.run(run())
+    assert stat[0] == 3
+    assert mail['id'] == 2 and mail['content_text'] == ['body 2\r\n.dot line']
+    assert [m['id'] for m in mails] == [3]
+    assert [m['id'] for m in mails_with_index] == [2, 3]
+    assert [h['subject'] for h in headers] == ['mail 1', 'mail 2', 'mail 3']
+    assert latest['subject'] == 'mail 3'
+
+    with pytest.raises(InvalidArguments):
+        asyncio.run(async_mail_server.get_mails(start_time=b'test'))
+
+
+def test_async_delete_and_able(async_mail_server: AsyncMailServer, fake_pop):
+    assert asyncio.run(async_mail_server.delete(1))
+    assert 'DELE 1' in fake_pop.commands
+    assert asyncio.run(async_mail_server.pop_able())
+    assert asyncio.run(async_mail_server.smtp_able())
+
+
+def test_async_server_requires_async_with(async_mail_server: AsyncMailServer):
+    with pytest.raises(TypeError):
+        with async_mail_server.pop_server:
+            pass
+    assert isinstance(async_mail_server.pop_server, AsyncPOPServer)
+
+    for method in ('open_session', 'close_session', 'close_connection', 'keep_alive'):
+        with pytest.raises(TypeError):
+            getattr(async_mail_server.pop_server, method)()
@@ -0,0 +1,138 @@
+import datetime
+import json
+import pickle
+from unittest import mock
+
+import pytest
+
+from zmail.cache import EncodedAttachmentCache, HeaderCache
+from zmail.exceptions import InvalidArguments
+from zmail.server import MailServer
+from zmail.structures import CaseInsensitiveDict
+
+
+@pytest.fixture
+def header_cache(tmp_path):
+    cache = HeaderCache(str(tmp_path / 'headers.db'))
+    yield cache
+    cache.close()
+
+
+def make_mail_server(**kwargs) -> MailServer:
+    return MailServer('zmail@example.com', 'password',
+                      smtp_host='smtp.example.com', smtp_port=465,
+                      pop_host='pop.example.com', pop_port=995,
+                      smtp_ssl=True, pop_ssl=True, smtp_tls=False, pop_tls=False, **kwargs)
+
+
+def test_header_cache(header_cache: HeaderCache):
+    headers = CaseInsensitiveDict({'Subject': 'zmail', 'Date': datetime.datetime(2018, 8, 25)})
+    header_cache.set_many('a', {'uid-1': headers})
+
+    assert header_cache.get_many('a', ['uid-1', 'uid-2']) == {'uid-1': headers}
+    assert header_cache.get_many('b', ['uid-1']) == {}
+    assert header_cache.get_many('a', ['uid-1'])['uid-1']['subject'] == 'zmail'
+
+    header_cache.set_many('a', {'uid-2': headers, 'uid-3': headers})
+    assert header_cache.prune('a', ['uid-2']) == 2
+    assert list(header_cache.get_many('a', ['uid-1', 'uid-2', 'uid-3'])) == ['uid-2']
+
+    header_cache.clear()
+    assert header_cache.get_many('a', ['uid-2']) == {}
+
+
+def test_header_cache_json(header_cache: HeaderCache):
+    aware = datetime.datetime(2020, 8, 2, 8, 0, tzinfo=datetime.timezone(datetime.timedelta(hours=8)))
+    headers = CaseInsensitiveDict([('Subject', '中文'), ('date', aware), ('To', None), ('From', 'a <a@b.c>')])
+    header_cache.set_many('a', {'uid-1': headers, 'uid-2': CaseInsensitiveDict({'Date': None})})
+
+    cached = header_cache.get_many('a', ['uid-1', 'uid-2'])
+    assert cached == {'uid-1': headers, 'uid-2': {'Date': None}}
+    assert list(cached['uid-1']) == ['Subject', 'date', 'To', 'From']
+    assert cached['uid-1']['date'].utcoffset() == datetime.timedelta(hours=8)
+
+    stored = header_cache._conn.execute("SELECT headers FROM headers WHERE uid = 'uid-1'").fetchone()[0]
+    assert json.loads(stored)[1] == ['date', '2020-08-02T08:00:00+0800']
+
+    # Pickles of older versions are never loaded.
+    with header_cache._conn:
+        header_cache._conn.execute("INSERT INTO headers VALUES ('a', 'uid-3', ?)", (pickle.dumps(headers),))
+    with mock.patch('pickle.loads') as loads:
+        assert header_cache.get_many('a', ['uid-3']) == {}
+    loads.assert_not_called()
+
+
+def test_header_cache_persistent(tmp_path):
+    path = str(tmp_path / 'headers.db')
+    cache = HeaderCache(path)
+    cache.set_many('a', {'uid-1': CaseInsensitiveDict({'Subject': 'zmail'})})
+    cache.close()
+
+    cache = HeaderCache(path)
+    assert cache.get_many('a', ['uid-1'])['uid-1']['subject'] == 'zmail'
+    cache.close()
+
+
+def test_mail_server_header_cache(header_cache: HeaderCache):
+    server = make_mail_server(header_cache=header_cache)
+    pop = mock.MagicMock()
+    pop.__enter__.return_value = pop
+    pop.stat.return_value = (3, 300)
+    pop.count.return_value = 3
+    pop.get_uids.return_value = {1: 'uid-1', 2: 'uid-2', 3: 'uid-3'}
+    pop.get_headers.side_effect = lambda which_list: [[b'Subject: mail ' + str(i).encode(), b''] for i in which_list]
+    server.pop_server = pop
+
+    headers = server.get_headers()
+    assert [(h['id'], h['subject']) for h in headers] == [(1, 'mail 1'), (2, 'mail 2'), (3, 'mail 3')]
+    pop.get_headers.assert_called_with([1, 2, 3])
+
+    # Mail 1 was deleted and a new mail arrived.
+    pop.get_uids.return_value = {1: 'uid-2', 2: 'uid-3', 3: 'uid-4'}
+    headers = server.get_headers()
+    assert [(h['id'], h['subject']) for h in headers] == [(1, 'mail 2'), (2, 'mail 3'), (3, 'mail 3')]
+    pop.get_headers.assert_called_with([3])
+    assert header_cache.get_many('zmail@example.com@pop.example.com:pop', ['uid-1']) == {}
+    assert list(header_cache.get_many('zmail@example.com@pop.example.com:pop', ['uid-2', 'uid-3'])) == \
+        ['uid-2', 'uid-3']
+
+    # The same account over IMAP has other unique-ids, it does not prune headers cached over POP3.
+    imap_server = make_mail_server(header_cache=header_cache, imap_host='imap.example.com', imap_port=993,
+                                   backend='imap')
+    imap = mock.MagicMock()
+    imap.__enter__.return_value = imap
+    imap.count.return_value = 1
+    imap.get_uids.return_value = {1: '7.10'}
+    imap.get_headers.side_effect = lambda which_list: [[b'Subject: imap', b''] for _ in which_list]
+    imap_server.imap_server = imap
+
+    assert [h['subject'] for h in imap_server.get_headers()] == ['imap']
+    assert server.get_headers() == headers
+    pop.get_headers.assert_called_with([])
+
+
+def test_mail_server_header_cache_arguments(tmp_path):
+    server = make_mail_server(header_cache=str(tmp_path / 'headers.db'))
+    assert isinstance(server.header_cache, HeaderCache)
+    server.header_cache.close()
+
+    with pytest.raises(InvalidArguments):
+        make_mail_server(header_cache=NotImplemented)
+
+
+def test_encoded_attachment_cache():
+    cache = EncodedAttachmentCache(max_bytes=10)
+    cache.put('a', b'aaaa')
+    cache.put('b', b'bbbb')
+    assert cache.get('a') == b'aaaa'
+    cache.put('c', b'cccc')  # Evicts b, the least recently used.
+
+    assert cache.get('b') is None
+    assert cache.get('a') == b'aaaa' and cache.get('c') == b'cccc'
+    assert cache.size == 8 and len(cache) == 2
+
+    cache.put('d', b'd' * 11)  # Larger than the budget.
+    assert cache.get('d') is None and cache.size == 8
+
+    cache.clear()
+    assert cache.size == 0 and len(cache) == 0
@@ -0,0 +1,76 @@
+import threading
+import time
+from collections import Counter
+from unittest import mock
+
+import pytest
+
+from zmail.exceptions import InvalidArguments
+from zmail.group import MailServerGroup
+from zmail.server import MailServer
+
+
+def make_server(username, pop_host, pop_port=995):
+    return MailServer(username, 'password',
+                      smtp_host='127.0.0.1', smtp_port=0,
+                      pop_host=pop_host, pop_port=pop_port,
+                      smtp_ssl=False, pop_ssl=False, smtp_tls=False, pop_tls=False, timeout=5)
+
+
+def test_group_limits():
+    servers = [make_server('user{}@163.com'.format(i), 'pop.163.com') for i in range(6)] + \
+              [make_server('user{}@qq.com'.format(i), 'pop.qq.com') for i in range(6)]
+    running = Counter()
+    peaks = Counter()
+    lock = threading.Lock()
+
+    def get_headers(server):
+        provider = server.pop_host
+        with lock:
+            running[provider] += 1
+            running['all'] += 1
+            for k in (provider, 'all'):
+                peaks[k] = max(peaks[k], running[k])
+        time.sleep(0.1)
+        with lock:
+            running[provider] -= 1
+            running['all'] -= 1
+        if server.username == 'user0@qq.com':
+            raise ConnectionResetError()
+        return [server.username]
+
+    group = MailServerGroup(servers, max_connections=5, max_per_provider=3, provider_limits={'163.com': 2})
+    assert group.get_provider(servers[0]) == '163.com'
+    assert group.get_provider(servers[-1]) == 'pop.qq.com'
+
+    start = time.monotonic()
+    with mock.patch.object(MailServer, 'get_headers', get_headers):
+        results = list(group.get_headers())
+
+    # 3 rounds of 163.com, not 12 serial calls.
+    assert time.monotonic() - start < 0.8
+    assert peaks == Counter({'all': 5, 'pop.163.com': 2, 'pop.qq.com': 3})
+    assert sorted(r.server.username for r in results) == sorted(s.username for s in servers)
+    failed = [r for r in results if r.error is not None]
+    assert [(r.server.username, r.result) for r in failed] == [('user0@qq.com', None)]
+    assert all(r.result == [r.server.username] for r in results if r.error is None)
+
+    with pytest.raises(InvalidArguments):
+        MailServerGroup(servers, provider_limits={'qq.com': 0})
+
+
+def test_group_iter_mails(fake_pop):
+    servers = [make_server('user{}@example.com'.format(i), '127.0.0.1', fake_pop.port) for i in range(3)]
+    group = MailServerGroup(servers, max_connections=2)
+
+    results = list(group.iter_mails(start_index=2))
+    assert len(results) == 6
+    assert Counter(r.server.username for r in results) == Counter({s.username: 2 for s in servers})
+    assert Counter(r.result['subject'] for r in results) == Counter({'mail 2': 3, 'mail 3': 3})
+
+    # Stopping early releases connections.
+    results = group.iter_mails()
+    next(results)
+    results.close()
+    time.sleep(0.3)
+    assert fake_pop.commands.count('QUIT') == sum(c.startswith('USER') for c in fake_pop.commands)
@@ -0,0 +1,148 @@
+import os
+import socket
+import threading
+import time
+
+import pytest
+
+from zmail.exceptions import InvalidArguments
+from zmail.mime import Mail, RawMail
+from zmail.server import IMAPServer, MailServer
+from zmail.utils import save, show
+
+
+@pytest.fixture
+def imap_mail_server(fake_imap):
+    return MailServer('zmail@example.com', 'password',
+                      smtp_host='127.0.0.1', smtp_port=0,
+                      pop_host='127.0.0.1', pop_port=0,
+                      smtp_ssl=False, pop_ssl=False, smtp_tls=False, pop_tls=False, timeout=5,
+                      imap_host='127.0.0.1', imap_port=fake_imap.port, imap_ssl=False, backend='imap')
+
+
+def test_imap_backend_arguments():
+    with pytest.raises(InvalidArguments):
+        MailServer('zmail@example.com', 'password', '127.0.0.1', 0, '127.0.0.1', 0,
+                   False, False, False, False, backend='imap')
+
+
+def test_imap_connect_timeout():
+    # A server which accepts connections but never sends its greeting.
+    with socket.socket() as listener:
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        srv = IMAPServer('zmail@example.com', 'password', '127.0.0.1', listener.getsockname()[1],
+                         False, False, 0.3, False)
+        start = time.monotonic()
+        with pytest.raises(OSError):
+            srv.login()
+        assert time.monotonic() - start < 5
+
+
+def test_imap_stat_and_headers(imap_mail_server: MailServer, fake_imap):
+    assert isinstance(imap_mail_server.mailbox_server, IMAPServer)
+    assert imap_mail_server.stat() == (3, sum(len(b'\r\n'.join(m)) + 2 for m in fake_imap.mails))
+
+    headers = imap_mail_server.get_headers(2)
+    assert [h['subject'] for h in headers] == ['mail 2', 'mail 3']
+    assert [h['id'] for h in headers] == [2, 3]
+    assert imap_mail_server.get_latest()['content_text'] == ['body 3']
+
+
+def test_imap_search(imap_mail_server: MailServer, fake_imap):
+    mails = imap_mail_server.get_mails(subject='mail 2', start_time='2020-8-1')
+
+    assert [m['id'] for m in mails] == [2]
+    assert mails[0]['content_text'] == ['body 2']
+    assert [c for c in fake_imap.commands if c.startswith(('SEARCH', 'FETCH'))] == \
+        ['SEARCH SENTSINCE 31-Jul-2020 SUBJECT "mail 2"', 'FETCH 2 (BODY.PEEK[])']
+
+    # Server matches ignoring case, result is refined locally.
+    assert imap_mail_server.get_mails(subject='MAIL') == []
+    assert [m['id'] for m in imap_mail_server.get_mails(sender='example.com', start_index=2)] == [2, 3]
+    # Non-ascii string is sent as a literal.
+    assert imap_mail_server.get_mails(subject='中文') == []
+    assert 'SEARCH CHARSET UTF-8 SUBJECT' in fake_imap.commands
+
+
+def test_imap_session_and_delete(imap_mail_server: MailServer, fake_imap):
+    with imap_mail_server.session():
+        imap_mail_server.delete(1)
+        assert len(imap_mail_server.get_mails()) == 3
+        assert imap_mail_server.mailbox_server.get_uids() == {1: '7.10', 2: '7.20', 3: '7.30'}
+
+    assert fake_imap.commands.count('LOGIN zmail@example.com "password"') == 1
+    assert [m['subject'] for m in imap_mail_server.get_mails()] == ['mail 2', 'mail 3']
+
+
+def test_imap_lazy_mail(imap_mail_server: MailServer, fake_imap, here, tmp_path, capsys):
+    content = os.urandom(100000)
+    mail = Mail({'subject': 'lazy', 'content_text': '中文', 'content_html': '<p>html</p>',
+                 'attachments': [os.path.join(here, '图标.ico'), ('big.bin', content)]})
+    fake_imap.mails.append(mail.get_mime_as_bytes().split(b'\r\n'))
+
+    with imap_mail_server.session():
+        lazy = imap_mail_server.get_mail(4, lazy=True)
+        assert lazy['subject'] == 'lazy'
+        assert lazy['content_text'] == ['中文']
+        assert lazy['content_html'] == ['<p>html</p>']
+        assert [a.name for a in lazy['attachments']] == ['图标.ico', 'big.bin']
+        assert not any(a.is_loaded() for a in lazy['attachments'])
+        assert fake_imap.sections == ['HEADER', '1.MIME', '2.MIME', '3.MIME', '4.MIME', '1', '2']
+
+        # Shown without downloading attachments.
+        show(lazy)
+        assert 'Name:big.bin Size:{} '.format(lazy['attachments'][1].size) in capsys.readouterr().out
+        assert not any(a.is_loaded() for a in lazy['attachments'])
+
+        # Raw bytes are not fetched.
+        with pytest.raises(InvalidArguments, match='lazily'):
+            save(lazy, target_path=str(tmp_path))
+        assert list(tmp_path.iterdir()) == []
+        with pytest.raises(InvalidArguments, match='lazily'):
+            RawMail(lazy)
+        with pytest.raises(InvalidArguments, match='lazily'):
+            imap_mail_server.resend('a@example.com', lazy)
+
+        # Downloaded on access.
+        name, raw = lazy['attachments'][1]
+        assert (name, raw) == ('big.bin', content)
+        assert fake_imap.sections[-1] == '4'
+        assert lazy['attachments'] == mail.decode()['attachments']
+
+    assert [m['content_text'] for m in imap_mail_server.get_mails(subject='mail', lazy=True)] == \
+        [['body 1'], ['body 2'], ['body 3']]
+
+
+def test_imap_idle_buffered_response(fake_imap):
+    fake_imap.capabilities.append('IDLE')
+    srv = IMAPServer('zmail@example.com', 'password', '127.0.0.1', fake_imap.port, False, False, 5, False)
+    with srv:
+        assert srv.count() == 3
+        fake_imap.mails.append([b'Subject: new mail', b'', b'new body'])
+        # EXISTS comes with the continuation line, not later on the socket.
+        start = time.monotonic()
+        srv.idle(3)
+        assert time.monotonic() - start < 1
+        assert srv.count() == 4
+
+
+def test_imap_watch(imap_mail_server: MailServer, fake_imap):
+    fake_imap.capabilities.append('IDLE')
+    new_mail = [b'Subject: new mail', b'Content-Type: text/plain', b'', b'new body']
+    threading.Timer(0.3, fake_imap.mails.append, (new_mail,)).start()
+
+    watcher = imap_mail_server.watch(duration=10)
+    start = time.monotonic()
+    mail = next(watcher)
+    watcher.close()
+
+    # Pushed by IDLE, not polled.
+    assert time.monotonic() - start < 5
+    assert (mail['id'], mail['subject'], mail['content_text']) == (4, 'new mail', ['new body'])
+    assert 'IDLE' in fake_imap.commands
+    assert 'UID SEARCH UID 31:*' in fake_imap.commands
+    assert fake_imap.commands[-1] == 'LOGOUT'
+
+    # Returns after duration when nothing arrives.
+    assert list(imap_mail_server.watch(duration=0.2)) == []
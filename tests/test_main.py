@@ -0,0 +1,23 @@
+import json
+import os
+
+from zmail.__main__ import main
+from zmail.mime import Mail
+from zmail.utils import save
+
+
+def test_parse_command(tmp_path, capsys):
+    (tmp_path / 'sub').mkdir()
+    save(Mail({'subject': 'one', 'from': 'zmail@example.com', 'content_text': 'text'}), target_path=str(tmp_path))
+    save(Mail({'subject': 'two', 'content_text': 'text'}), target_path=str(tmp_path / 'sub'))
+    (tmp_path / 'note.txt').write_text('not a mail')
+
+    assert main(['parse', str(tmp_path), '--workers', '2', '--fields', 'subject,from']) == 0
+    records = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert sorted(records, key=lambda r: r['subject']) == [
+        {'path': os.path.join(str(tmp_path), 'one.eml'), 'subject': 'one', 'from': 'zmail@example.com'},
+        {'path': os.path.join(str(tmp_path), 'sub', 'two.eml'), 'subject': 'two', 'from': None},
+    ]
+
+    assert main(['parse', str(tmp_path / 'missing.eml'), '-w', '1']) == 1
+    assert 'missing.eml' in capsys.readouterr().err
@@ -7,7 +7,9 @@ from unittest import mock
 
 import pytest
 
-from zmail.mime import Mail
+from zmail.cache import EncodedAttachmentCache
+from zmail.mime import ENCODE_BLOCK_SIZE, SMTP_POLICY, AttachmentPart, Mail, TextPart
+from zmail.parser import parse
 
 logger = logging.getLogger('zmail')
 
@@ -67,6 +69,61 @@ def test_get_mime(mail_config):
     assert mail.mime.as_string().encode('utf-8').split(b'\n') == mail.get_mime_as_bytes_list()
 
 
+@pytest.mark.parametrize('boundary', [None, "===============0242955124569473489=="])
+def test_iter_mime_bytes(mail_config, boundary):
+    mail_as_dict, _ = mail_config
+    mail_as_dict = dict(mail_as_dict, attachments=mail_as_dict['attachments'] + [('x.bin', b'\x00' * 100000)])
+    mail = Mail(mail_as_dict, boundary)
+
+    assert b''.join(mail.iter_mime_bytes()) == mail.get_mime_as_bytes()
+    assert mail.decode()['attachments'][1] == ('x.bin', b'\x00' * 100000)
+
+
+def test_attachment_cache(mail_config):
+    mail_as_dict, boundary = mail_config
+    mail_as_dict = dict(mail_as_dict, attachments=mail_as_dict['attachments'] + [('x.bin', b'\x00' * 1000)])
+    cache = EncodedAttachmentCache()
+
+    with mock.patch('zmail.mime.attachment_cache', cache), \
+            mock.patch.object(AttachmentPart, 'iter_blocks', autospec=True,
+                              side_effect=AttachmentPart.iter_blocks) as iter_blocks:
+        first = b''.join(Mail(mail_as_dict, boundary).iter_mime_bytes())
+        second = b''.join(Mail(mail_as_dict, boundary).iter_mime_bytes())
+
+    assert first == second == Mail(mail_as_dict, boundary).get_mime_as_bytes()
+    # Both attachments were read and encoded once.
+    assert iter_blocks.call_count == 2
+    assert len(cache) == 2
+
+
+def test_attachment_cache_disabled(mail_config):
+    mail_as_dict, boundary = mail_config
+    mail_as_dict = dict(mail_as_dict, attachments=mail_as_dict['attachments'] + [('x.bin', b'\x00' * 1000)])
+
+    with mock.patch.object(AttachmentPart, 'iter_blocks', autospec=True,
+                           side_effect=AttachmentPart.iter_blocks) as iter_blocks, \
+            mock.patch('zmail.mime.hashlib.sha256') as sha256:
+        b''.join(Mail(mail_as_dict, boundary).iter_mime_bytes())
+        b''.join(Mail(mail_as_dict, boundary).iter_mime_bytes())
+
+    # Not cached by default, buffers are not hashed.
+    assert iter_blocks.call_count == 4
+    sha256.assert_not_called()
+
+
+def test_attachment_cache_streams():
+    cache = EncodedAttachmentCache()
+    part = AttachmentPart(b'\x00' * 3 * ENCODE_BLOCK_SIZE, 'x.bin', cache)
+
+    encoded = part.iter_encoded()
+    # The first block is yielded before the others are encoded, cached when all are.
+    assert next(encoded) == b''.join(AttachmentPart(b'\x00' * ENCODE_BLOCK_SIZE, 'x.bin').iter_encoded())
+    assert len(cache) == 0
+    b''.join(encoded)
+    assert len(cache) == 1
+    assert b''.join(part.iter_encoded()) == b''.join(AttachmentPart(part.source, 'x.bin').iter_encoded())
+
+
 def test_mail_decode(mail_config):
     mail_as_dict, boundary = mail_config
     mail = Mail(mail_as_dict, boundary)
@@ -125,3 +182,24 @@ def test_mail_set_header(mail_config):
         'to': '中国<123@test.com>', }
     for k, v in mail_decoded_demo.items():
         assert mail_decoded[k] == v, k
+
+
+def test_text_part_8bit():
+    part = TextPart('中文\n.line', 'html')
+    assert part.as_8bit_bytes() == ('Content-Type: text/html; charset="utf-8"\r\nMIME-Version: 1.0\r\n'
+                                    'Content-Transfer-Encoding: 8bit\r\n\r\n中文\r\n.line').encode('utf-8')
+
+    # Too long lines are quoted-printable if it is shorter than base64.
+    assert b'Content-Transfer-Encoding: quoted-printable' in TextPart('x' * 1000).as_8bit_bytes()
+    assert TextPart('中' * 1000).as_8bit_bytes() == TextPart('中' * 1000).as_bytes(policy=SMTP_POLICY)
+
+
+def test_iter_mime_bytes_8bit(mail_config):
+    mail_as_dict, boundary = mail_config
+    mail = Mail(mail_as_dict, boundary)
+    raw = b''.join(mail.iter_mime_bytes(eight_bit=True))
+
+    assert raw.count(b'Content-Transfer-Encoding: 8bit') == 4
+    decoded = parse(raw.split(b'\r\n'))
+    assert decoded['content_text'] == ['xxxxxx', 'yyyyyy']
+    assert decoded['attachments'] == mail.decode()['attachments']
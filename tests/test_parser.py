@@ -1,4 +1,13 @@
-from zmail.parser import recursive_decode, remove_line_feed_and_whitespace
+import mmap
+import os
+
+import pytest
+
+from zmail.exceptions import ParseError
+from zmail.mime import Mail
+from zmail.parser import (BodyPart, ParsedMail, index_parts, parse, parse_bodystructure, parse_imap_response,
+                          parse_mail, recursive_decode, remove_line_feed_and_whitespace)
+from zmail.structures import CaseInsensitiveDict
 
 
 def test_recursive_decode():
@@ -29,3 +38,96 @@ def test_remove_line_feed_and_whitespace():
 
     assert remove_line_feed_and_whitespace(r' \r\n\r\ngb2312\r\n\r\n ') == 'gb2312'
     assert remove_line_feed_and_whitespace('\r\n \r\n\r\ngb2312\r\n\r\n \r\n') == 'gb2312'
+
+
+def test_parse_bodystructure():
+    data = [(b'1 (UID 10 BODYSTRUCTURE (("TEXT" "PLAIN" ("CHARSET" "utf-8") NIL NIL "BASE64" 8 1 NIL NIL NIL NIL)'
+             b'("APPLICATION" "OCTET-STREAM" NIL NIL NIL "BASE64" 4 NIL ("ATTACHMENT" ("FILENAME" "a \\"b\\"")) NIL NIL)'
+             b' "MIXED" ("BOUNDARY" "xyz") NIL NIL NIL) BODY[HEADER] {4}', b'a\r\n\r\n'), b')']
+    attrs = parse_imap_response(data)[1]
+    assert attrs[:2] == [b'UID', b'10']
+    assert attrs[-2:] == [b'BODY[HEADER]', b'a\r\n\r\n']
+    assert attrs[3][1][8] == [b'ATTACHMENT', [b'FILENAME', b'a "b"']]
+    assert parse_bodystructure(attrs[3]) == [
+        BodyPart('1', '1.MIME', 'text', 'plain', None, 8),
+        BodyPart('2', '2.MIME', 'application', 'octet-stream', 'attachment', 4),
+    ]
+
+    single = parse_imap_response([b'1 (BODYSTRUCTURE ("TEXT" "HTML" NIL NIL NIL "7BIT" 3 1))'])[1][1]
+    assert parse_bodystructure(single) == [BodyPart('1', 'HEADER', 'text', 'html', None, 3)]
+
+
+def test_parsed_mail(here):
+    mail = Mail({'subject': 'lazy', 'content_text': ['text 1', 'text 2'], 'content_html': '<p>html</p>',
+                 'attachments': [os.path.join(here, '图标.ico'), ('a.txt', 'abc')],
+                 'headers': {'Date': 'Sun, 02 Aug 2020 08:00:00 +0800'}})
+    lines = mail.get_mime_as_bytes().split(b'\r\n')
+    eager = parse_mail(lines, 1)
+    lazy = parse_mail(lines, 1, lazy=True)
+
+    assert isinstance(lazy, ParsedMail)
+    assert list(lazy) == list(eager)
+    assert lazy['SUBJECT'] == 'lazy' and lazy['date'] == eager['date']
+    assert not any(lazy.is_decoded(k) for k in ('content_text', 'content_html', 'attachments'))
+
+    assert lazy['content_text'] == ['text 1', 'text 2']
+    assert lazy.is_decoded('content_text') and not lazy.is_decoded('attachments')
+    assert lazy['Attachments'] == eager['attachments']
+    assert lazy['attachments'] is lazy['attachments']
+    assert lazy == eager and isinstance(lazy.copy(), CaseInsensitiveDict)
+    assert parse(lines, lazy=True) == parse(lines)
+
+
+def test_index_parts():
+    lines = [b'Subject: nested', b'Content-Type: multipart/mixed; boundary="outer"', b'',
+             b'preamble --outer',
+             b'--outer',
+             b'Content-Type: multipart/alternative; boundary=inner', b'',
+             b'--inner ',
+             b'Content-Type: text/plain', b'',
+             b'mentions --inner and --outer',
+             b'--outer-not-a-delimiter',
+             b'--inner',
+             b'Content-Type: text/html', b'',
+             b'<p>html</p>',
+             b'--inner--',
+             b'epilogue',
+             b'--outer',
+             b'Content-Type: application/octet-stream', b'Content-Disposition: attachment; filename="a.txt"', b'',
+             b'abc']
+    raw_headers, headers, charsets, parts = index_parts(lines)
+    assert headers['subject'] == 'nested'
+    assert [(p.main_type, p.sub_type, lines[p.start:p.end]) for p in parts] == [
+        ('text', 'plain', [b'mentions --inner and --outer', b'--outer-not-a-delimiter']),
+        ('text', 'html', [b'<p>html</p>']),
+        # The last part is kept without a close delimiter.
+        ('application', 'octet-stream', [b'abc']),
+    ]
+
+    mail = parse(lines)
+    assert mail['content_text'] == ['mentions --inner and --outer\r\n--outer-not-a-delimiter']
+    assert mail['content_html'] == ['<p>html</p>']
+    assert mail['attachments'] == [('a.txt', b'abc')]
+
+    with pytest.raises(ParseError):
+        parse([b'Content-Type: multipart/mixed; boundary=x', b'', b'no delimiter --x-'])
+
+
+def test_parse_buffer(here, tmp_path):
+    mail = Mail({'subject': 'buffer', 'content_text': '中文', 'content_html': '<p>html</p>',
+                 'attachments': [os.path.join(here, '图标.ico'), ('a.bin', os.urandom(100000))]})
+    data = mail.get_mime_as_bytes()
+    expected = parse(data.split(b'\r\n'))
+
+    assert parse(data) == parse(memoryview(data)) == parse(bytearray(data)) == expected
+    assert parse(data, lazy=True) == expected
+    # Bare LF line breaks.
+    assert parse(data.replace(b'\r\n', b'\n'))['attachments'] == expected['attachments']
+
+    path = tmp_path / 'mail.eml'
+    path.write_bytes(data)
+    with open(str(path), 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+        parsed = parse_mail(m, 1)
+        assert parsed['raw'] is m
+        assert parsed['attachments'] == expected['attachments']
+        del parsed
@@ -1,11 +1,17 @@
+import io
 import logging
 import poplib
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from unittest import mock
 
 import pytest
 
+from zmail.exceptions import InvalidArguments
 from zmail.info import get_supported_server_info
-from zmail.server import POPServer
+from zmail.parser import ParsedMail
+from zmail.server import MailServer, POPServer, read_multiline
 
 
 @pytest.fixture
@@ -174,3 +180,189 @@ def test_get_mails(pop_server: POPServer):
                 assert isinstance(mail, list)
                 for i in mail:
                     assert isinstance(i, bytes)
+
+
+# Pipelining
+
+@pytest.fixture
+def offline_pop_server():
+    srv = POPServer('zmail@example.com', 'password',
+                    host='pop.example.com', port=995,
+                    ssl=True, tls=False, timeout=60, debug=False,
+                    pipeline_window=4)
+    srv.server = mock.Mock(encoding='UTF-8')
+    srv.server.capa.return_value = {'PIPELINING': [], 'TOP': []}
+    return srv
+
+
+def test_pipeline_get_headers(offline_pop_server: POPServer):
+    srv = offline_pop_server
+    srv.server._getlongresp.side_effect = [(b'+OK', [str(i).encode()], 1) for i in range(1, 11)]
+
+    assert srv.get_headers(list(range(1, 11))) == [[str(i).encode()] for i in range(1, 11)]
+
+    sent = b'\r\n'.join(c[0][0] for c in srv.server._putline.call_args_list).split(b'\r\n')
+    assert sent == [('TOP {} 0'.format(i)).encode() for i in range(1, 11)]
+    # Never more than `pipeline_window` commands written ahead.
+    assert max(len(c[0][0].split(b'\r\n')) for c in srv.server._putline.call_args_list) <= 4
+    srv.server.top.assert_not_called()
+
+
+def test_pipeline_get_mails_error_keeps_sync(offline_pop_server: POPServer):
+    srv = offline_pop_server
+    srv.server._getlongresp.side_effect = [(b'+OK', [b'1'], 1),
+                                           poplib.error_proto(b'-ERR no such message'),
+                                           (b'+OK', [b'3'], 1)]
+    with pytest.raises(poplib.error_proto):
+        srv.get_mails([1, 2, 3])
+    assert srv.server._getlongresp.call_count == 3
+
+
+def test_pipeline_fallback(offline_pop_server: POPServer):
+    srv = offline_pop_server
+    srv.server.capa.return_value = {'TOP': []}
+    srv.server.retr.side_effect = [(b'+OK', [b'1'], 1), (b'+OK', [b'2'], 1)]
+    assert srv.get_mails([1, 2]) == [[b'1'], [b'2']]
+    srv.server._putline.assert_not_called()
+
+    srv._capabilities = None
+    srv.server.capa.side_effect = poplib.error_proto(b'-ERR')
+    assert srv.can_pipeline() is False
+
+    srv.pipelining = False
+    srv._capabilities = None
+    assert srv.can_pipeline() is False
+
+
+# Session
+
+@mock.patch('zmail.server.poplib.POP3_SSL')
+def test_pop_session(pop3_ssl):
+    srv = POPServer('zmail@example.com', 'password',
+                    host='pop.example.com', port=995,
+                    ssl=True, tls=False, timeout=60, debug=False)
+    srv.open_session()
+    with srv:
+        with srv:
+            pass
+        assert srv.is_login()
+    with srv:
+        pass
+    assert srv.is_login()
+    assert pop3_ssl.call_count == 1
+    pop3_ssl.return_value.noop.assert_not_called()
+
+    # Drop broken connection on connection errors.
+    with pytest.raises(ConnectionResetError):
+        with srv:
+            raise ConnectionResetError
+    assert not srv.is_login() and srv.server is None
+
+    with srv:
+        pass
+    assert pop3_ssl.call_count == 2
+
+    srv.close_session()
+    assert not srv.is_login()
+    pop3_ssl.return_value.quit.assert_called_once_with()
+
+
+def test_pop_session_reconnect(fake_pop):
+    srv = POPServer('zmail@example.com', 'password', host='127.0.0.1', port=fake_pop.port,
+                    ssl=False, tls=False, timeout=5, debug=False)
+    srv.open_session()
+    with srv:
+        assert srv.count() == 3
+
+    # The server drops the idle connection, poplib reads EOF.
+    fake_pop.connections[0].shutdown(socket.SHUT_RDWR)
+    srv._last_used -= srv.keepalive_interval
+    with srv:
+        assert srv.count() == 3
+    assert len(fake_pop.connections) == 2
+
+    srv.close_session()
+    assert not srv.is_login()
+
+
+def test_iter_mails_close_keeps_sync(offline_pop_server: POPServer):
+    srv = offline_pop_server
+    srv.server._getlongresp.side_effect = [(b'+OK', [str(i).encode()], 1) for i in range(1, 5)]
+
+    mails = srv.iter_mails([1, 2, 3, 4, 5, 6])
+    assert next(mails) == [b'1']
+    mails.close()
+    # Responses of the commands in flight are consumed.
+    assert srv.server._getlongresp.call_count == 4
+
+
+def test_pop_watch(fake_pop):
+    # IMAP is configured, as by zmail.server(), but backend is pop.
+    server = MailServer('zmail@example.com', 'password',
+                        smtp_host='127.0.0.1', smtp_port=0,
+                        pop_host='127.0.0.1', pop_port=fake_pop.port,
+                        smtp_ssl=False, pop_ssl=False, smtp_tls=False, pop_tls=False, timeout=5,
+                        imap_host='127.0.0.1', imap_port=1, imap_ssl=False)
+    new_mail = [b'Subject: new mail', b'Content-Type: text/plain', b'', b'new body']
+    threading.Timer(0.5, fake_pop.mails.append, (new_mail,)).start()
+
+    watcher = server.watch(duration=10, poll_interval=0.05, max_poll_interval=0.2)
+    mail = next(watcher)
+    watcher.close()
+
+    assert (mail['id'], mail['subject']) == (4, 'new mail')
+    assert fake_pop.commands.count('UIDL') > 2
+    assert fake_pop.commands[-2:] == ['RETR 4', 'QUIT']
+
+
+@pytest.mark.parametrize('buffer_size', [1, 3, 7, 8192])
+def test_read_multiline(buffer_size):
+    long_line = b'x' * 100000
+    responses = (b'Subject: a\r\n\r\n..dot\r\n.\r\n'
+                 b'.\r\n'
+                 b'..\r\n' + long_line + b'\r\n.\r\n'
+                 b'+OK next')
+    file = io.BufferedReader(io.BytesIO(responses), buffer_size)
+
+    assert read_multiline(file) == b'Subject: a\r\n\r\n.dot\r\n'
+    assert read_multiline(file) == b''
+    assert read_multiline(file) == b'.\r\n' + long_line + b'\r\n'
+    # Pipelined responses are not consumed.
+    assert file.read() == b'+OK next'
+
+    with pytest.raises(poplib.error_proto):
+        read_multiline(io.BufferedReader(io.BytesIO(b'no end\r\n'), buffer_size))
+
+
+def test_pop_get_mail(fake_pop):
+    srv = POPServer('zmail@example.com', 'password', host='127.0.0.1', port=fake_pop.port,
+                    ssl=False, tls=False, timeout=5, debug=False)
+    with srv:
+        assert srv.get_mail(2) == [b'Subject: mail 2', b'Content-Type: text/plain', b'', b'body 2', b'.dot line']
+        assert srv.get_header(1) == [b'Subject: mail 1', b'Content-Type: text/plain', b'']
+        assert srv.get_uids() == {1: 'uid-1', 2: 'uid-2', 3: 'uid-3'}
+
+
+def test_get_mails_workers(fake_pop):
+    server = MailServer('zmail@example.com', 'password',
+                        smtp_host='127.0.0.1', smtp_port=0,
+                        pop_host='127.0.0.1', pop_port=fake_pop.port,
+                        smtp_ssl=False, pop_ssl=False, smtp_tls=False, pop_tls=False, timeout=5)
+    fake_pop.mails *= 20
+    mails = server.get_mails(start_index=2)
+
+    assert [m['id'] for m in mails] == list(range(2, 61))
+    assert server.get_mails(start_index=2, workers=2) == mails
+    assert server.get_mails(start_index=2, lazy=True) == mails
+    assert isinstance(server.get_mail(2, lazy=True), ParsedMail)
+    with ThreadPoolExecutor(2) as pool:
+        assert server.get_mails(subject='mail 3', workers=pool) == [m for m in mails if m['subject'] == 'mail 3']
+
+        # Stopping early cancels pending parses and keeps the executor usable.
+        it = server.iter_mails(workers=pool)
+        assert next(it)['id'] == 1
+        it.close()
+        assert pool.submit(int, '1').result() == 1
+
+    with pytest.raises(InvalidArguments):
+        server.get_mails(workers=0)
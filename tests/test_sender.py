@@ -0,0 +1,74 @@
+import smtplib
+import time
+
+import pytest
+
+from zmail.exceptions import InvalidArguments
+from zmail.sender import (AdaptiveBackoff, ConcurrentSender, TokenBucket,
+                          is_transient_error)
+from zmail.server import MailServer
+
+
+@pytest.fixture
+def offline_mail_server(fake_smtp):
+    return MailServer('zmail@example.com', 'password',
+                      smtp_host='127.0.0.1', smtp_port=fake_smtp.port,
+                      pop_host='127.0.0.1', pop_port=0,
+                      smtp_ssl=False, pop_ssl=False, smtp_tls=False, pop_tls=False, timeout=5)
+
+
+def test_is_transient_error():
+    assert is_transient_error(smtplib.SMTPDataError(451, b'later'))
+    assert is_transient_error(smtplib.SMTPSenderRefused(421, b'later', 'a@example.com'))
+    assert is_transient_error(smtplib.SMTPRecipientsRefused({'a@example.com': (452, b'full')}))
+    assert is_transient_error(smtplib.SMTPServerDisconnected())
+    assert is_transient_error(ConnectionResetError())
+
+    assert not is_transient_error(smtplib.SMTPDataError(554, b'rejected'))
+    assert not is_transient_error(smtplib.SMTPRecipientsRefused({'a@example.com': (550, b'no such user')}))
+    assert not is_transient_error(smtplib.SMTPAuthenticationError(535, b'bad password'))
+    assert not is_transient_error(ValueError())
+
+
+def test_token_bucket():
+    bucket = TokenBucket(rate=50, capacity=1)
+    start = time.monotonic()
+    for _ in range(6):
+        bucket.acquire()
+    assert time.monotonic() - start >= 0.09
+
+    with pytest.raises(InvalidArguments):
+        TokenBucket(rate=0)
+
+
+def test_adaptive_backoff():
+    backoff = AdaptiveBackoff(base=0.01, maximum=0.04)
+    for delay in (0.01, 0.02, 0.04, 0.04):
+        backoff.failed()
+        assert backoff.delay == delay
+    backoff.wait()
+    backoff.succeeded()
+    assert backoff.delay == 0.02
+    backoff.succeeded()
+    backoff.succeeded()
+    assert backoff.delay == 0
+
+
+def test_concurrent_sender(offline_mail_server: MailServer, fake_smtp):
+    fake_smtp.transient_failures = 2
+    sender = ConcurrentSender(offline_mail_server, max_connections=3, max_per_connection=2,
+                              rate=1000, backoff=0.01)
+    mails = [('user{}@example.com'.format(i), {'subject': 'mail {}'.format(i)}) for i in range(10)]
+    mails[4] = ('bad@example.com', {'subject': 'refused'})
+
+    results = sender.send_mails(mails)
+
+    assert [r.recipients for r in results] == [[m[0]] for m in mails]
+    assert [r.success for r in results] == [i != 4 for i in range(10)]
+    assert isinstance(results[4].error, smtplib.SMTPRecipientsRefused)
+    assert len(fake_smtp.messages) == 9
+    assert sum(c.startswith('AUTH') for c in fake_smtp.commands) >= 5
+
+    assert ConcurrentSender(offline_mail_server).send_mails([]) == []
+    with pytest.raises(InvalidArguments):
+        ConcurrentSender(offline_mail_server, max_connections=0)
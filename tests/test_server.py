@@ -2,6 +2,7 @@ import datetime
 import logging
 import os
 import time
+from unittest import mock
 
 import pytest
 
@@ -234,3 +235,43 @@ def test_all_account_smtp_and_pop_able(accounts):
 
         assert server.smtp_able()
         assert server.pop_able()
+
+
+# Offline tests.
+
+@pytest.fixture
+def offline_mail_server() -> MailServer:
+    server = MailServer('zmail@example.com', 'password',
+                        smtp_host='smtp.example.com', smtp_port=465,
+                        pop_host='pop.example.com', pop_port=995,
+                        smtp_ssl=True, pop_ssl=True, smtp_tls=False, pop_tls=False)
+    pop = mock.MagicMock()
+    pop.__enter__.return_value = pop
+    pop.stat.return_value = (3, 300)
+    pop.count.return_value = 3
+    pop.iter_headers.side_effect = lambda which_list: ([b'Subject: mail ' + str(i).encode(), b'']
+                                                       for i in which_list)
+    pop.iter_mails.side_effect = lambda which_list: ([b'Subject: mail ' + str(i).encode(),
+                                                      b'Content-Type: text/plain', b'', b'body']
+                                                     for i in which_list)
+    server.pop_server = pop
+    return server
+
+
+def test_iter_mails(offline_mail_server: MailServer):
+    server = offline_mail_server
+    mails = server.iter_mails(start_index=2)
+    assert not server.pop_server.__enter__.called  # Lazy.
+
+    assert [(mail['id'], mail['subject']) for mail in mails] == [(2, 'mail 2'), (3, 'mail 3')]
+    server.pop_server.iter_headers.assert_not_called()
+
+    mails = server.iter_mails(subject='mail 3')
+    assert [(mail['id'], mail['content_text']) for mail in mails] == [(3, ['body'])]
+    server.pop_server.iter_mails.assert_called_with([3])
+
+    assert [h['id'] for h in server.iter_headers(end_index=2)] == [1, 2]
+    assert server.pop_server.__exit__.call_count == 4
+
+    with pytest.raises(InvalidArguments):
+        server.iter_mails(start_time=b'test')
@@ -5,7 +5,9 @@ from unittest import mock
 import pytest
 
 from zmail.info import get_supported_server_info
-from zmail.server import SMTPServer
+from zmail.mime import Mail, RawMail
+from zmail.parser import parse_mail
+from zmail.server import MailServer, SMTPServer
 
 
 @pytest.fixture
@@ -125,3 +127,119 @@ def test_smtp_check_available(smtp_server_config):
 
 def test_send_mail():
     pass
+
+
+# Offline tests.
+
+@pytest.fixture
+def offline_mail_server(fake_smtp):
+    return MailServer('zmail@example.com', 'password',
+                      smtp_host='127.0.0.1', smtp_port=fake_smtp.port,
+                      pop_host='127.0.0.1', pop_port=0,
+                      smtp_ssl=False, pop_ssl=False, smtp_tls=False, pop_tls=False, timeout=5)
+
+
+def test_send_mails(offline_mail_server: MailServer, fake_smtp):
+    fake_smtp.max_messages = 2
+    mails = [('user{}@example.com'.format(i), {'subject': 'mail {}'.format(i)}) for i in range(5)]
+    mails.insert(1, ('bad@example.com', {'subject': 'refused'}))
+    mails.insert(2, ('user@example.com', {'subject': 0}))
+
+    results = offline_mail_server.send_mails(mails)
+
+    assert [r.success for r in results] == [True, False, False, True, True, True, True]
+    assert isinstance(results[1].error, smtplib.SMTPRecipientsRefused)
+    assert results[0].recipients == ['user0@example.com'] and results[0].refused == {}
+    assert len(fake_smtp.messages) == 5
+    # Reconnected after 421, logged in once per 2 mails.
+    assert sum(c.startswith('AUTH') for c in fake_smtp.commands) == 3
+    assert not offline_mail_server.smtp_server.is_login()
+
+
+def test_send_mails_max_per_session(offline_mail_server: MailServer, fake_smtp):
+    results = offline_mail_server.send_mails([('user@example.com', {'subject': str(i)}) for i in range(5)],
+                                             max_per_session=2)
+    assert all(r.success for r in results)
+    assert sum(c.startswith('AUTH') for c in fake_smtp.commands) == 3
+    assert fake_smtp.commands.count('QUIT') == 3
+
+
+@pytest.mark.parametrize('extensions', [[], ['PIPELINING'], ['CHUNKING'], ['PIPELINING', 'CHUNKING']])
+def test_send_pipelining_and_chunking(offline_mail_server: MailServer, fake_smtp, extensions):
+    fake_smtp.extensions = ['AUTH PLAIN LOGIN'] + extensions
+    srv = offline_mail_server.smtp_server
+    srv.chunk_size = 100
+    mail = Mail({'subject': 'zmail', 'content_text': '.leading dot\r\n' * 50})
+
+    with srv:
+        refused = srv.send(['a@example.com', 'bad@example.com'], mail, None)
+        with pytest.raises(smtplib.SMTPRecipientsRefused):
+            srv.send(['bad@example.com'], mail, None)
+
+    assert refused == {'bad@example.com': (550, b'No such user')}
+    assert fake_smtp.messages == [mail.get_mime_as_bytes()]
+    assert 'RSET' in [c.upper() for c in fake_smtp.commands]
+    if 'CHUNKING' in extensions:
+        assert 'DATA' not in fake_smtp.commands
+        assert sum(c.startswith('BDAT') for c in fake_smtp.commands) == len(fake_smtp.messages[0]) // 100 + 1
+    else:
+        assert fake_smtp.commands[2:6] == ['MAIL FROM:<zmail@example.com>', 'RCPT TO:<a@example.com>',
+                                           'RCPT TO:<bad@example.com>', 'DATA']
+
+
+def test_send_data_dot_stuffing():
+    srv = SMTPServer('zmail@example.com', 'password', 'localhost', 25, False, False, 60, False)
+    srv.server = mock.Mock()
+    srv.server.getreply.return_value = (250, b'OK')
+
+    srv._send_data([b'.a\r\n', b'b\r\n.', b'c\r\n..d'])
+    srv.server.send.assert_called_once_with(b'..a\r\nb\r\n..c\r\n...d\r\n.\r\n')
+
+
+def test_resend(offline_mail_server: MailServer, fake_smtp):
+    raw = Mail({'subject': 'zmail', 'from': '<b@example.com>', 'headers': {'To': '<b@example.com>'},
+                'content_text': 'text'}).get_mime_as_bytes()
+    mail = parse_mail(raw.split(b'\r\n'), 1)
+
+    refused = offline_mail_server.resend(['a@example.com', 'bad@example.com'], mail,
+                                         headers={'Resent-To': '<a@example.com>'})
+    offline_mail_server.send_mails([('a@example.com', RawMail(mail))])
+    # Mails parsed from a buffer.
+    offline_mail_server.resend('a@example.com', parse_mail(raw, 1))
+
+    assert refused == {'bad@example.com': (550, b'No such user')}
+    assert fake_smtp.messages == [b'Resent-To: <a@example.com>\r\n' + raw, raw, raw]
+
+
+def test_send_raw_mail_headers(offline_mail_server: MailServer, fake_smtp):
+    raw = b'From: <b@example.com>\r\nTo: <c@example.com>\r\nSubject: raw\r\n\r\ntext\r\n'
+    offline_mail_server.send_mails([('a@example.com', RawMail(raw)), ('a@example.com', RawMail(raw.split(b'\r\n')))])
+    offline_mail_server.send_mail('a@example.com', RawMail(raw))
+    # Only missing headers are added.
+    offline_mail_server.send_mail('a@example.com', RawMail(raw.split(b'\r\n', 1)[1]))
+
+    assert fake_smtp.messages[:3] == [raw, raw, raw]
+    assert fake_smtp.messages[3] == b'From: <zmail@example.com>\r\n' + raw.split(b'\r\n', 1)[1]
+
+
+@pytest.mark.parametrize('extensions', [[], ['CHUNKING']])
+def test_resend_lf_mail(offline_mail_server: MailServer, fake_smtp, extensions):
+    fake_smtp.extensions = ['AUTH PLAIN LOGIN'] + extensions
+    raw = Mail({'subject': 'zmail', 'content_text': 'text\r\n.dot\r\nend'}).get_mime_as_bytes()
+
+    # A mail read with LF line endings, e.g. from an mbox archive, is sent with CRLF.
+    offline_mail_server.resend('a@example.com', parse_mail(raw.replace(b'\r\n', b'\n'), 1))
+    # CRLF split between blocks.
+    with mock.patch.object(RawMail, 'BLOCK_SIZE', 7):
+        offline_mail_server.resend('a@example.com', parse_mail(raw, 1))
+
+    assert fake_smtp.messages == [raw, raw]
+
+
+def test_send_8bitmime(offline_mail_server: MailServer, fake_smtp):
+    fake_smtp.extensions = ['AUTH PLAIN LOGIN', 'PIPELINING', '8BITMIME', 'SMTPUTF8']
+    offline_mail_server.send_mail('用户@example.com', {'subject': '中文', 'content_text': '中文'})
+
+    assert 'MAIL FROM:<zmail@example.com> BODY=8BITMIME SMTPUTF8' in fake_smtp.commands
+    assert 'RCPT TO:<用户@example.com>' in fake_smtp.commands
+    assert b'Content-Transfer-Encoding: 8bit\r\n\r\n' + '中文'.encode('utf-8') in fake_smtp.messages[0]
@@ -0,0 +1,78 @@
+import os
+
+import pytest
+
+from zmail.exceptions import InvalidArguments
+from zmail.mime import Mail
+from zmail.parser import parse_mail
+from zmail.server import MailServer
+from zmail.template import MailTemplate
+
+BOUNDARY = "===============0242955124569473489=="
+
+
+@pytest.fixture
+def template_config(here):
+    return {
+        'subject': 'Hello $name',
+        'content_text': ['Dear ${name}, you owe $$5.', 'static $5 text'],
+        'content_html': '<p>$name</p>',
+        'headers': {'X-Id': '$id', 'X-Static': 'static'},
+        'attachments': [os.path.join(here, 'favicon.ico'), ('a.txt', b'attachment')],
+    }
+
+
+def test_render(template_config):
+    template = MailTemplate(template_config, BOUNDARY)
+    assert template.fields == {'name', 'id'}
+
+    rendered = template.render({'name': '中国'}, id=1)
+    rendered.set_mime_header('To', '<a@example.com>')
+
+    expected = Mail(dict(template_config, subject='Hello 中国',
+                         content_text=['Dear 中国, you owe $5.', 'static $5 text'],
+                         content_html='<p>中国</p>', headers={'X-Id': '1', 'X-Static': 'static'}), BOUNDARY)
+    expected.set_mime_header('To', '<a@example.com>')
+    assert rendered.get_mime_as_bytes() == expected.get_mime_as_bytes()
+
+    with pytest.raises(InvalidArguments):
+        template.render(name='x')
+
+
+def test_render_without_boundary(template_config):
+    template = MailTemplate(template_config)
+    mail = parse_mail(template.render(name='zmail', id=2).get_mime_as_bytes().split(b'\r\n'), 0)
+
+    assert mail['subject'] == 'Hello zmail'
+    assert mail['content_text'] == ['Dear zmail, you owe $5.', 'static $5 text']
+    assert mail['content_html'] == ['<p>zmail</p>']
+    assert mail['headers']['x-id'] == '2'
+    assert [name for name, _ in mail['attachments']] == ['favicon.ico', 'a.txt']
+
+
+def test_render_non_ascii_attachments(template_config):
+    config = dict(template_config, attachments=[('a.txt', 'café'), ('b.txt', 'café'.encode('latin-1'))])
+    template = MailTemplate(config, BOUNDARY)
+
+    rendered = template.render(name='zmail', id=3)
+    expected = Mail(dict(config, subject='Hello zmail', content_text=['Dear zmail, you owe $5.', 'static $5 text'],
+                         content_html='<p>zmail</p>', headers={'X-Id': '3', 'X-Static': 'static'}), BOUNDARY)
+    assert rendered.get_mime_as_bytes() == expected.get_mime_as_bytes()
+
+
+def test_send_rendered_mails(fake_smtp, template_config):
+    server = MailServer('zmail@example.com', 'password',
+                        smtp_host='127.0.0.1', smtp_port=fake_smtp.port,
+                        pop_host='127.0.0.1', pop_port=0,
+                        smtp_ssl=False, pop_ssl=False, smtp_tls=False, pop_tls=False, timeout=5)
+    template = MailTemplate(template_config)
+
+    results = server.send_mails(('user{}@example.com'.format(i), template.render(name=str(i), id=i))
+                                for i in range(3))
+
+    assert all(r.success for r in results)
+    assert len(fake_smtp.messages) == 3
+    mail = parse_mail(fake_smtp.messages[2].split(b'\r\n'), 0)
+    assert mail['subject'] == 'Hello 2'
+    assert mail['to'] == '<user2@example.com>'
+    assert mail['from'] == '<zmail@example.com>'
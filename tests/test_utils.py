@@ -1,11 +1,16 @@
+import mmap
 import os
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import suppress
 
 import pytest
 
 from zmail.api import server
+from zmail.exceptions import InvalidArguments
+from zmail.mime import Mail
+from zmail.parser import parse_mail
 from zmail.structures import CaseInsensitiveDict
-from zmail.utils import read, save, save_attachment
+from zmail.utils import index_mbox, read, read_many, read_mbox, save, save_attachment, show
 
 
 def test_save_attachment(here):
@@ -72,3 +77,101 @@ def test_save_and_read(accounts):
     finally:
         with suppress(FileNotFoundError):
             os.remove('_test.eml')
+
+
+def test_save_mail(here, tmp_path):
+    raw = os.urandom(300000)
+    source = tmp_path / 'source.bin'
+    source.write_bytes(raw)
+
+    with open(str(source), 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+        mail = Mail({'subject': 'zmail', 'content_text': 'text',
+                     'attachments': [os.path.join(here, 'favicon.ico'), ('a.bin', f), ('b.bin', m)]})
+        save(mail, target_path=str(tmp_path))
+        # File objects are read again from where they were.
+        save(mail, name='again.eml', target_path=str(tmp_path))
+
+    saved_mail = read(str(tmp_path / 'zmail.eml'))
+    assert saved_mail['subject'] == 'zmail'
+    assert [name for name, _ in saved_mail['attachments']] == ['favicon.ico', 'a.bin', 'b.bin']
+    assert saved_mail['attachments'][1][1] == saved_mail['attachments'][2][1] == raw
+    assert (tmp_path / 'again.eml').read_bytes() == (tmp_path / 'zmail.eml').read_bytes()
+
+
+def test_read_lazy(here, tmp_path, capsys):
+    mail = Mail({'subject': 'zmail', 'content_text': 'text', 'attachments': [os.path.join(here, 'favicon.ico')]})
+    save(mail, target_path=str(tmp_path))
+
+    lazy = read(str(tmp_path / 'zmail.eml'), lazy=True)
+    assert not lazy.is_decoded('attachments')
+    show(lazy)
+    assert 'Name:favicon.ico' in capsys.readouterr().out
+    save_attachment(lazy, str(tmp_path))
+    with open(os.path.join(here, 'favicon.ico'), 'rb') as f:
+        assert (tmp_path / 'favicon.ico').read_bytes() == f.read()
+    save(lazy, name='again.eml', target_path=str(tmp_path))
+    assert read(str(tmp_path / 'again.eml')) == read(str(tmp_path / 'zmail.eml'))
+
+
+def test_save_buffer_mail(tmp_path):
+    data = Mail({'subject': 'zmail', 'content_text': 'text'}).get_mime_as_bytes()
+    save(parse_mail(data, 1), target_path=str(tmp_path))
+    assert (tmp_path / 'zmail.eml').read_bytes() == data
+
+
+def test_read_mbox(tmp_path):
+    mails = [b'Subject: mail {}\r\nContent-Type: text/plain\r\n\r\nFrom the start\r\n>From here\r\n'.replace(
+        b'{}', str(i).encode()) for i in range(1, 4)]
+    mbox = tmp_path / 'test.mbox'
+    mbox.write_bytes(b''.join(b'From zmail@example.com Sat Jan  3 01:05:34 1996\n'
+                              + m.replace(b'\n>From', b'\n>>From').replace(b'\nFrom', b'\n>From') + b'\n'
+                              for m in mails))
+
+    parsed = list(read_mbox(str(mbox)))
+    assert [m['id'] for m in parsed] == [1, 2, 3]
+    assert [m['subject'] for m in parsed] == ['mail 1', 'mail 2', 'mail 3']
+    assert parsed[0]['content_text'] == ['From the start\r\n>From here\r\n']
+    assert [m['raw'] for m in parsed] == mails
+
+    index = index_mbox(str(mbox))
+    assert len(index) == 3 and index[0] == 0
+    assert [m['subject'] for m in read_mbox(str(mbox), start_index=2, index=index)] == ['mail 2', 'mail 3']
+    assert [m['id'] for m in read_mbox(str(mbox), start_index=2, end_index=2)] == [2]
+
+    mails = read_mbox(str(mbox), lazy=True)
+    assert next(mails)['subject'] == 'mail 1'
+    mails.close()
+
+    (tmp_path / 'empty.mbox').write_bytes(b'')
+    assert list(read_mbox(str(tmp_path / 'empty.mbox'))) == []
+
+
+def test_read_many(here, tmp_path):
+    paths = []
+    for i in range(10):
+        mail = Mail({'subject': 'mail {}'.format(i), 'content_text': 'text',
+                     'attachments': [os.path.join(here, 'favicon.ico')]})
+        save(mail, target_path=str(tmp_path))
+        paths.append(str(tmp_path / 'mail {}.eml'.format(i)))
+    missing = str(tmp_path / 'missing.eml')
+
+    results = list(read_many(paths + [missing], workers=2, chunksize=3))
+    assert sorted(r.path for r in results) == sorted(paths + [missing])
+    assert all(r.mail == read(r.path) for r in results if r.path != missing)
+    failed = [r for r in results if r.error is not None]
+    assert [(r.path, r.mail, type(r.error)) for r in failed] == [(missing, None, FileExistsError)]
+
+    results = list(read_many(paths, fields=('Subject', 'date', 'x-missing'), workers=2))
+    assert sorted(r.mail['subject'] for r in results) == ['mail {}'.format(i) for i in range(10)]
+    assert all(list(r.mail) == ['Subject', 'date'] for r in results)
+
+    with ThreadPoolExecutor(2) as pool:
+        results = read_many(paths, workers=pool, chunksize=1)
+        assert next(results).error is None
+        results.close()
+        assert pool.submit(int, '1').result() == 1
+
+    with pytest.raises(InvalidArguments):
+        read_many(paths, workers=0)
+    with pytest.raises(InvalidArguments):
+        read_many(paths, chunksize=0)
@@ -0,0 +1,65 @@
+"""
+zmail.__main__
+~~~~~~~~~~~~
+Command line interface of zmail, e.g. python -m zmail parse mails/ --workers 8
+"""
+import argparse
+import json
+import os
+import sys
+from typing import Iterable, Iterator, List, Optional
+
+from .utils import DEFAULT_CHUNKSIZE, read_many
+
+# Fields printed by the parse command by default.
+DEFAULT_FIELDS = ('subject', 'from', 'to', 'date')
+
+
+def iter_paths(paths: Iterable[str]) -> Iterator[str]:
+    """Expand directories to the .eml files under them."""
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    if name.lower().endswith('.eml'):
+                        yield os.path.join(root, name)
+        else:
+            yield path
+
+
+def parse_command(args: argparse.Namespace) -> int:
+    """Print selected fields of every mail as a JSON line, errors to stderr."""
+    fields = [field.strip() for field in args.fields.split(',') if field.strip()]
+    failed = 0
+    for result in read_many(iter_paths(args.paths), args.workers, fields, args.chunksize):
+        if result.error is not None:
+            failed += 1
+            print('{}: {!r}'.format(result.path, result.error), file=sys.stderr)
+            continue
+        record = {'path': result.path}
+        record.update(result.mail.items())
+        print(json.dumps(record, default=str, ensure_ascii=False))
+    return 1 if failed else 0
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog='python -m zmail')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    parse = subparsers.add_parser('parse', help='Parse .eml files in a process pool, print them as JSON lines.')
+    parse.add_argument('paths', nargs='+', help='.eml files, or directories searched for them')
+    parse.add_argument('-w', '--workers', type=int, default=None,
+                       help='number of worker processes, the number of CPUs by default')
+    parse.add_argument('-f', '--fields', default=','.join(DEFAULT_FIELDS),
+                       help='comma separated fields to print, default: %(default)s')
+    parse.add_argument('--chunksize', type=int, default=DEFAULT_CHUNKSIZE,
+                       help='number of files sent to a worker at a time, default: %(default)s')
+
+    args = parser.parse_args(argv)
+    return parse_command(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
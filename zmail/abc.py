@@ -1,9 +1,13 @@
 import logging
+import time
 from abc import ABC, abstractmethod
 from typing import Optional
 
 logger = logging.getLogger('zmail')
 
+# Seconds a session connection may stay idle before it is checked with NOOP.
+KEEPALIVE_INTERVAL = 30
+
 
 class BaseServer(ABC):
     """Base protocol server."""
@@ -27,6 +31,12 @@ class BaseServer(ABC):
 
         self._login = False
 
+        # Session states, see open_session().
+        self.keepalive_interval = KEEPALIVE_INTERVAL
+        self._session = 0
+        self._depth = 0
+        self._last_used = 0.0
+
         if tls and ssl:
             raise TypeError('Can not use ssl and tls together.')
 
@@ -49,6 +59,77 @@ class BaseServer(ABC):
     def stls(self):
         pass
 
+    @abstractmethod
+    def noop(self):
+        pass
+
+    def _drop(self):
+        """Close connection without logout, used when the connection is broken."""
+        if self.server is not None:
+            try:
+                self.server.close()
+            except Exception as e:
+                self.log_debug('{} close error: {}'.format(self.__repr__(), e))
+        self._remove_server()
+        self._login = False
+
+    def _is_connection_error(self, e: BaseException) -> bool:
+        return isinstance(e, (OSError, EOFError))
+
+    def open_session(self):
+        """Keep the connection open across `with` blocks until close_session() is called.
+
+        The connection is made lazily by the first `with` block, checked by NOOP after
+        it has been idle for keepalive_interval seconds and re-made if it was dropped.
+        """
+        self._session += 1
+
+    def close_session(self):
+        if self._session == 0:
+            self.log_exception('{} close session before open!'.format(self.__repr__()))
+            return
+
+        self._session -= 1
+        if self._session == 0 and self._depth == 0 and self._login:
+            try:
+                self.logout()
+            except Exception as e:
+                if not self._is_connection_error(e):
+                    raise
+                self._drop()
+
+    def close_connection(self):
+        """Logout without closing the session, the next `with` block logs in again."""
+        if not self._login:
+            return
+        try:
+            self.logout()
+        except Exception as e:
+            self.log_debug('{} logout error: {!r}'.format(self.__repr__(), e))
+            self._drop()
+
+    def in_session(self) -> bool:
+        return self._session > 0
+
+    def keep_alive(self, force=False):
+        """Send NOOP if the connection has been idle for a while, reconnect if it is broken."""
+        if not self._login:
+            return
+        if not force and time.monotonic() - self._last_used < self.keepalive_interval:
+            return
+
+        try:
+            self.noop()
+        except Exception as e:
+            if not self._is_connection_error(e):
+                raise
+            if self.debug:
+                self.log_access('reconnect after {!r}'.format(e))
+            self._drop()
+            self.login()
+
+        self._last_used = time.monotonic()
+
     def check_available(self) -> bool:
         try:
             self.login()
@@ -75,10 +156,26 @@ class BaseServer(ABC):
                                self.is_login(), msg))
 
     def __enter__(self):
-        self.login()
+        if self._depth == 0:
+            if self._login and self._session:
+                self.keep_alive()
+            else:
+                self.login()
+        self._depth += 1
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
+        self._depth -= 1
+        self._last_used = time.monotonic()
+        if self._depth > 0:
+            return
+
+        if self._session:
+            # Keep connection for next call, unless it is broken.
+            if exc_val is not None and self._is_connection_error(exc_val):
+                self._drop()
+            return
+
         self.logout()
 
     def __repr__(self):
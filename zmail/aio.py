@@ -0,0 +1,504 @@
+"""
+zmail.aio
+~~~~~~~~~~~~
+This module provides an AsyncMailServer object to communicate with mail server in asyncio.
+"""
+import asyncio
+import logging
+import poplib
+import smtplib
+import ssl as _ssl
+from base64 import b64encode
+from typing import List, Optional
+
+from .abc import BaseServer
+from .exceptions import InvalidArguments
+from .helpers import (convert_time_range, first_not_none, get_intersection,
+                      match_conditions)
+from .mime import Mail
+from .parser import parse_headers, parse_mail
+from .server import iter_data, make_mail
+from .settings import __local__
+from .structures import CaseInsensitiveDict
+
+CRLF = b'\r\n'
+
+# Max line length of asyncio streams.
+STREAM_LIMIT = 2 ** 24
+
+logger = logging.getLogger('zmail')
+
+
+class AsyncMailServer:
+    """Like MailServer, but every method is a coroutine."""
+
+    def __init__(self, username: str, password: str,
+                 smtp_host: str, smtp_port: int,
+                 pop_host: str, pop_port: int,
+                 smtp_ssl: bool, pop_ssl: bool,
+                 smtp_tls: bool, pop_tls: bool,
+                 debug: bool = False, log=None, timeout=60,
+                 auto_add_from=True, auto_add_to=True):
+        self.username = username
+        self.password = password
+        self.debug = debug
+        self.log = log or logger
+        self.timeout = timeout
+
+        self.smtp_host = smtp_host
+        self.smtp_port = smtp_port
+        self.smtp_ssl = smtp_ssl
+        self.smtp_tls = smtp_tls
+
+        self.pop_host = pop_host
+        self.pop_port = pop_port
+        self.pop_ssl = pop_ssl
+        self.pop_tls = pop_tls
+
+        self.auto_add_from = auto_add_from
+        self.auto_add_to = auto_add_to
+
+        # Check arguments.
+        if not isinstance(self.log, logging.Logger):
+            raise InvalidArguments('log excepted type logging.Logger got {}'.format(type(self.log)))
+
+        if not isinstance(self.timeout, (int, float)):
+            raise InvalidArguments('timeout excepted type int or float got {}'.format(type(self.timeout)))
+
+    @property
+    def smtp_server(self) -> 'AsyncSMTPServer':
+        """A new AsyncSMTPServer, connections are not shared between concurrent calls."""
+        return AsyncSMTPServer(username=self.username,
+                               password=self.password,
+                               host=self.smtp_host,
+                               port=self.smtp_port,
+                               ssl=self.smtp_ssl,
+                               tls=self.smtp_tls,
+                               timeout=self.timeout,
+                               debug=self.debug,
+                               log=self.log)
+
+    @property
+    def pop_server(self) -> 'AsyncPOPServer':
+        """A new AsyncPOPServer, connections are not shared between concurrent calls."""
+        return AsyncPOPServer(username=self.username,
+                              password=self.password,
+                              host=self.pop_host,
+                              port=self.pop_port,
+                              ssl=self.pop_ssl,
+                              tls=self.pop_tls,
+                              timeout=self.timeout,
+                              debug=self.debug,
+                              log=self.log)
+
+    async def send_mail(self, recipients: List[str] or str, mail: dict or CaseInsensitiveDict, cc=None,
+                        timeout=None, auto_add_from=True, auto_add_to=True) -> bool:
+        """"Send email."""
+        recipients, _mail = make_mail(self.username, recipients, mail, cc,
+                                      first_not_none(auto_add_from, self.auto_add_from),
+                                      first_not_none(auto_add_to, self.auto_add_to),
+                                      self.debug, self.log)
+
+        async with self.smtp_server as server:
+            await server.send(recipients, _mail, first_not_none(timeout, self.timeout))
+
+        return True
+
+    async def delete(self, which: int) -> bool:
+        """Delete mail."""
+        async with self.pop_server as server:
+            await server.delete(which)
+        return True
+
+    async def stat(self) -> tuple:
+        """Get mailbox status."""
+        async with self.pop_server as server:
+            return await server.stat()
+
+    async def get_mail(self, which: int) -> CaseInsensitiveDict:
+        """Get a mail from mailbox."""
+        async with self.pop_server as server:
+            mail = await server.get_mail(which)
+        return parse_mail(mail, which, self.debug, self.log)
+
+    async def get_mails(self, subject=None, start_time=None, end_time=None, sender=None,
+                        start_index: Optional[int] = None, end_index: Optional[int] = None) -> list:
+        """Get a list of mails from mailbox."""
+        start_time, end_time = convert_time_range(start_time, end_time)
+
+        async with self.pop_server as server:
+            intersection = get_intersection((1, (await server.stat())[0]), (start_index, end_index))
+            if (subject, start_time, end_time, sender) == (None, None, None, None):
+                mail_id = intersection
+            else:
+                mail_id = [header['id'] for header in await self._get_headers(server, intersection)
+                           if match_conditions(header, subject, start_time, end_time, sender)]
+
+            mails = []
+            for which in mail_id:
+                mail = await server.get_mail(which)
+                mails.append(parse_mail(mail, which, self.debug, self.log))
+            return mails
+
+    async def get_latest(self) -> CaseInsensitiveDict:
+        """Get latest mail in mailbox."""
+        async with self.pop_server as server:
+            latest_num = (await server.stat())[0]
+            mail = await server.get_mail(latest_num)
+        return parse_mail(mail, latest_num, self.debug, self.log)
+
+    async def get_headers(self, start_index: Optional[int] = None, end_index: Optional[int] = None) \
+            -> List[CaseInsensitiveDict]:
+        """Get mails headers."""
+        async with self.pop_server as server:
+            intersection = get_intersection((1, (await server.stat())[0]), (start_index, end_index))
+            return await self._get_headers(server, intersection)
+
+    @staticmethod
+    async def _get_headers(server: 'AsyncPOPServer', which_list: List[int]) -> List[CaseInsensitiveDict]:
+        headers = []
+        for which in which_list:
+            _, _headers, *__ = parse_headers(await server.get_header(which))
+            _headers.update(id=which)
+            headers.append(_headers)
+        return headers
+
+    async def smtp_able(self) -> bool:
+        return await self.smtp_server.check_available()
+
+    async def pop_able(self) -> bool:
+        return await self.pop_server.check_available()
+
+
+class AsyncBaseServer(BaseServer):
+    """Base asyncio protocol server, use `async with` instead of `with`."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.reader = None  # type:asyncio.StreamReader or None
+
+    async def _make_server(self):
+        if self.server is None:
+            ssl_context = _ssl.create_default_context() if self.ssl else None
+            self.reader, self.server = await asyncio.wait_for(
+                asyncio.open_connection(self.host, self.port, ssl=ssl_context, limit=STREAM_LIMIT),
+                self.timeout)
+
+    def _remove_server(self):
+        self.server = None
+        self.reader = None
+
+    async def _close(self):
+        self.server.close()
+        try:
+            await self.server.wait_closed()
+        except (OSError, _ssl.SSLError):
+            pass
+
+    async def _start_tls(self):
+        # StreamWriter.start_tls is new in Python 3.11.
+        await self.server.start_tls(_ssl.create_default_context())
+
+    async def _put_line(self, line: bytes):
+        self.server.write(line + CRLF)
+        await asyncio.wait_for(self.server.drain(), self.timeout)
+
+    async def _get_line(self) -> bytes:
+        line = await asyncio.wait_for(self.reader.readline(), self.timeout)
+        if not line:
+            raise EOFError('{} connection closed by server.'.format(self.__repr__()))
+        return line.rstrip(CRLF)
+
+    async def check_available(self) -> bool:
+        try:
+            await self.login()
+            await self.logout()
+            return True
+        except Exception as e:
+            self.log_exception('{} access error :{}'.format(self.__class__.__name__, e))
+            return False
+
+    def __enter__(self):
+        raise TypeError('Use "async with" instead of "with" for {}.'.format(self.__class__.__name__))
+
+    # Sessions of BaseServer call login, logout and noop without awaiting them.
+    def open_session(self):
+        self._no_session()
+
+    def close_session(self):
+        self._no_session()
+
+    def close_connection(self):
+        self._no_session()
+
+    def keep_alive(self, force=False):
+        self._no_session()
+
+    def _no_session(self):
+        raise TypeError('{} does not support sessions, keep one "async with" block open instead.'
+                        .format(self.__class__.__name__))
+
+    async def __aenter__(self):
+        await self.login()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.logout()
+
+
+class AsyncSMTPServer(AsyncBaseServer):
+    """SMTP client built on asyncio streams."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.esmtp_features = {}
+
+    async def _make_server(self):
+        if self.server is None:
+            await super()._make_server()
+            code, message = await self.get_reply()
+            if code != 220:
+                await self._close()
+                self._remove_server()
+                raise smtplib.SMTPConnectError(code, message)
+
+    async def get_reply(self) -> tuple:
+        """Read a possibly multi-line reply, return (code, message)."""
+        lines = []
+        while True:
+            line = await self._get_line()
+            try:
+                code = int(line[:3])
+            except ValueError:
+                raise smtplib.SMTPResponseException(-1, line)
+            lines.append(line[4:].strip(b' \t'))
+            if line[3:4] != b'-':
+                return code, b'\n'.join(lines)
+
+    async def docmd(self, cmd: str) -> tuple:
+        await self._put_line(cmd.encode('utf-8'))
+        return await self.get_reply()
+
+    async def ehlo(self):
+        code, message = await self.docmd('EHLO ' + __local__)
+        if code != 250:
+            code, message = await self.docmd('HELO ' + __local__)
+            if code != 250:
+                raise smtplib.SMTPHeloError(code, message)
+            self.esmtp_features = {}
+            return
+
+        features = {}
+        for line in message.decode('latin-1').split('\n')[1:]:
+            name, _, params = line.partition(' ')
+            features[name.lower()] = params.strip()
+        self.esmtp_features = features
+
+    def has_extn(self, name: str) -> bool:
+        return name.lower() in self.esmtp_features
+
+    async def login(self):
+        if self._login:
+            self.log_exception('{} duplicate login!'.format(self.__repr__()))
+            return
+
+        if self.debug:
+            self.log_access('login')
+
+        await self._make_server()
+        await self.ehlo()
+
+        if self.tls:
+            await self.stls()
+
+        mechanisms = self.esmtp_features.get('auth', '').upper().split()
+        if 'PLAIN' in mechanisms:
+            token = b64encode('\0{}\0{}'.format(self.username, self.password).encode('utf-8')).decode('ascii')
+            code, message = await self.docmd('AUTH PLAIN ' + token)
+        else:
+            code, message = await self.docmd('AUTH LOGIN ' + b64encode(self.username.encode('utf-8')).decode())
+            if code == 334:
+                code, message = await self.docmd(b64encode(self.password.encode('utf-8')).decode())
+        if code not in (235, 503):
+            raise smtplib.SMTPAuthenticationError(code, message)
+
+        self._login = True
+
+    async def logout(self):
+        if not self._login:
+            self.log_exception('{} Logout before login!'.format(self.__repr__()))
+            return
+
+        if self.debug:
+            self.log_access('logout')
+
+        try:
+            code, message = await self.docmd('QUIT')
+            if code != 221:
+                raise smtplib.SMTPResponseException(code, message)
+        except (EOFError, ConnectionError):
+            pass
+        finally:
+            await self._close()
+
+        self._remove_server()
+
+        self._login = False
+
+    async def stls(self):
+        """Start TLS."""
+        code, message = await self.docmd('STARTTLS')
+        if code != 220:
+            raise smtplib.SMTPNotSupportedError(message)
+        await self._start_tls()
+        await self.ehlo()
+
+    async def noop(self):
+        code, message = await self.docmd('NOOP')
+        if code != 250:
+            raise smtplib.SMTPResponseException(code, message)
+
+    # Methods
+    async def send(self, recipients: List[str], mail: Mail, timeout: int or float or None):
+        if timeout is not None:
+            self.timeout = timeout
+
+        code, message = await self.docmd('MAIL FROM:{}'.format(smtplib.quoteaddr(self.username)))
+        if code != 250:
+            await self.docmd('RSET')
+            raise smtplib.SMTPSenderRefused(code, message, self.username)
+
+        refused = {}
+        for recipient in recipients:
+            code, message = await self.docmd('RCPT TO:{}'.format(smtplib.quoteaddr(recipient)))
+            if code not in (250, 251):
+                refused[recipient] = (code, message)
+        if len(refused) == len(recipients):
+            await self.docmd('RSET')
+            raise smtplib.SMTPRecipientsRefused(refused)
+
+        code, message = await self.docmd('DATA')
+        if code != 354:
+            await self.docmd('RSET')
+            raise smtplib.SMTPDataError(code, message)
+
+        for data in iter_data(mail.iter_mime_bytes()):
+            self.server.write(data)
+            await asyncio.wait_for(self.server.drain(), self.timeout)
+        code, message = await self.get_reply()
+        if code != 250:
+            raise smtplib.SMTPDataError(code, message)
+
+        return refused
+
+
+class AsyncPOPServer(AsyncBaseServer):
+    """POP3 client built on asyncio streams."""
+
+    async def _make_server(self):
+        if self.server is None:
+            await super()._make_server()
+            try:
+                await self._get_response()
+            except poplib.error_proto:
+                await self._close()
+                self._remove_server()
+                raise
+
+    async def _get_response(self) -> bytes:
+        resp = await self._get_line()
+        if not resp.startswith(b'+'):
+            raise poplib.error_proto(resp)
+        return resp
+
+    async def _get_long_response(self) -> List[bytes]:
+        await self._get_response()
+        lines = []
+        line = await self._get_line()
+        while line != b'.':
+            if line.startswith(b'..'):
+                line = line[1:]
+            lines.append(line)
+            line = await self._get_line()
+        return lines
+
+    async def _short_command(self, cmd: str) -> bytes:
+        await self._put_line(cmd.encode('utf-8'))
+        return await self._get_response()
+
+    async def _long_command(self, cmd: str) -> List[bytes]:
+        await self._put_line(cmd.encode('utf-8'))
+        return await self._get_long_response()
+
+    async def login(self):
+        """Note: the mailbox on the server is locked until logout() is called."""
+        if self._login:
+            self.log_exception('{} duplicate login!'.format(self.__repr__()))
+            return
+
+        if self.debug:
+            self.log_access('login')
+
+        await self._make_server()
+
+        if self.tls:
+            await self.stls()
+
+        await self._short_command('USER {}'.format(self.username))
+        await self._short_command('PASS {}'.format(self.password))
+
+        self._login = True
+
+    async def logout(self):
+        """Quit and remove pop3 server."""
+        if not self._login:
+            self.log_exception('{} Logout before login!'.format(self.__repr__()))
+            return
+
+        if self.debug:
+            self.log_access('logout')
+
+        try:
+            await self._short_command('QUIT')
+        finally:
+            await self._close()
+
+        self._remove_server()
+
+        self._login = False
+
+    async def stls(self):
+        await self._short_command('STLS')
+        await self._start_tls()
+
+    async def noop(self):
+        await self._short_command('NOOP')
+
+    # Methods
+
+    async def stat(self) -> tuple:
+        """Get mailbox status. The result is a tuple of 2 integers: (message count, mailbox size)."""
+        resp = await self._short_command('STAT')
+        _, count, size = resp.split()[:3]
+        return int(count), int(size)
+
+    async def get_header(self, which: int) -> list:
+        """Use 'top' to get mail headers."""
+        return await self._long_command('TOP {} 0'.format(which))
+
+    async def get_headers(self, which_list: Optional[list] = None) -> list:
+        """Get all mails headers."""
+        if which_list is None:
+            which_list = range(1, (await self.stat())[0] + 1)
+        return [await self.get_header(which) for which in which_list]
+
+    async def get_mail(self, which: int) -> list:
+        """Get a mail by its id."""
+        return await self._long_command('RETR {}'.format(which))
+
+    async def get_mails(self, which_list: list) -> list:
+        """Get a list of mails by its id."""
+        return [await self.get_mail(which) for which in which_list]
+
+    async def delete(self, which: int):
+        await self._short_command('DELE {}'.format(which))
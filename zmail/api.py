@@ -4,11 +4,15 @@ zmail.api
 This module implements the zmail API.
 """
 import logging
-from typing import Optional
+from typing import Iterable, Optional
 
+from .aio import AsyncMailServer
+from .cache import HeaderCache
+from .group import DEFAULT_MAX_CONNECTIONS, DEFAULT_MAX_PER_PROVIDER, MailServerGroup
 from .info import get_supported_server_info
-from .server import MailServer
-from .utils import read, read_html, save, save_attachment, show
+from .server import DEFAULT_PIPELINE_WINDOW, MailServer
+from .template import MailTemplate
+from .utils import index_mbox, read, read_html, read_many, read_mbox, save, save_attachment, show
 
 logger = logging.getLogger('zmail')
 
@@ -16,7 +20,8 @@ logger = logging.getLogger('zmail')
 read_eml = read
 save_eml = save
 
-__all__ = ('save_attachment', 'read_html', 'show', 'read', 'save', 'server', 'read_eml', 'save_eml')
+__all__ = ('save_attachment', 'read_html', 'show', 'read', 'save', 'server', 'async_server', 'read_eml', 'save_eml',
+           'MailTemplate', 'server_group', 'read_mbox', 'index_mbox', 'read_many')
 
 
 def server(username: str, password: str,
@@ -28,29 +33,68 @@ def server(username: str, password: str,
            pop_port: Optional[int] = None,
            pop_ssl: Optional[bool] = None,
            pop_tls: Optional[bool] = None,
+           imap_host: Optional[str] = None,
+           imap_port: Optional[int] = None,
+           imap_ssl: Optional[bool] = None,
+           imap_tls: Optional[bool] = None,
            config: Optional[str] = None,
            timeout=60, debug=False, log: Optional[logging.Logger] = None,
-           auto_add_from=True, auto_add_to=True) -> MailServer:
-    """A wrapper for MailServer."""
-
-    user_define_config = {
-        'smtp_host': smtp_host,
-        'smtp_port': smtp_port,
-        'smtp_ssl': smtp_ssl,
-        'smtp_tls': smtp_tls,
-        'pop_host': pop_host,
-        'pop_port': pop_port,
-        'pop_ssl': pop_ssl,
-        'pop_tls': pop_tls,
-    }
-
-    auto_generate_config = get_supported_server_info(username, config)  # type:dict
+           auto_add_from=True, auto_add_to=True,
+           pipelining=True, pipeline_window=DEFAULT_PIPELINE_WINDOW,
+           header_cache: Optional[HeaderCache or str] = None,
+           backend='pop', mailbox='INBOX') -> MailServer:
+    """A wrapper for MailServer, set backend to 'imap' to read mailbox by IMAP."""
+    server_config = _make_server_config(username, config,
+                                        smtp_host=smtp_host, smtp_port=smtp_port, smtp_ssl=smtp_ssl,
+                                        smtp_tls=smtp_tls, pop_host=pop_host, pop_port=pop_port,
+                                        pop_ssl=pop_ssl, pop_tls=pop_tls, imap_host=imap_host,
+                                        imap_port=imap_port, imap_ssl=imap_ssl, imap_tls=imap_tls)
+
+    return MailServer(username, password, **server_config, timeout=timeout, debug=debug,
+                      log=log, auto_add_to=auto_add_to, auto_add_from=auto_add_from,
+                      pipelining=pipelining, pipeline_window=pipeline_window,
+                      header_cache=header_cache, backend=backend, mailbox=mailbox)
+
+
+def server_group(accounts: Iterable[tuple], max_connections: int = DEFAULT_MAX_CONNECTIONS,
+                 max_per_provider: int = DEFAULT_MAX_PER_PROVIDER, provider_limits: Optional[dict] = None,
+                 **kwargs) -> MailServerGroup:
+    """A wrapper for MailServerGroup, accounts are (username, password) pairs.
+
+    Servers are made by server() with kwargs, e.g. timeout or backend='imap'.
+    """
+    return MailServerGroup([server(username, password, **kwargs) for username, password in accounts],
+                           max_connections, max_per_provider, provider_limits)
 
-    # Fill user-defined config.
-    auto_generate_config.update({k: v for k, v in user_define_config.items() if v is not None})
 
+def async_server(username: str, password: str,
+                 smtp_host: Optional[str] = None,
+                 smtp_port: Optional[int] = None,
+                 smtp_ssl: Optional[bool] = None,
+                 smtp_tls: Optional[bool] = None,
+                 pop_host: Optional[str] = None,
+                 pop_port: Optional[int] = None,
+                 pop_ssl: Optional[bool] = None,
+                 pop_tls: Optional[bool] = None,
+                 config: Optional[str] = None,
+                 timeout=60, debug=False, log: Optional[logging.Logger] = None,
+                 auto_add_from=True, auto_add_to=True) -> AsyncMailServer:
+    """A wrapper for AsyncMailServer."""
+    server_config = _make_server_config(username, config,
+                                        smtp_host=smtp_host, smtp_port=smtp_port, smtp_ssl=smtp_ssl,
+                                        smtp_tls=smtp_tls, pop_host=pop_host, pop_port=pop_port,
+                                        pop_ssl=pop_ssl, pop_tls=pop_tls)
     # Ignore IMAP config.
-    auto_generate_config = {k: v for k, v in auto_generate_config.items() if 'imap' not in k}
+    server_config = {k: v for k, v in server_config.items() if 'imap' not in k}
+
+    return AsyncMailServer(username, password, **server_config, timeout=timeout, debug=debug,
+                           log=log, auto_add_to=auto_add_to, auto_add_from=auto_add_from)
+
+
+def _make_server_config(username: str, config: Optional[str], **user_define_config) -> dict:
+    auto_generate_config = dict(get_supported_server_info(username, config))  # type:dict
+
+    # Fill user-defined config.
+    auto_generate_config.update({k: v for k, v in user_define_config.items() if v is not None})
 
-    return MailServer(username, password, **auto_generate_config, timeout=timeout, debug=debug,
-                      log=log, auto_add_to=auto_add_to, auto_add_from=auto_add_from)
+    return auto_generate_config
@@ -0,0 +1,156 @@
+"""
+zmail.cache
+~~~~~~~~~~~~
+This module provides a persistent cache of parsed mail headers
+and an in-memory cache of encoded attachments.
+"""
+import datetime
+import json
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Dict, Hashable, Iterable, Optional
+
+from .structures import CaseInsensitiveDict
+
+# Keep SQL statements below the default host-parameter limit of sqlite.
+_SQL_BATCH = 500
+
+# ISO 8601 format of Date in cached headers, followed by the UTC offset if it has one.
+_DATE_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+# Default byte budget of an EncodedAttachmentCache made by the user, the shared zmail.mime.attachment_cache
+# is disabled by default.
+DEFAULT_ATTACHMENT_CACHE_SIZE = 64 * 1024 * 1024
+
+
+class HeaderCache:
+    """An on-disk cache of parsed mail headers, keyed by (account, UIDL).
+
+    POP3 messages are immutable, so headers parsed once can be served from cache
+    for as long as the server keeps reporting the same unique-id.
+    Headers are stored as JSON, loading a cache file never runs code from it.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute('CREATE TABLE IF NOT EXISTS headers ('
+                               'account TEXT NOT NULL, uid TEXT NOT NULL, headers BLOB NOT NULL, '
+                               'PRIMARY KEY (account, uid))')
+
+    def get_many(self, account: str, uids: Iterable[str]) -> Dict[str, CaseInsensitiveDict]:
+        """Get cached headers of uids, missing uids are not included in the result."""
+        uids = list(uids)
+        result = {}
+        with self._lock:
+            for start in range(0, len(uids), _SQL_BATCH):
+                batch = uids[start:start + _SQL_BATCH]
+                rows = self._conn.execute('SELECT uid, headers FROM headers WHERE account = ? AND uid IN ({})'
+                                          .format(', '.join('?' * len(batch))), [account] + batch)
+                for uid, headers in rows:
+                    try:
+                        result[uid] = _load_headers(headers)
+                    except (TypeError, ValueError):
+                        # Written by an older version, fetched and replaced again.
+                        continue
+        return result
+
+    def set_many(self, account: str, headers: Dict[str, CaseInsensitiveDict]) -> None:
+        """Store headers as a uid -> headers dict."""
+        if not headers:
+            return
+        with self._lock, self._conn:
+            self._conn.executemany('INSERT OR REPLACE INTO headers (account, uid, headers) VALUES (?, ?, ?)',
+                                   [(account, uid, _dump_headers(value)) for uid, value in headers.items()])
+
+    def prune(self, account: str, alive_uids: Iterable[str]) -> int:
+        """Remove cached headers of messages no longer on the server, return the number removed."""
+        alive_uids = set(alive_uids)
+        with self._lock, self._conn:
+            stale = [(account, uid) for uid, in self._conn.execute('SELECT uid FROM headers WHERE account = ?',
+                                                                    (account,))
+                     if uid not in alive_uids]
+            self._conn.executemany('DELETE FROM headers WHERE account = ? AND uid = ?', stale)
+        return len(stale)
+
+    def clear(self, account: str or None = None) -> None:
+        """Remove cached headers of an account, or of all accounts if account is None."""
+        with self._lock, self._conn:
+            if account is None:
+                self._conn.execute('DELETE FROM headers')
+            else:
+                self._conn.execute('DELETE FROM headers WHERE account = ?', (account,))
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+    def __repr__(self):
+        return '<{} path:{}>'.format(self.__class__.__name__, self.path)
+
+
+def _dump_headers(headers: CaseInsensitiveDict) -> str:
+    return json.dumps([[k, v.strftime(_DATE_FORMAT + '%z') if isinstance(v, datetime.datetime) else v]
+                       for k, v in headers.items()], ensure_ascii=False)
+
+
+def _load_headers(data: str) -> CaseInsensitiveDict:
+    headers = CaseInsensitiveDict()
+    for k, v in json.loads(data):
+        if k.lower() == 'date' and isinstance(v, str):
+            # An aware datetime is followed by its UTC offset like +0800.
+            v = datetime.datetime.strptime(v, _DATE_FORMAT + ('%z' if len(v) > 19 else ''))
+        headers[k] = v
+    return headers
+
+
+class EncodedAttachmentCache:
+    """A thread-safe LRU cache of base64-encoded attachments, holding at most max_bytes.
+
+    Keys identify the content of an attachment, e.g. (path, mtime, size) or a content hash,
+    so a file attached to many mails is read and encoded only once.
+    """
+
+    def __init__(self, max_bytes: int = DEFAULT_ATTACHMENT_CACHE_SIZE):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._data = OrderedDict()  # type:OrderedDict[Hashable, bytes]
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[bytes]:
+        with self._lock:
+            value = self._data.get(key)
+            if value is not None:
+                self._data.move_to_end(key)
+            return value
+
+    def put(self, key: Hashable, value: bytes) -> None:
+        """Cache value, evicting the least recently used values to stay within max_bytes."""
+        with self._lock:
+            if key in self._data:
+                self.size -= len(self._data.pop(key))
+            if len(value) > self.max_bytes:
+                return
+            self._data[key] = value
+            self.size += len(value)
+            while self.size > self.max_bytes:
+                _, evicted = self._data.popitem(last=False)
+                self.size -= len(evicted)
+
+    def accepts(self, size: int) -> bool:
+        """Whether a value of size bytes may be cached."""
+        return size <= self.max_bytes
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self.size = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __repr__(self):
+        return '<EncodedAttachmentCache {}/{} bytes>'.format(self.size, self.max_bytes)
@@ -1,6 +1,7 @@
 import sys
 
 PY_37 = sys.version_info >= (3, 7)
+PY_39 = sys.version_info >= (3, 9)
 
 if PY_37:
     from collections import OrderedDict  # noqa
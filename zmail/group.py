@@ -0,0 +1,184 @@
+"""
+zmail.group
+~~~~~~~~~~~~
+This module provides a MailServerGroup to read mailboxes of many accounts concurrently.
+"""
+import queue
+import threading
+from collections import OrderedDict, deque
+from typing import Iterable, Iterator, List, Optional
+
+from .exceptions import InvalidArguments
+from .server import MailServer
+from .structures import GroupResult
+
+# Max number of mailbox connections of a group.
+DEFAULT_MAX_CONNECTIONS = 16
+
+# Max number of mailbox connections to one provider.
+DEFAULT_MAX_PER_PROVIDER = 4
+
+
+class MailServerGroup:
+    """Run MailServer methods over many accounts concurrently, yield results as they complete.
+
+    At most max_connections mailboxes are read at the same time, and at most
+    max_per_provider of them on one provider. A provider is the host of mailbox server,
+    provider_limits overrides the limit of hosts by domain, e.g. {'163.com': 2, 'qq.com': 8}.
+
+    Usage:
+        group = MailServerGroup([zmail.server(*account) for account in accounts], max_connections=32)
+        for result in group.get_headers():
+            if result.error is None:
+                handle(result.server.username, result.result)
+    """
+
+    def __init__(self, servers: Iterable[MailServer], max_connections: int = DEFAULT_MAX_CONNECTIONS,
+                 max_per_provider: int = DEFAULT_MAX_PER_PROVIDER, provider_limits: Optional[dict] = None):
+        self.servers = list(servers)  # type:List[MailServer]
+        self.max_connections = max_connections
+        self.max_per_provider = max_per_provider
+        self.provider_limits = dict(provider_limits or {})
+
+        for name, limit in [('max_connections', max_connections), ('max_per_provider', max_per_provider)] \
+                + list(self.provider_limits.items()):
+            if not isinstance(limit, int) or limit < 1:
+                raise InvalidArguments('{} excepted positive int got {}'.format(name, limit))
+
+    def get_provider(self, server: MailServer) -> str:
+        """Key of the connection limit of a server, a domain of provider_limits or the host."""
+        host = server.mailbox_server.host.lower()
+        for domain in self.provider_limits:
+            if host == domain or host.endswith('.' + domain):
+                return domain
+        return host
+
+    def get_headers(self, *args, **kwargs) -> Iterator[GroupResult]:
+        """Call get_headers of every server, yield a GroupResult when one completes."""
+        return self.map('get_headers', *args, **kwargs)
+
+    def get_mails(self, *args, **kwargs) -> Iterator[GroupResult]:
+        """Call get_mails of every server, yield a GroupResult when one completes."""
+        return self.map('get_mails', *args, **kwargs)
+
+    def iter_mails(self, *args, **kwargs) -> Iterator[GroupResult]:
+        """Call iter_mails of every server, yield a GroupResult for every mail as it is fetched.
+
+        A failed server yields a GroupResult with error after the mails fetched before the error.
+        """
+        return self._run('iter_mails', args, kwargs, stream=True)
+
+    def map(self, method: str, *args, **kwargs) -> Iterator[GroupResult]:
+        """Call a method of every server, yield a GroupResult when one completes."""
+        return self._run(method, args, kwargs, stream=False)
+
+    def _run(self, method: str, args: tuple, kwargs: dict, stream: bool) -> Iterator[GroupResult]:
+        pending = OrderedDict()  # type:OrderedDict[str, deque]
+        for server in self.servers:
+            pending.setdefault(self.get_provider(server), deque()).append(server)
+
+        state = _Schedule(pending, self.provider_limits, self.max_per_provider)
+        results = queue.Queue(maxsize=self.max_connections * 4)
+        stop = threading.Event()
+        workers = [threading.Thread(target=self._work, args=(state, results, stop, method, args, kwargs, stream),
+                                    daemon=True)
+                   for _ in range(min(self.max_connections, len(self.servers)))]
+        for worker in workers:
+            worker.start()
+
+        try:
+            remaining = len(workers)
+            while remaining:
+                result = results.get()
+                if result is None:
+                    remaining -= 1
+                else:
+                    yield result
+        finally:
+            # Stop workers when the consumer stops early.
+            stop.set()
+
+    def _work(self, state: '_Schedule', results: queue.Queue, stop: threading.Event,
+              method: str, args: tuple, kwargs: dict, stream: bool):
+        try:
+            while not stop.is_set():
+                server, provider = state.acquire()
+                if server is None:
+                    return
+                try:
+                    self._call(server, results, stop, method, args, kwargs, stream)
+                finally:
+                    state.release(provider)
+        finally:
+            _put(results, stop, None)
+
+    def _call(self, server: MailServer, results: queue.Queue, stop: threading.Event,
+              method: str, args: tuple, kwargs: dict, stream: bool):
+        try:
+            if not stream:
+                _put(results, stop, GroupResult(server, getattr(server, method)(*args, **kwargs), None))
+                return
+
+            items = getattr(server, method)(*args, **kwargs)
+            try:
+                for item in items:
+                    if not _put(results, stop, GroupResult(server, item, None)):
+                        return
+            finally:
+                items.close()
+        except Exception as e:
+            server.log_debug('{} {} failed: {!r}'.format(server.username, method, e))
+            _put(results, stop, GroupResult(server, None, e))
+
+    def __len__(self):
+        return len(self.servers)
+
+    def __repr__(self):
+        return '<MailServerGroup servers:{} max_connections:{} max_per_provider:{}>' \
+            .format(len(self.servers), self.max_connections, self.max_per_provider)
+
+
+class _Schedule:
+    """Servers waiting to run, grouped by provider, and running count of every provider."""
+
+    def __init__(self, pending: 'OrderedDict[str, deque]', provider_limits: dict, max_per_provider: int):
+        self.pending = pending
+        self.limits = {provider: provider_limits.get(provider, max_per_provider) for provider in pending}
+        self.running = dict.fromkeys(pending, 0)
+        self.cond = threading.Condition()
+
+    def acquire(self) -> tuple:
+        """Wait for a server whose provider is below its limit, return (server, provider).
+
+        Return (None, None) if all servers are taken.
+        """
+        with self.cond:
+            while self.pending:
+                for provider, servers in self.pending.items():
+                    if self.running[provider] < self.limits[provider]:
+                        server = servers.popleft()
+                        if not servers:
+                            del self.pending[provider]
+                        else:
+                            # Take turns between providers.
+                            self.pending.move_to_end(provider)
+                        self.running[provider] += 1
+                        return server, provider
+                self.cond.wait()
+            return None, None
+
+    def release(self, provider: str):
+        with self.cond:
+            self.running[provider] -= 1
+            self.cond.notify_all()
+
+
+def _put(results: queue.Queue, stop: threading.Event, result: Optional[GroupResult]) -> bool:
+    """Put a result unless the consumer has stopped, return whether it is put."""
+    while not stop.is_set():
+        try:
+            results.put(result, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
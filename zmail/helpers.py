@@ -2,7 +2,7 @@ import datetime
 import os
 import re
 from base64 import b64encode
-from typing import Optional
+from typing import List, Optional, Tuple
 
 from .exceptions import InvalidArguments, ZmailInternalError
 from .structures import CaseInsensitiveDict
@@ -11,6 +11,7 @@ DATETIME_PATTERN = re.compile(r'([0-9]+)?-?([0-9]{1,2})?-?([0-9]+)?\s*([0-9]{1,2
 LOCAL_TIMEZONE = datetime.datetime.now(datetime.timezone.utc).astimezone().tzinfo
 HDR_PREV = '=?utf-8?b?'
 HDR_END = '?='
+IMAP_MONTHS = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
 
 
 def convert_date_to_datetime(_date: str or datetime.datetime) -> datetime.datetime:
@@ -39,6 +40,26 @@ def convert_date_to_datetime(_date: str or datetime.datetime) -> datetime.dateti
                              tzinfo=LOCAL_TIMEZONE)
 
 
+def convert_time_range(start_time: Optional[str or datetime.datetime],
+                       end_time: Optional[str or datetime.datetime]) -> tuple:
+    """Check and convert time conditions used for filtering mails to datetime objects."""
+    if start_time is not None:
+        if isinstance(start_time, (datetime.datetime, str)):
+            start_time = convert_date_to_datetime(start_time)
+        else:
+            raise InvalidArguments(
+                'start_time excepted type str or datetime.datetime, got {} instead.'.format(type(start_time)))
+
+    if end_time is not None:
+        if isinstance(end_time, (datetime.datetime, str)):
+            end_time = convert_date_to_datetime(end_time)
+        else:
+            raise InvalidArguments(
+                'end_time excepted type str or datetime.datetime, got {} instead.'.format(type(end_time)))
+
+    return start_time, end_time
+
+
 def match_conditions(mail_headers: CaseInsensitiveDict,
                      subject: Optional[str] = None,
                      start_time: Optional[datetime.datetime] = None,
@@ -68,6 +89,46 @@ def match_conditions(mail_headers: CaseInsensitiveDict,
     return True
 
 
+def make_search_criteria(subject: Optional[str] = None,
+                         start_time: Optional[datetime.datetime] = None,
+                         end_time: Optional[datetime.datetime] = None,
+                         sender: Optional[str] = None) -> Tuple[List[str], Optional[bytes]]:
+    """Translate conditions to IMAP SEARCH criteria, return them and a literal for the last one.
+
+    IMAP compares dates without time and strings ignoring case, so the criteria match
+    a superset of match_conditions, which should be used to filter the result.
+    A non-ascii string is sent as a literal, imaplib allows one literal per command,
+    so at most one of subject and sender is searched by the server if both are non-ascii.
+    """
+    criteria = []
+    if start_time is not None:
+        # Widen by a day, the server may compare dates in its own timezone.
+        criteria += ['SENTSINCE', _imap_date(start_time - datetime.timedelta(days=1))]
+    if end_time is not None:
+        criteria += ['SENTBEFORE', _imap_date(end_time + datetime.timedelta(days=2))]
+
+    literal = None
+    for key, value in (('SUBJECT', subject), ('FROM', sender)):
+        if value is None:
+            continue
+        try:
+            value.encode('ascii')
+        except UnicodeEncodeError:
+            if literal is None:
+                literal = value.encode('utf-8')
+                last = [key]
+            continue
+        criteria += [key, '"{}"'.format(value.replace('\\', '\\\\').replace('"', '\\"'))]
+
+    if literal is not None:
+        criteria += last
+    return criteria or ['ALL'], literal
+
+
+def _imap_date(d: datetime.datetime) -> str:
+    return '{:02d}-{}-{:04d}'.format(d.day, IMAP_MONTHS[d.month - 1], d.year)
+
+
 def get_intersection(main_range: tuple, sub_range: tuple) -> list:
     main_start, main_end = main_range
     sub_start, sub_end = sub_range
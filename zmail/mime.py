@@ -1,20 +1,45 @@
+import hashlib
 import logging
 import os
+import re
 import warnings
+from base64 import encodebytes
+from email.charset import QP, Charset
 from email.encoders import encode_base64
+from email.generator import Generator
 from email.header import Header
+from email.message import Message
 from email.mime.base import MIMEBase
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
-from typing import List, Optional
+from email.parser import BytesHeaderParser
+from email.policy import compat32
+from typing import Iterator, List, Optional
 
+from .cache import EncodedAttachmentCache
 from .exceptions import InvalidArguments
 from .helpers import get_abs_path, make_list
-from .parser import parse
+from .parser import BUFFER_TYPES, HEADER_END, parse
 from .structures import CaseInsensitiveDict
 
 logger = logging.getLogger('zmail')
 
+# Policy used to generate a message for SMTP, the same as the default policy but with CRLF line endings.
+SMTP_POLICY = compat32.clone(linesep='\r\n')
+
+CRLF = b'\r\n'
+NLCRE = re.compile(r'\r\n|\r|\n')
+EOL = re.compile(rb'\r\n|\r|\n')
+
+# Bytes of attachment read and base64-encoded at a time, a multiple of 57 (one 76-char line).
+ENCODE_BLOCK_SIZE = 57 * 4096
+
+# Max length of a line in SMTP without CRLF (RFC 5321), longer text lines can not be sent as 8bit.
+MAX_LINE_LENGTH = 998
+
+# Shared by all mails, disabled by default, e.g. attachment_cache.max_bytes = 64 * 1024 * 1024 enables it.
+attachment_cache = EncodedAttachmentCache(max_bytes=0)
+
 
 class Mail:
     def __init__(self, mail: dict or CaseInsensitiveDict, boundary: Optional[str] = None,
@@ -63,13 +88,13 @@ class Mail:
         if self.mail.get('content_html') is not None:
             _htmls = make_list(self.mail['content_html'])
             for _html in _htmls:
-                mime.attach(MIMEText('{}'.format(_html), 'html', 'utf-8'))
+                mime.attach(TextPart('{}'.format(_html), 'html'))
 
         # Set TEXT content.
         if self.mail.get('content_text') is not None:
             _messages = make_list(self.mail['content_text'])
             for _message in _messages:
-                mime.attach(MIMEText('{}'.format(_message), 'plain', 'utf-8'))
+                mime.attach(TextPart('{}'.format(_message), 'plain'))
 
         # Set attachments.
         if self.mail.get('attachments'):
@@ -81,10 +106,14 @@ class Mail:
                     mime.attach(part)
                 elif isinstance(attachment, tuple):
                     name, raw = attachment
-                    part = MIMEBase('application', 'octet-stream')
-                    part.set_payload(raw)
-                    part['Content-Disposition'] = 'attachment;filename="{}"'.format(name)
-                    encode_base64(part)
+                    if isinstance(raw, str):
+                        part = MIMEBase('application', 'octet-stream')
+                        part.set_payload(raw)
+                        part['Content-Disposition'] = 'attachment;filename="{}"'.format(name)
+                        encode_base64(part)
+                    else:
+                        # Bytes-like or binary file object, encoded when the mail is generated.
+                        part = AttachmentPart(raw, name)
                     mime.attach(part)
                 else:
                     raise InvalidArguments('Attachments excepted str or tuple got {} instead.'.format(type(attachment)))
@@ -101,7 +130,7 @@ class Mail:
     def decode(self) -> CaseInsensitiveDict:
         if self.mime is None:
             self.make_mine()
-        return parse(self.mime.as_string().encode('utf-8').split(b'\n'))
+        return parse(self.get_mime_as_bytes())
 
     def get_mime_raw(self) -> MIMEMultipart:
         if self.mime is not None:
@@ -113,6 +142,19 @@ class Mail:
     def get_mime_as_string(self) -> str:
         return self.get_mime_raw().as_string()
 
+    def get_mime_as_bytes(self) -> bytes:
+        """Get MIME as bytes with CRLF line endings, ready for SMTP."""
+        return self.get_mime_raw().as_bytes(policy=SMTP_POLICY)
+
+    def iter_mime_bytes(self, eight_bit: bool = False) -> Iterator[bytes]:
+        """Like get_mime_as_bytes, but generate MIME piece by piece, attachments are read
+        and base64-encoded block by block so memory used does not grow with their size.
+
+        If eight_bit, for servers supporting 8BITMIME, text parts are sent as 8bit,
+        or as the shorter of quoted-printable and base64 if they have too long lines.
+        """
+        return iter_part_bytes(self.get_mime_raw(), eight_bit=eight_bit)
+
     def get_mime_as_bytes_list(self) -> List[bytes]:
         return self.get_mime_as_string().encode('utf-8').split(b'\n')
 
@@ -122,17 +164,226 @@ class Mail:
                      'date', 'id', 'raw', 'attachments', 'content_text', 'content_html')])
 
 
+class RawMail:
+    """A fetched mail sent again as its original bytes, without decoding or re-encoding it.
+
+    Extra headers, e.g. Resent-From and Resent-To, are prepended to the original ones.
+    """
+
+    # Lines joined and yielded at a time.
+    BATCH_LINES = 1024
+
+    # Bytes of a raw buffer yielded at a time.
+    BLOCK_SIZE = 64 * 1024
+
+    def __init__(self, mail: CaseInsensitiveDict or List[bytes] or bytes, headers: Optional[dict] = None):
+        if isinstance(mail, (list,) + BUFFER_TYPES):
+            self.lines = mail
+            self.mail = self._read_headers(mail)
+        elif isinstance(mail, (dict, CaseInsensitiveDict)) and isinstance(mail.get('raw'), (list,) + BUFFER_TYPES):
+            self.lines = mail['raw']
+            self.mail = mail if isinstance(mail, CaseInsensitiveDict) else CaseInsensitiveDict(mail)
+        elif isinstance(mail, (dict, CaseInsensitiveDict)) and 'raw' in mail and mail['raw'] is None:
+            raise InvalidArguments('mail was fetched lazily without its raw bytes, '
+                                   'get it with lazy=False to resend it.')
+        else:
+            raise InvalidArguments('mail excepted a parsed mail, a list of raw lines or bytes got {}'
+                                   .format(type(mail)))
+
+        self.headers = [SMTP_POLICY.fold_binary(k, v) for k, v in (headers or {}).items()]
+
+    @staticmethod
+    def _read_headers(raw: List[bytes] or bytes) -> CaseInsensitiveDict:
+        """Original headers of raw lines or bytes, so From and To are not added twice."""
+        if isinstance(raw, list):
+            block = CRLF.join(raw[:raw.index(b'')] if b'' in raw else raw)
+        else:
+            match = HEADER_END.search(raw)
+            block = bytes(raw[:match.start()] if match is not None else raw)
+        return CaseInsensitiveDict(BytesHeaderParser(policy=compat32).parsebytes(block).items())
+
+    def set_mime_header(self, k, v) -> None:
+        self.headers.append(SMTP_POLICY.fold_binary(k, v))
+
+    def iter_mime_bytes(self, eight_bit: bool = False) -> Iterator[bytes]:
+        """Yield the mail with line endings normalized to CRLF, as smtplib.sendmail does."""
+        if self.headers:
+            yield b''.join(self.headers)
+        if not isinstance(self.lines, list):
+            # Mail parsed from a buffer.
+            data = memoryview(self.lines)
+            tail = b''
+            for start in range(0, len(data), self.BLOCK_SIZE):
+                block = tail + bytes(data[start:start + self.BLOCK_SIZE])
+                # Keep a CR at the end of a block, it may be followed by LF in the next one.
+                tail = b'\r' if block.endswith(b'\r') else b''
+                yield EOL.sub(CRLF, block[:len(block) - len(tail)])
+            if tail or data[-1:] != b'\n':
+                yield CRLF
+            return
+
+        lines = self.lines[:-1] if self.lines and self.lines[-1] == b'' else self.lines
+        for start in range(0, len(lines), self.BATCH_LINES):
+            yield EOL.sub(CRLF, CRLF.join(lines[start:start + self.BATCH_LINES]) + CRLF)
+
+    def get_mime_as_bytes(self) -> bytes:
+        return b''.join(self.iter_mime_bytes())
+
+
+class TextPart(MIMEText):
+    """A utf-8 text part, base64-encoded as MIMEText unless sent to a server supporting 8BITMIME."""
+
+    def __init__(self, text: str, subtype: str = 'plain'):
+        super().__init__(text, subtype, 'utf-8')
+        self.text = text
+
+    def as_8bit_bytes(self, policy=SMTP_POLICY) -> bytes:
+        """Get the part as 8bit, or as the shorter of quoted-printable and base64 if a line is too long."""
+        nl = policy.linesep.encode('ascii')
+        body = nl.join(line.encode('utf-8') for line in NLCRE.split(self.text))
+        if all(len(line) <= MAX_LINE_LENGTH for line in body.split(nl)) and b'\x00' not in body:
+            encoding = '8bit'
+        else:
+            charset = Charset('utf-8')
+            charset.body_encoding = QP
+            qp = charset.body_encode(self.text).encode('ascii').replace(b'\n', nl)
+            if len(qp) >= len(body) * 4 // 3:
+                return self.as_bytes(policy=policy)
+            encoding, body = 'quoted-printable', qp
+
+        headers = b''.join(policy.fold_binary(k, encoding if k.lower() == 'content-transfer-encoding' else v)
+                           for k, v in self.raw_items())
+        return headers + nl + body
+
+
+class AttachmentPart(MIMEBase):
+    """An attachment part which keeps its source instead of the encoded content.
+
+    The source is a file path, a binary file object, or a bytes-like object such as an mmap.
+    It is read and base64-encoded block by block when the mail is generated by iter_part_bytes,
+    or as a whole by get_payload when generated by email.generator.
+    A file object is read from its position when the part was made, it must be seekable
+    to generate the mail more than once.
+
+    If `cache` (the shared attachment_cache by default) is enabled, encoded content of paths
+    and buffers is kept in it, keyed by (path, mtime, size) or by content hash, so an attachment
+    sent many times is encoded once.
+    """
+
+    def __init__(self, source, filename: str, cache: Optional[EncodedAttachmentCache] = None):
+        super().__init__('application', 'octet-stream')
+        self.source = source
+        self.cache = cache if cache is not None else attachment_cache
+        self._is_file = not isinstance(source, (str,) + BUFFER_TYPES)
+        self._offset = source.tell() if self._is_file and source.seekable() else None
+        self['Content-Disposition'] = 'attachment;filename="{}"'.format(filename)
+        self['Content-Transfer-Encoding'] = 'base64'
+        # Generator checks _payload before calling get_payload.
+        self._payload = ''
+
+    def iter_blocks(self) -> Iterator[bytes]:
+        """Yield raw content in blocks of ENCODE_BLOCK_SIZE bytes."""
+        if isinstance(self.source, str):
+            with open(self.source, 'rb') as f:
+                yield from iter(lambda: f.read(ENCODE_BLOCK_SIZE), b'')
+        elif self._is_file:
+            if self._offset is not None:
+                self.source.seek(self._offset)
+            yield from iter(lambda: self.source.read(ENCODE_BLOCK_SIZE), b'')
+        else:
+            view = memoryview(self.source)
+            for start in range(0, len(view), ENCODE_BLOCK_SIZE):
+                yield view[start:start + ENCODE_BLOCK_SIZE]
+
+    def iter_encoded(self) -> Iterator[bytes]:
+        """Yield base64-encoded content, with CRLF line endings."""
+        key = self.cache_key()
+        if key is None:
+            for block in self.iter_blocks():
+                yield encodebytes(block).replace(b'\n', CRLF)
+            return
+
+        encoded = self.cache.get(key)
+        if encoded is not None:
+            yield encoded
+            return
+
+        blocks = []
+        for block in self.iter_blocks():
+            blocks.append(encodebytes(block).replace(b'\n', CRLF))
+            yield blocks[-1]
+        self.cache.put(key, b''.join(blocks))
+
+    def cache_key(self):
+        """Key of encoded content in cache, None if it should not be cached."""
+        if self._is_file or not self.cache.max_bytes:
+            return None
+        if isinstance(self.source, str):
+            stat = os.stat(self.source)
+            size, key = stat.st_size, ('path', os.path.abspath(self.source), stat.st_mtime_ns, stat.st_size)
+        else:
+            size = len(self.source)
+            key = None
+        # Encoded content is 4/3 of the raw plus CRLF every 76 chars.
+        if not self.cache.accepts((size + 2) // 3 * 4 * 78 // 76):
+            return None
+        return key or ('sha256', hashlib.sha256(self.source).digest())
+
+    def get_payload(self, i=None, decode=False):
+        if decode:
+            return b''.join(self.iter_blocks())
+        return b''.join(self.iter_encoded()).decode('ascii')
+
+
 def make_attachment_part(file_path) -> MIMEBase:
     """According to file-type return a prepared attachment part."""
     name = os.path.split(file_path)[1]
-    encoded_name = Header(name).encode()
+    return AttachmentPart(file_path, Header(name).encode())
+
+
+def iter_part_bytes(part: Message, policy=SMTP_POLICY, eight_bit: bool = False) -> Iterator[bytes]:
+    """Generate a MIME part as bytes piece by piece, the same as part.as_bytes(policy=policy)
+    unless eight_bit, in which case text parts are generated by TextPart.as_8bit_bytes."""
+    if isinstance(part, AttachmentPart):
+        yield _header_bytes(part, policy)
+        yield from part.iter_encoded()
+        return
+
+    if not part.is_multipart():
+        if eight_bit and isinstance(part, TextPart):
+            yield part.as_8bit_bytes(policy)
+        else:
+            yield part.as_bytes(policy=policy)
+        return
+
+    nl = policy.linesep.encode('ascii')
+    subparts = part.get_payload()
+
+    # Headers come first, so choose a boundary which is not in the parts generated at once.
+    boundary = part.get_boundary()
+    if not boundary:
+        small_parts = nl.join(b''.join(iter_part_bytes(sub, policy, eight_bit)) for sub in subparts
+                              if not isinstance(sub, AttachmentPart) and not sub.is_multipart())
+        boundary = Generator._make_boundary(small_parts.decode('ascii', 'surrogateescape'))
+        part.set_boundary(boundary)
+    delimiter = b'--' + boundary.encode('ascii')
+
+    yield _header_bytes(part, policy)
+    if part.preamble is not None:
+        yield _lines_bytes(part.preamble, nl) + nl
+    yield delimiter + nl
+    for idx, sub in enumerate(subparts):
+        if idx:
+            yield nl + delimiter + nl
+        yield from iter_part_bytes(sub, policy, eight_bit)
+    yield nl + delimiter + b'--' + nl
+    if part.epilogue is not None:
+        yield _lines_bytes(part.epilogue, nl)
+
+
+def _header_bytes(part: Message, policy) -> bytes:
+    return b''.join(policy.fold_binary(k, v) for k, v in part.raw_items()) + policy.linesep.encode('ascii')
 
-    file_type = 'application/octet-stream'
-    main_type, sub_type = file_type.split('/')
 
-    with open(file_path, 'rb') as f:
-        part = MIMEBase(main_type, sub_type)
-        part.set_payload(f.read())
-        part['Content-Disposition'] = 'attachment;filename="{}"'.format(encoded_name)
-        encode_base64(part)
-    return part
+def _lines_bytes(text: str, nl: bytes) -> bytes:
+    return nl.join(line.encode('ascii', 'surrogateescape') for line in NLCRE.split(text))
@@ -4,14 +4,18 @@ zmail.parser
 This module provides functions to handles MIME object.
 """
 import datetime
+import functools
+import itertools
 import logging
+import mmap
 import re
 import warnings
-from base64 import b64decode
+from binascii import a2b_base64
+from collections import namedtuple
 from datetime import timedelta, timezone, tzinfo
 from email.header import decode_header
 from quopri import decodestring
-from typing import List
+from typing import List, Tuple
 from urllib.parse import unquote
 
 from .exceptions import ParseError
@@ -40,6 +44,12 @@ MONTH_TO_INT = CaseInsensitiveDict({
     'Dec': 12,
 })
 HEADER_VALUE_STRIP = '\r\n "'
+HEADER_END = re.compile(rb'\r?\n\r?\n')
+LINE_BREAK = re.compile(rb'\r?\n')
+# Mails parsed from one contiguous buffer instead of a list of lines.
+BUFFER_TYPES = (bytes, bytearray, memoryview, mmap.mmap)
+IMAP_TOKEN = re.compile(rb'(\()|(\))|"((?:[^"\\]|\\.)*)"|\{(\d+)\}\s*$|([^\s()"]+)')
+IMAP_QUOTED_ESCAPE = re.compile(rb'\\(.)')
 logger = logging.getLogger('zmail')
 
 
@@ -133,14 +143,15 @@ def _get_sub_charset(raw_headers: list) -> list:
     return []
 
 
-def parse_headers(lines: List[bytes], debug=False, log=None):
+def parse_headers(lines: List[bytes], debug=False, log=None, start=0):
+    """Parse headers starting at lines[start], the returned index of their end is an index of lines."""
     log = log or logger
     headers = CaseInsensitiveDict()
     raw_headers = []
     unknown_value_headers = []
 
-    lines_idx = 0
-    line = lines[0]
+    lines_idx = start
+    line = lines[start]
     line_count = len(lines)
 
     while lines:
@@ -259,36 +270,195 @@ def parse_headers(lines: List[bytes], debug=False, log=None):
     return raw_headers, headers, lines_idx, main_type, sub_type, charsets, extra_kv
 
 
-def multiple_part_decode(lines: List[bytes], boundary: str, debug=False, log=None):
-    content_text = []
-    content_html = []
-    attachments = []
-    boundary = boundary.encode('ascii')
+# A non-multiple-part part of mail, its body is lines[start:end] of the mail.
+MailPart = namedtuple('MailPart', ('headers', 'start', 'end', 'main_type', 'sub_type', 'charsets', 'extra_kv'))
 
-    # Split to parts.
+
+def index_parts(lines: List[bytes], debug=False, log=None) -> tuple:
+    """Parse headers of a mail and of all its parts in one pass over lines.
+
+    Return raw headers, headers and charsets of the mail, and its non-multiple-part parts
+    as a list of MailPart. Only delimiter lines (RFC 2046) of the enclosing multiple-parts
+    end a part, bodies are not copied.
+    """
+    log = log or logger
     parts = []
-    part_index = []
-    for _idx, line in enumerate(lines):
-        if boundary in line:
-            part_index.append(_idx)
-    if not part_index:
-        raise ParseError('Can not find boundary on this mail.boundary{}'.format(boundary.decode("ascii")))
-    else:
-        _len = len(part_index)
-        for idx_idx, idx in enumerate(part_index):
-            if idx_idx + 1 <= _len - 1:
-                parts.append(lines[idx + 1:part_index[idx_idx + 1]])
+    # [delimiter, found] of enclosing multiple-parts, the innermost is the last.
+    stack = []
+    part = None  # type:MailPart or None
+    top = None
+    idx, line_count = 0, len(lines)
+
+    while True:
+        # Headers of a part.
+        raw_headers, headers, eof_idx, main_type, sub_type, charsets, extra_kv = parse_headers(lines, debug, log, idx)
+        if top is None:
+            top = raw_headers, headers, charsets
+        idx = eof_idx + 1
+        if main_type == TYPE_MULTIPART:
+            boundary = extra_kv.get('boundary')
+            if boundary is None:
+                raise ParseError('Can not find boundary in multiple-part mail.')
+            stack.append([b'--' + boundary.encode('ascii'), False])
+        else:
+            part = MailPart(headers, idx, line_count, main_type, sub_type, charsets, extra_kv)
+
+        if not stack:
+            # Nothing left to be delimited.
+            break
+
+        # Body of the part, up to the next delimiter line.
+        next_part = False
+        while idx < line_count and not next_part:
+            line = lines[idx]
+            idx += 1
+            if not stack or line[:2] != b'--':
+                continue
+            depth, closing = _match_delimiter(line, stack)
+            if depth is None:
+                continue
+
+            if part is not None:
+                parts.append(part._replace(end=idx - 1))
+                part = None
+            # A delimiter of an outer multiple-part closes inner ones.
+            for delimiter, found in stack[depth + 1:]:
+                _check_delimiter_found(delimiter, found)
+            del stack[depth + 1:]
+            stack[-1][1] = True
+            if closing:
+                stack.pop()
+            else:
+                next_part = True
+
+        if not next_part or idx >= line_count:
+            break
+
+    if part is not None:
+        parts.append(part)
+    for delimiter, found in stack:
+        _check_delimiter_found(delimiter, found)
+
+    return top + (parts,)
+
+
+def _match_delimiter(line: bytes, stack: list) -> tuple:
+    """Return (depth, closing) of the multiple-part whose delimiter line it is, (None, False) if not."""
+    for depth in range(len(stack) - 1, -1, -1):
+        delimiter = stack[depth][0]
+        if line.startswith(delimiter):
+            # Delimiters may be followed by whitespace.
+            rest = line[len(delimiter):].rstrip(b' \t\r\n')
+            if not rest:
+                return depth, False
+            if rest == b'--':
+                return depth, True
+    return None, False
+
+
+def _check_delimiter_found(delimiter: bytes, found: bool):
+    if not found:
+        raise ParseError('Can not find boundary on this mail.boundary{}'.format(delimiter[2:].decode('ascii')))
+
+
+def index_buffer(data, debug=False, log=None) -> tuple:
+    """Like index_parts, but over a mail in one bytes-like buffer: bytes, bytearray, memoryview or mmap.
+
+    Header blocks and delimiter lines are found by searching the buffer, ranges of MailPart are
+    offsets of it, so only headers are copied out of it.
+    """
+    log = log or logger
+    parts = []
+    # [boundary, found] of enclosing multiple-parts, the innermost is the last.
+    stack = []
+    part = None  # type:MailPart or None
+    top = None
+    pos, size = 0, len(data)
+
+    while True:
+        # Headers of a part.
+        header_end, body_start = _find_header_end(data, pos, size)
+        header_lines = LINE_BREAK.split(bytes(data[pos:header_end])) + [b'']
+        raw_headers, headers, _, main_type, sub_type, charsets, extra_kv = parse_headers(header_lines, debug, log)
+        if top is None:
+            top = raw_headers, headers, charsets
+        pos = body_start
+        if main_type == TYPE_MULTIPART:
+            boundary = extra_kv.get('boundary')
+            if boundary is None:
+                raise ParseError('Can not find boundary in multiple-part mail.')
+            stack.append([boundary.encode('ascii'), False])
+        else:
+            part = MailPart(headers, pos, size, main_type, sub_type, charsets, extra_kv)
+
+        if not stack:
+            # Nothing left to be delimited.
+            break
+
+        # Body of the part, up to the next delimiter line.
+        next_part = False
+        while stack and not next_part:
+            match = _delimiter_pattern(tuple(boundary for boundary, _ in stack)).search(data, pos)
+            if match is None:
+                pos = size
+                break
+
+            if part is not None:
+                # The line break before a delimiter belongs to it.
+                parts.append(part._replace(end=match.start()))
+                part = None
+            depth = max(idx for idx, (boundary, _) in enumerate(stack) if boundary == match.group(1))
+            # A delimiter of an outer multiple-part closes inner ones.
+            for boundary, found in stack[depth + 1:]:
+                _check_delimiter_found(b'--' + boundary, found)
+            del stack[depth + 1:]
+            stack[-1][1] = True
+            pos = match.end()
+            if match.group(2):
+                stack.pop()
+            else:
+                next_part = True
+
+        if not next_part or pos >= size:
+            break
+
+    if part is not None:
+        parts.append(part)
+    for boundary, found in stack:
+        _check_delimiter_found(b'--' + boundary, found)
+
+    return top + (parts,)
+
+
+def _find_header_end(data, pos: int, size: int) -> Tuple[int, int]:
+    """Return the end of headers starting at pos and the start of their body."""
+    if data[pos:pos + 1] == b'\n':
+        return pos, pos + 1
+    if data[pos:pos + 2] == b'\r\n':
+        return pos, pos + 2
+    match = HEADER_END.search(data, pos)
+    if match is None:
+        return size, size
+    return match.start(), match.end()
+
+
+@functools.lru_cache(maxsize=64)
+def _delimiter_pattern(boundaries: tuple):
+    """A pattern of delimiter lines of the boundaries, with the line break before it."""
+    return re.compile(rb'(?:^|\r?\n)--(' + b'|'.join(re.escape(b) for b in reversed(boundaries))
+                      + rb')(--)?[ \t]*(?:\r?\n|$)', re.MULTILINE)
+
+
+def _index(source, debug=False, log=None) -> tuple:
+    if isinstance(source, BUFFER_TYPES):
+        return index_buffer(source, debug, log)
+    return index_parts(source, debug, log)
 
-    for part in parts:
-        parsed_part = parse(part, debug, log)  # Recursive call
-        if parsed_part['content_text']:
-            content_text += parsed_part['content_text']
-        if parsed_part['content_html']:
-            content_html += parsed_part['content_html']
-        if parsed_part['attachments']:
-            attachments += parsed_part['attachments']
 
-    return content_text, content_html, attachments
+def _get_body(source, part: 'MailPart') -> List[bytes] or memoryview:
+    if isinstance(source, BUFFER_TYPES):
+        return memoryview(source)[part.start:part.end]
+    return source[part.start:part.end]
 
 
 def parse_one_part_body(headers: CaseInsensitiveDict, body: List[bytes], main_type: str, sub_type: str,
@@ -372,66 +542,68 @@ def parse_one_part_body(headers: CaseInsensitiveDict, body: List[bytes], main_ty
     return content_text, content_html, attachment
 
 
-def _decode_one_part_body(lines: List[bytes], transfer_encoding: str, charsets: List[str], _need_decode=True):
-    """Decode transfer-encoding then decode raw value to string."""
+def _decode_one_part_body(lines: List[bytes] or memoryview, transfer_encoding: str, charsets: List[str],
+                          _need_decode=True):
+    """Decode transfer-encoding then decode raw value to string.
+
+    The body is a list of lines or a slice of a buffer.
+    """
     if transfer_encoding == 'quoted-printable':
-        decoded_bytes = decodestring(b'\r\n'.join(lines))
+        decoded_bytes = decodestring(_join_lines(lines))
         if _need_decode:
             return recursive_decode(decoded_bytes, charsets)
         else:
-            return b'\r\n'.join(lines)
+            return _join_lines(lines)
     elif transfer_encoding == 'base64':
-        decoded_bytes = b64decode(b''.join(lines))
+        # a2b_base64 skips line breaks, a buffer slice is decoded without copying it.
+        decoded_bytes = a2b_base64(b''.join(lines) if isinstance(lines, list) else lines)
         if _need_decode:
             return recursive_decode(decoded_bytes, charsets)
         else:
             return decoded_bytes
     elif transfer_encoding in ('binary', '8bit', '7bit'):
         if _need_decode:
-            return recursive_decode(b'\r\n'.join(lines), charsets)
+            return recursive_decode(_join_lines(lines), charsets)
         else:
-            return b'\r\n'.join(lines)
+            return _join_lines(lines)
     else:
         raise ParseError('Invalid transfer-encoding {}'.format(transfer_encoding))
 
 
-def parse(lines: List[bytes], debug=False, log=None) -> CaseInsensitiveDict:
-    """Decode a multiple-part or Non-multiple-part mail to ParsedMail(as CaseInsensitiveDict)."""
-    log = log or logger
-    content_text = []
-    content_html = []
-    attachments = []
+def _join_lines(lines: List[bytes] or memoryview) -> bytes:
+    return b'\r\n'.join(lines) if isinstance(lines, list) else bytes(lines)
 
-    raw_headers, headers, eof_idx, main_type, sub_type, charsets, extra_kv = parse_headers(lines, debug, log)
 
-    body = lines[eof_idx + 1:]
+def get_transfer_encoding(headers: CaseInsensitiveDict) -> str:
+    transfer_encoding = headers.get('content-transfer-encoding')
 
-    if main_type == TYPE_MULTIPART:  # Include recursive call
-        boundary = extra_kv.get('boundary')
-        if boundary is None:
-            raise ParseError('Can not find boundary in multiple-part mail.')
+    if transfer_encoding is not None:
+        return transfer_encoding.lower()
+    # Default transfer_encoding.
+    return '8bit'
 
-        _content_text, _content_html, _attachment = multiple_part_decode(body, boundary, debug, log)
 
-        if _content_text:
-            content_text += _content_text
-        if _content_html:
-            content_html += _content_html
-        if _attachment:
-            attachments += _attachment
+def parse(lines: List[bytes] or bytes, debug=False, log=None, lazy=False) -> CaseInsensitiveDict:
+    """Decode a multiple-part or Non-multiple-part mail to ParsedMail(as CaseInsensitiveDict).
 
-    else:  # Recursive exit
-        transfer_encoding = headers.get('content-transfer-encoding')
+    The mail is a list of lines, or one buffer (bytes, bytearray, memoryview or mmap) whose
+    parts are decoded from slices of it. If lazy, return a ParsedMail whose parts are decoded on access.
+    """
+    if lazy:
+        return ParsedMail(lines, debug, log)
 
-        if transfer_encoding is not None:
-            transfer_encoding = transfer_encoding.lower()
-        else:
-            # Default transfer_encoding.
-            transfer_encoding = '8bit'
+    log = log or logger
+    content_text = []
+    content_html = []
+    attachments = []
+
+    raw_headers, headers, charsets, parts = _index(lines, debug, log)
 
-        _content_text, _content_html, _attachment = parse_one_part_body(headers, body, main_type, sub_type,
-                                                                        transfer_encoding, charsets, extra_kv,
-                                                                        debug, log)
+    for part in parts:
+        _content_text, _content_html, _attachment = parse_one_part_body(part.headers, _get_body(lines, part),
+                                                                        part.main_type, part.sub_type,
+                                                                        get_transfer_encoding(part.headers),
+                                                                        part.charsets, part.extra_kv, debug, log)
 
         if _content_text:
             content_text.append(_content_text)
@@ -457,9 +629,156 @@ def parse(lines: List[bytes], debug=False, log=None) -> CaseInsensitiveDict:
     return mail
 
 
-def parse_mail(lines: List[bytes], which: int, debug=False, log=None) -> CaseInsensitiveDict:
-    """A wrapper for parse mail."""
-    parsed_mail = parse(lines, debug, log)
+class _Lazy:
+    """Value of a ParsedMail key which is not decoded yet."""
+
+
+class ParsedMail(CaseInsensitiveDict):
+    """A parsed mail whose content_text, content_html and attachments are decoded on first access.
+
+    Headers of the mail and of every part are parsed when it is made, bodies of parts are
+    kept as is and only the parts of the accessed key are decoded, then the result is kept.
+    """
+
+    LAZY_KEYS = {'content_text': 'text', 'content_html': 'html', 'attachments': 'attachment'}
+
+    def __init__(self, lines: List[bytes] or bytes, debug=False, log=None):
+        super().__init__()
+        self._debug = debug
+        self._log = log
+        self._lines = lines
+        raw_headers, headers, charsets, self._parts = _index(lines, debug, log)
+
+        for key in self.LAZY_KEYS:
+            self[key] = _Lazy
+
+        self['headers'] = headers
+        self['raw_headers'] = raw_headers
+        self['charsets'] = charsets
+
+        self['subject'] = headers.get('subject')
+        self['date'] = headers.get('date')
+        self['from'] = headers.get('from')
+        self['to'] = headers.get('to')
+
+    def __getitem__(self, key):
+        value = super().__getitem__(key)
+        if value is _Lazy:
+            value = self._decode(self.LAZY_KEYS[key.lower()])
+            self[key.lower()] = value
+        return value
+
+    def _decode(self, kind: str) -> list:
+        decoded = []
+        for part in self._parts:
+            if _get_part_kind(part) != kind:
+                continue
+            values = parse_one_part_body(part.headers, _get_body(self._lines, part), part.main_type,
+                                         part.sub_type, get_transfer_encoding(part.headers), part.charsets,
+                                         part.extra_kv, self._debug, self._log or logger)
+            value = next((v for v in values if v), None)
+            if value:
+                decoded.append(value)
+        return decoded
+
+    def is_decoded(self, key: str) -> bool:
+        return super().__getitem__(key) is not _Lazy
+
+    def lower_items(self):
+        return ((lowerkey, self[lowerkey]) for lowerkey in self._store)
+
+    def copy(self):
+        return CaseInsensitiveDict(self.items())
+
+
+def _get_part_kind(part: MailPart) -> str:
+    """'text', 'html' or 'attachment', decided like parse_one_part_body."""
+    content_disposition = part.headers.get('content-disposition')
+    if content_disposition is not None and content_disposition.find('attachment') == 0:
+        return 'attachment'
+    if (part.main_type, part.sub_type) == TYPE_TEXT_PLAIN:
+        return 'text'
+    if (part.main_type, part.sub_type) == TYPE_TEXT_HTML:
+        return 'html'
+    return 'attachment'
+
+
+def parse_mail(lines: List[bytes] or bytes, which: int, debug=False, log=None, lazy=False) -> CaseInsensitiveDict:
+    """A wrapper for parse mail, mail['raw'] is the given lines or buffer."""
+    parsed_mail = parse(lines, debug, log, lazy)
     parsed_mail['id'] = which
     parsed_mail['raw'] = lines
     return parsed_mail
+
+
+# A part of BODYSTRUCTURE, section is the part specifier used by BODY[section].
+BodyPart = namedtuple('BodyPart', ('section', 'mime_section', 'main_type', 'sub_type', 'disposition', 'size'))
+
+
+def parse_imap_response(data: list) -> list:
+    """Parse a response of imaplib, bytes and (bytes, literal) tuples, to nested lists.
+
+    Atoms and strings are bytes, NIL is None, literals are bytes.
+    """
+    root = []
+    stack = [root]
+    for item in data:
+        text, literal = item if isinstance(item, tuple) else (item, None)
+        for match in IMAP_TOKEN.finditer(text):
+            open_paren, close_paren, quoted, size, atom = match.groups()
+            if open_paren:
+                stack.append([])
+                stack[-2].append(stack[-1])
+            elif close_paren:
+                if len(stack) > 1:
+                    stack.pop()
+            elif quoted is not None:
+                stack[-1].append(IMAP_QUOTED_ESCAPE.sub(rb'\1', quoted))
+            elif size is not None:
+                if literal is None:
+                    raise ParseError('Literal of {} bytes is missing.'.format(size.decode()))
+                stack[-1].append(literal)
+            elif atom.upper() == b'NIL':
+                stack[-1].append(None)
+            else:
+                stack[-1].append(atom)
+    return root
+
+
+def parse_bodystructure(node: list) -> List[BodyPart]:
+    """Get leaf parts of a parsed BODYSTRUCTURE in order."""
+    if node and isinstance(node[0], list):
+        parts = []
+        _walk_bodystructure(node, '', parts)
+        return parts
+    # A single-part mail, whose MIME headers are the mail headers.
+    return [_make_body_part(node, '1', 'HEADER')]
+
+
+def _walk_bodystructure(node: list, prefix: str, parts: List[BodyPart]):
+    # Body parts come first, followed by the subtype and extension data.
+    for idx, child in enumerate(itertools.takewhile(lambda c: isinstance(c, list), node)):
+        section = '{}{}'.format(prefix, idx + 1)
+        if isinstance(child[0], list):
+            _walk_bodystructure(child, section + '.', parts)
+        else:
+            parts.append(_make_body_part(child, section, section + '.MIME'))
+
+
+def _make_body_part(node: list, section: str, mime_section: str) -> BodyPart:
+    main_type = _imap_str(node[0]).lower()
+    sub_type = _imap_str(node[1]).lower()
+    # Extension data starts after the type specific fields.
+    if main_type == 'text':
+        ext = 8
+    elif (main_type, sub_type) == ('message', 'rfc822'):
+        ext = 10
+    else:
+        ext = 7
+    disposition = node[ext + 1] if len(node) > ext + 1 and isinstance(node[ext + 1], list) else None
+    disposition = _imap_str(disposition[0]).lower() if disposition else None
+    return BodyPart(section, mime_section, main_type, sub_type, disposition, int(node[6] or 0))
+
+
+def _imap_str(value) -> str:
+    return value.decode('utf-8', 'replace') if isinstance(value, bytes) else ''
@@ -0,0 +1,186 @@
+"""
+zmail.sender
+~~~~~~~~~~~~
+This module provides a ConcurrentSender to send mails over many SMTP connections.
+"""
+import queue
+import random
+import smtplib
+import threading
+import time
+from typing import Iterable, List, Optional
+
+from .exceptions import InvalidArguments
+from .helpers import first_not_none
+from .server import MailServer, SMTPServer, make_mail
+from .structures import SendResult
+
+# Replies meaning "try again later": service unavailable, local error, insufficient storage.
+TRANSIENT_CODES = (421, 451, 452)
+
+
+def is_transient_error(e: BaseException) -> bool:
+    """Whether sending may succeed if retried later."""
+    if isinstance(e, smtplib.SMTPRecipientsRefused):
+        return bool(e.recipients) and all(code in TRANSIENT_CODES for code, _ in e.recipients.values())
+    if isinstance(e, smtplib.SMTPResponseException):
+        return e.smtp_code in TRANSIENT_CODES
+    if isinstance(e, smtplib.SMTPException):
+        return isinstance(e, smtplib.SMTPServerDisconnected)
+    return isinstance(e, (OSError, EOFError))
+
+
+class TokenBucket:
+    """A thread-safe token bucket, allows `rate` acquisitions per second with bursts of `capacity`.
+
+    Share one TokenBucket between senders of the same account to rate limit the account.
+    """
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        if rate <= 0:
+            raise InvalidArguments('rate excepted positive number got {}'.format(rate))
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens: float = 1.0) -> None:
+        """Block until tokens are available."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                wait = (tokens - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class AdaptiveBackoff:
+    """A pause shared by all connections, doubled every time the server asks to slow down
+    and halved after every successful send."""
+
+    def __init__(self, base: float = 1.0, maximum: float = 60.0):
+        self.base = base
+        self.maximum = maximum
+        self.delay = 0.0
+        self._until = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self) -> None:
+        while True:
+            with self._lock:
+                wait = self._until - time.monotonic()
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+    def failed(self) -> None:
+        with self._lock:
+            self.delay = min(self.maximum, self.delay * 2 if self.delay else self.base)
+            # Add jitter to avoid every connection coming back at once.
+            self._until = max(self._until, time.monotonic() + self.delay * random.uniform(0.5, 1.0))
+
+    def succeeded(self) -> None:
+        with self._lock:
+            self.delay = self.delay / 2 if self.delay > self.base else 0.0
+
+
+class ConcurrentSender:
+    """Send mails over up to max_connections authenticated SMTP connections of a MailServer.
+
+    Every connection sends at most max_per_connection mails before it is re-made,
+    rate_limiter (or rate, in mails per second) limits the whole account. When the server
+    answers 421/451/452 or disconnects, all connections back off and the mail is retried
+    up to max_retries times.
+    """
+
+    def __init__(self, mail_server: MailServer, max_connections: int = 4,
+                 max_per_connection: Optional[int] = None,
+                 rate: Optional[float] = None, rate_limiter: Optional[TokenBucket] = None,
+                 max_retries: int = 5, backoff: float = 1.0, max_backoff: float = 60.0):
+        if not isinstance(max_connections, int) or max_connections < 1:
+            raise InvalidArguments('max_connections excepted positive int got {}'.format(max_connections))
+
+        self.mail_server = mail_server
+        self.max_connections = max_connections
+        self.max_per_connection = max_per_connection
+        self.rate_limiter = rate_limiter or (TokenBucket(rate) if rate is not None else None)
+        self.max_retries = max_retries
+        self.backoff = AdaptiveBackoff(backoff, max_backoff)
+        self.log = mail_server.log
+
+    def send_mails(self, mails: Iterable[tuple], timeout=None,
+                   auto_add_from=True, auto_add_to=True) -> List[SendResult]:
+        """Send (recipients, mail) pairs concurrently, return a SendResult for every mail in order."""
+        tasks = queue.Queue()
+        count = 0
+        for count, (recipients, mail) in enumerate(mails, 1):
+            tasks.put((count - 1, recipients, mail))
+        results = [None] * count  # type:List[SendResult or None]
+
+        options = (first_not_none(timeout, self.mail_server.timeout),
+                   first_not_none(auto_add_from, self.mail_server.auto_add_from),
+                   first_not_none(auto_add_to, self.mail_server.auto_add_to))
+        workers = [threading.Thread(target=self._work, args=(tasks, results, options), daemon=True)
+                   for _ in range(min(self.max_connections, count))]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        return results
+
+    def _work(self, tasks: queue.Queue, results: list, options: tuple):
+        timeout, auto_add_from, auto_add_to = options
+        server = self.mail_server.make_smtp_server()  # type:SMTPServer
+        server.open_session()
+        sent = 0
+
+        try:
+            while True:
+                try:
+                    index, recipients, mail = tasks.get_nowait()
+                except queue.Empty:
+                    return
+
+                try:
+                    recipients, _mail = make_mail(self.mail_server.username, recipients, mail, None,
+                                                  auto_add_from, auto_add_to,
+                                                  self.mail_server.debug, self.log)
+                except Exception as e:
+                    results[index] = SendResult(recipients, False, {}, e)
+                    continue
+
+                retries = 0
+                while True:
+                    self.backoff.wait()
+                    if self.rate_limiter is not None:
+                        self.rate_limiter.acquire()
+                    if self.max_per_connection is not None and sent >= self.max_per_connection:
+                        server.close_connection()
+                        sent = 0
+
+                    try:
+                        with server:
+                            refused = server.send(recipients, _mail, timeout)
+                    except Exception as e:
+                        if retries < self.max_retries and is_transient_error(e):
+                            retries += 1
+                            self.log.debug('Transient SMTP error {!r}, retry {}.'.format(e, retries))
+                            self.backoff.failed()
+                            if server._is_connection_error(e) or getattr(e, 'smtp_code', None) == 421:
+                                server.close_connection()
+                                sent = 0
+                            continue
+                        results[index] = SendResult(recipients, False, {}, e)
+                    else:
+                        self.backoff.succeeded()
+                        results[index] = SendResult(recipients, True, refused, None)
+                        sent += 1
+                    break
+        finally:
+            server.close_session()
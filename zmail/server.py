@@ -4,29 +4,127 @@ zmail.server
 This module provides a MailServer object to communicate with mail server.
 """
 
-import datetime
+import functools
+import imaplib
 import logging
 import poplib
+import re
+import select
 import smtplib
+import ssl
+import time
 import warnings
-from typing import Iterable, List, Optional
+from collections import deque
+from concurrent.futures import Executor, ProcessPoolExecutor
+from contextlib import contextmanager
+from typing import Iterable, Iterator, List, Optional, Tuple
 
 from .abc import BaseServer
+from .cache import HeaderCache
+from .compat import PY_39
 from .exceptions import InvalidArguments
-from .helpers import (convert_date_to_datetime, first_not_none,
-                      get_intersection, make_address_header, make_list,
-                      match_conditions)
-from .mime import Mail
-from .parser import parse_headers, parse_mail
+from .helpers import (convert_time_range, first_not_none, get_intersection,
+                      make_address_header, make_list, make_search_criteria, match_conditions)
+from .mime import Mail, RawMail
+from .parser import (TYPE_TEXT_HTML, TYPE_TEXT_PLAIN, parse, parse_bodystructure, parse_headers,
+                     parse_imap_response, parse_mail)
 from .settings import __local__
-from .structures import CaseInsensitiveDict
+from .structures import CaseInsensitiveDict, LazyAttachment, SendResult
+from .template import RenderedMail
 
-# Fix poplib bug.
-poplib._MAXLINE = 4096
+# Read buffer of POP3 connections, multi-line responses are scanned for their end in blocks of it.
+POP_BUFFER_SIZE = 256 * 1024
+
+# Max number of POP3 commands in flight when the server supports PIPELINING.
+DEFAULT_PIPELINE_WINDOW = 32
+
+# Size of BDAT chunks when the SMTP server supports CHUNKING.
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+
+# Max number of mails fetched by one IMAP FETCH command.
+DEFAULT_FETCH_BATCH = 16
+
+# Max number of mails fetched ahead of the consumer while a worker pool parses them.
+PARSE_AHEAD = 32
+
+# Seconds before IDLE is re-issued, RFC 2177 lets servers drop clients idle for 30 minutes,
+# NAT gateways often drop them sooner.
+IDLE_INTERVAL = 10 * 60
+
+# Seconds between two checks of watch() polling a mailbox, doubled up to MAX_POLL_INTERVAL
+# while no mail arrives.
+DEFAULT_POLL_INTERVAL = 30
+MAX_POLL_INTERVAL = 5 * 60
+
+RFC822_SIZE = re.compile(rb'RFC822\.SIZE (\d+)')
+FETCH_UID = re.compile(rb'(\d+) \(UID (\d+)\)')
+BODY_SECTION = re.compile(rb'BODY\[([^\]]*)\]', re.IGNORECASE)
+
+# Bytes of a message collected before writing them to the SMTP socket.
+SEND_BUFFER_SIZE = 64 * 1024
+
+CRLF = b'\r\n'
 
 logger = logging.getLogger('zmail')
 
 
+def make_mail(username: str, recipients: List[str] or str, mail: dict or CaseInsensitiveDict or RenderedMail,
+              cc=None, auto_add_from=True, auto_add_to=True, debug=False, log=None) -> Tuple[List[str], Mail]:
+    """Make a Mail with From, To and Cc headers, return it and the address list of recipients.
+
+    A RenderedMail of MailTemplate or a RawMail is used as is, only these headers are added to it.
+    """
+    _mail = mail if isinstance(mail, (RenderedMail, RawMail)) else Mail(mail, debug=debug, log=log)
+
+    if auto_add_from and _mail.mail.get('From') is None:
+        _mail.set_mime_header('From', make_address_header([username]))
+
+    recipients = list(make_list(recipients))
+    if auto_add_to and _mail.mail.get('To') is None:
+        _mail.set_mime_header('To', make_address_header(recipients))
+
+    # Add Carbon Copy address.
+    cc = make_list(cc) if cc is not None else None
+    if cc is not None:
+        for address in cc:
+            recipients.append(address)
+        _mail.set_mime_header('Cc', make_address_header(cc))
+
+    # Remove tuple format in recipients.
+    recipients = [i if not isinstance(i, tuple) else i[1] for i in recipients]
+
+    return recipients, _mail
+
+
+def iter_data(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    """Dot-stuff a message for DATA and end it with CRLF.CRLF, in blocks of about SEND_BUFFER_SIZE bytes."""
+    buffer = bytearray()
+    line_start = True
+    for chunk in chunks:
+        if not chunk:
+            continue
+        if line_start and chunk[:1] == b'.':
+            buffer += b'.'
+        buffer += chunk.replace(b'\n.', b'\n..')
+        line_start = chunk[-1:] == b'\n'
+        if len(buffer) >= SEND_BUFFER_SIZE:
+            yield bytes(buffer)
+            buffer.clear()
+
+    if not line_start:
+        buffer += CRLF
+    buffer += b'.' + CRLF
+    yield bytes(buffer)
+
+
+def _is_ascii(s: str) -> bool:
+    try:
+        s.encode('ascii')
+    except UnicodeEncodeError:
+        return False
+    return True
+
+
 class MailServer:
 
     def __init__(self, username: str, password: str,
@@ -35,7 +133,12 @@ class MailServer:
                  smtp_ssl: bool, pop_ssl: bool,
                  smtp_tls: bool, pop_tls: bool,
                  debug: bool = False, log=None, timeout=60,
-                 auto_add_from=True, auto_add_to=True):
+                 auto_add_from=True, auto_add_to=True,
+                 pipelining=True, pipeline_window=DEFAULT_PIPELINE_WINDOW,
+                 header_cache: Optional[HeaderCache or str] = None,
+                 imap_host: Optional[str] = None, imap_port: Optional[int] = None,
+                 imap_ssl: bool = True, imap_tls: bool = False,
+                 backend: str = 'pop', mailbox: str = 'INBOX'):
         self.username = username
         self.password = password
         self.debug = debug
@@ -52,11 +155,28 @@ class MailServer:
         self.pop_ssl = pop_ssl
         self.pop_tls = pop_tls
 
+        self.imap_host = imap_host
+        self.imap_port = imap_port
+        self.imap_ssl = imap_ssl
+        self.imap_tls = imap_tls
+        self.mailbox = mailbox
+
+        # Protocol used to read mailbox, 'pop' or 'imap'.
+        self.backend = backend
+
         self.auto_add_from = auto_add_from
         self.auto_add_to = auto_add_to
 
+        self.pipelining = pipelining
+        self.pipeline_window = pipeline_window
+
+        if isinstance(header_cache, str):
+            header_cache = HeaderCache(header_cache)
+        self.header_cache = header_cache  # type:HeaderCache or None
+
         self.smtp_server = None  # type:SMTPServer or None
         self.pop_server = None  # type:POPServer or None
+        self.imap_server = None  # type:IMAPServer or None
 
         # Check arguments.
         if not isinstance(self.log, logging.Logger):
@@ -65,20 +185,25 @@ class MailServer:
         if not isinstance(self.timeout, (int, float)):
             raise InvalidArguments('timeout excepted type int or float got {}'.format(type(self.timeout)))
 
+        if not isinstance(self.pipeline_window, int) or self.pipeline_window < 1:
+            raise InvalidArguments('pipeline_window excepted positive int got {}'.format(self.pipeline_window))
+
+        if self.header_cache is not None and not isinstance(self.header_cache, HeaderCache):
+            raise InvalidArguments('header_cache excepted type str or HeaderCache got {}'
+                                   .format(type(self.header_cache)))
+
+        if self.backend not in ('pop', 'imap'):
+            raise InvalidArguments("backend excepted 'pop' or 'imap' got {}".format(self.backend))
+
+        if self.backend == 'imap' and (self.imap_host is None or self.imap_port is None):
+            raise InvalidArguments('imap_host and imap_port are required by imap backend.')
+
         self.prepare()
 
     def prepare(self):
-        """Init SMTPServer and POPServer."""
+        """Init SMTPServer, POPServer and IMAPServer if it is configured."""
         if self.smtp_server is None:
-            self.smtp_server = SMTPServer(username=self.username,
-                                          password=self.password,
-                                          host=self.smtp_host,
-                                          port=self.smtp_port,
-                                          ssl=self.smtp_ssl,
-                                          tls=self.smtp_tls,
-                                          timeout=self.timeout,
-                                          debug=self.debug,
-                                          log=self.log)
+            self.smtp_server = self.make_smtp_server()
         if self.pop_server is None:
             self.pop_server = POPServer(username=self.username,
                                         password=self.password,
@@ -88,87 +213,223 @@ class MailServer:
                                         tls=self.pop_tls,
                                         timeout=self.timeout,
                                         debug=self.debug,
-                                        log=self.log)
+                                        log=self.log,
+                                        pipelining=self.pipelining,
+                                        pipeline_window=self.pipeline_window)
+        if self.imap_server is None and self.imap_host is not None:
+            self.imap_server = IMAPServer(username=self.username,
+                                          password=self.password,
+                                          host=self.imap_host,
+                                          port=self.imap_port,
+                                          ssl=self.imap_ssl,
+                                          tls=self.imap_tls,
+                                          timeout=self.timeout,
+                                          debug=self.debug,
+                                          log=self.log,
+                                          mailbox=self.mailbox)
+
+    @property
+    def mailbox_server(self) -> 'POPServer or IMAPServer':
+        """The server used to read mailbox, decided by backend."""
+        return self.imap_server if self.backend == 'imap' else self.pop_server
+
+    def make_smtp_server(self) -> 'SMTPServer':
+        """Make a new SMTPServer of this account, used when more than one connection is needed."""
+        return SMTPServer(username=self.username,
+                          password=self.password,
+                          host=self.smtp_host,
+                          port=self.smtp_port,
+                          ssl=self.smtp_ssl,
+                          tls=self.smtp_tls,
+                          timeout=self.timeout,
+                          debug=self.debug,
+                          log=self.log,
+                          pipelining=self.pipelining)
 
     def send_mail(self, recipients: List[str] or str, mail: dict or CaseInsensitiveDict, cc=None,
                   timeout=None, auto_add_from=True, auto_add_to=True) -> bool:
         """"Send email."""
-        _mail = Mail(mail, debug=self.debug, log=self.log)
+        recipients, _mail = make_mail(self.username, recipients, mail, cc,
+                                      first_not_none(auto_add_from, self.auto_add_from),
+                                      first_not_none(auto_add_to, self.auto_add_to),
+                                      self.debug, self.log)
 
-        if first_not_none(auto_add_from, self.auto_add_from) and _mail.mail.get('From') is None:
-            _mail.set_mime_header('From', make_address_header([self.username]))
+        with self.smtp_server as server:
+            server.send(recipients, _mail,
+                        first_not_none(timeout, self.timeout))
 
-        recipients = make_list(recipients)
-        if first_not_none(auto_add_to, self.auto_add_to) and _mail.mail.get('To') is None:
-            _mail.set_mime_header('To', make_address_header(recipients))
+        return True
 
-        # Add Carbon Copy address.
-        cc = make_list(cc) if cc is not None else None
-        if cc is not None:
-            for address in cc:
-                recipients.append(address)
-            _mail.set_mime_header('Cc', make_address_header(cc))
+    def resend(self, recipients: List[str] or str, mail: CaseInsensitiveDict or List[bytes],
+               headers: Optional[dict] = None, timeout=None) -> dict:
+        """Send a fetched mail as is to other recipients, return refused recipients.
 
-        # Remove tuple format in recipients.
-        recipients = [i if not isinstance(i, tuple) else i[1] for i in recipients]
+        The original bytes in mail['raw'] are sent without rebuilding MIME, only the envelope
+        changes and headers, e.g. {'Resent-To': ...}, are prepended if given.
+        """
+        _mail = RawMail(mail, headers)
+        recipients = [i if not isinstance(i, tuple) else i[1] for i in make_list(recipients)]
 
         with self.smtp_server as server:
-            server.send(recipients, _mail,
-                        first_not_none(timeout, self.timeout))
+            return server.send(recipients, _mail, first_not_none(timeout, self.timeout))
 
-        return True
+    def send_mails(self, mails: Iterable[tuple], timeout=None, auto_add_from=True, auto_add_to=True,
+                   max_per_session: Optional[int] = None) -> List[SendResult]:
+        """Send many (recipients, mail) pairs through one SMTP session.
+
+        The connection is re-made after every max_per_session mails, and when the server
+        disconnects or answers 421, in which case the failed mail is retried once.
+        A failed mail does not abort the batch, a SendResult is returned for every mail.
+        """
+        results = []
+        sent = 0
+
+        self.smtp_server.open_session()
+        try:
+            for recipients, mail in mails:
+                try:
+                    recipients, _mail = make_mail(self.username, recipients, mail, None,
+                                                  first_not_none(auto_add_from, self.auto_add_from),
+                                                  first_not_none(auto_add_to, self.auto_add_to),
+                                                  self.debug, self.log)
+                except Exception as e:
+                    results.append(SendResult(recipients, False, {}, e))
+                    continue
+
+                if max_per_session is not None and sent >= max_per_session:
+                    self.smtp_server.close_connection()
+                    sent = 0
+
+                for retry in (True, False):
+                    try:
+                        with self.smtp_server as server:
+                            refused = server.send(recipients, _mail, first_not_none(timeout, self.timeout))
+                    except Exception as e:
+                        if retry and self._is_smtp_session_lost(e):
+                            self.log_debug('SMTP session lost ({!r}), reconnecting.'.format(e))
+                            self.smtp_server.close_connection()
+                            sent = 0
+                            continue
+                        results.append(SendResult(recipients, False, {}, e))
+                    else:
+                        results.append(SendResult(recipients, True, refused, None))
+                        sent += 1
+                    break
+        finally:
+            self.smtp_server.close_session()
+
+        return results
+
+    def _is_smtp_session_lost(self, e: Exception) -> bool:
+        if isinstance(e, smtplib.SMTPResponseException) and e.smtp_code == 421:
+            return True
+        return self.smtp_server._is_connection_error(e)
 
     def delete(self, which: int) -> bool:
         """Delete mail."""
-        with self.pop_server as server:
+        with self.mailbox_server as server:
             server.delete(which)
         return True
 
     def stat(self) -> tuple:
         """Get mailbox status."""
-        with self.pop_server as server:
+        with self.mailbox_server as server:
             return server.stat()
 
-    def get_mail(self, which: int) -> CaseInsensitiveDict:
-        """Get a mail from mailbox."""
-        with self.pop_server as server:
+    def get_mail(self, which: int, lazy: bool = False) -> CaseInsensitiveDict:
+        """Get a mail from mailbox.
+
+        If lazy, parts are decoded on first access. With the imap backend only text parts are
+        downloaded and attachments are LazyAttachment, with the pop backend the mail is
+        a ParsedMail.
+        """
+        with self.mailbox_server as server:
+            if lazy and self.backend == 'imap':
+                return server.get_lazy_mail(which, self.debug, self.log)
             mail = server.get_mail(which)
-            return parse_mail(mail, which, self.debug, self.log)
+            return parse_mail(mail, which, self.debug, self.log, lazy)
 
     def get_mails(self, subject=None, start_time=None, end_time=None, sender=None,
-                  start_index: Optional[int] = None, end_index: Optional[int] = None) -> list:
-        """Get a list of mails from mailbox."""
-        headers = self.get_headers(start_index, end_index)
-        mail_id = []
-
-        if start_time is not None:
-            if isinstance(start_time, (datetime.datetime, str)):
-                start_time = convert_date_to_datetime(start_time)
+                  start_index: Optional[int] = None, end_index: Optional[int] = None, lazy: bool = False,
+                  workers: Optional[int or Executor] = None) -> list:
+        """Get a list of mails from mailbox.
+
+        If workers is given, mails are parsed by a process pool of this size, or by the given
+        Executor, while the following mails are fetched.
+        """
+        return list(self.iter_mails(subject, start_time, end_time, sender, start_index, end_index, lazy, workers))
+
+    def iter_mails(self, subject=None, start_time=None, end_time=None, sender=None,
+                   start_index: Optional[int] = None, end_index: Optional[int] = None, lazy: bool = False,
+                   workers: Optional[int or Executor] = None) -> Iterator[CaseInsensitiveDict]:
+        """Like get_mails, but fetch, parse and yield mails one by one."""
+        start_time, end_time = convert_time_range(start_time, end_time)
+        if workers is not None:
+            if lazy:
+                raise InvalidArguments('workers can not be used with lazy fetching.')
+            if not isinstance(workers, Executor) and (not isinstance(workers, int) or workers < 1):
+                raise InvalidArguments('workers excepted positive int or Executor got {}'.format(workers))
+        return self._iter_mails(subject, start_time, end_time, sender, start_index, end_index, lazy, workers)
+
+    def _iter_mails(self, subject, start_time, end_time, sender, start_index, end_index, lazy=False, workers=None):
+        conditions = (subject, start_time, end_time, sender)
+        with self.mailbox_server as server:
+            if conditions == (None, None, None, None):
+                # No conditions, skip fetching headers.
+                mail_id = get_intersection((1, server.count()), (start_index, end_index))
+            elif self.backend == 'imap':
+                # Let server search, its result is refined by match_conditions after fetching.
+                mail_id = server.search(*make_search_criteria(*conditions))
+                mail_id = [which for which in mail_id
+                           if (start_index is None or which >= start_index)
+                           and (end_index is None or which <= end_index)]
             else:
-                raise InvalidArguments(
-                    'start_time excepted type str or datetime.datetime, got {} instead.'.format(type(start_time)))
-
-        if end_time is not None:
-            if isinstance(end_time, (datetime.datetime, str)):
-                end_time = convert_date_to_datetime(end_time)
+                mail_id = [header['id'] for header in self.iter_headers(start_index, end_index)
+                           if match_conditions(header, *conditions)]
+                mail_id.sort()
+
+            fetched = None
+            if lazy and self.backend == 'imap':
+                mails = (server.get_lazy_mail(which, self.debug, self.log) for which in mail_id)
+            elif workers is not None:
+                fetched = server.iter_mails(mail_id)
+                mails = self._parse_in_pool(workers, zip(mail_id, fetched))
             else:
-                raise InvalidArguments(
-                    'end_time excepted type str or datetime.datetime, got {} instead.'.format(type(end_time)))
-
-        for header in headers:
-            if match_conditions(header, subject, start_time, end_time, sender):
-                mail_id.append(header['id'])
-
-        with self.pop_server as server:
-            mail_id.sort()
-            mail_as_bytes_list = server.get_mails(mail_id)
-            return [parse_mail(mail_as_bytes, mail_id[index], self.debug, self.log)
-                    for index, mail_as_bytes in enumerate(mail_as_bytes_list)]
+                fetched = server.iter_mails(mail_id)
+                mails = (parse_mail(mail_as_bytes, which, self.debug, self.log, lazy)
+                         for which, mail_as_bytes in zip(mail_id, fetched))
+            try:
+                for mail in mails:
+                    if self.backend != 'imap' or match_conditions(mail, *conditions):
+                        yield mail
+            finally:
+                mails.close()
+                # Finish in-flight commands before the connection is reused or closed.
+                if fetched is not None:
+                    fetched.close()
+
+    def _parse_in_pool(self, workers: int or Executor, fetched: Iterator[tuple]) -> Iterator[CaseInsensitiveDict]:
+        """Parse (id, mail) pairs in a worker pool as soon as they are fetched, yield results in order."""
+        pool = workers if isinstance(workers, Executor) else ProcessPoolExecutor(workers)
+        futures = deque()
+        try:
+            for which, mail_as_bytes in fetched:
+                # Loggers are not sent to worker processes.
+                futures.append(pool.submit(parse_mail, mail_as_bytes, which, self.debug))
+                if len(futures) >= PARSE_AHEAD:
+                    yield futures.popleft().result()
+            while futures:
+                yield futures.popleft().result()
+        finally:
+            for future in futures:
+                future.cancel()
+            if pool is not workers:
+                pool.shutdown()
 
     def get_latest(self) -> CaseInsensitiveDict:
         """Get latest mail in mailbox."""
-        with self.pop_server as server:
-            latest_num = server.stat()[0]
+        with self.mailbox_server as server:
+            latest_num = server.count()
             mail = server.get_mail(latest_num)
             return parse_mail(mail, latest_num, self.debug, self.log)
 
@@ -177,26 +438,173 @@ class MailServer:
                       "use server.get_headers instead",
                       DeprecationWarning,
                       stacklevel=2)
-        with self.pop_server as server:
+        with self.mailbox_server as server:
             return server.get_headers()
 
     def get_headers(self, start_index: Optional[int] = None, end_index: Optional[int] = None) \
             -> List[CaseInsensitiveDict]:
         """Get mails headers."""
-        headers = []
+        return list(self.iter_headers(start_index, end_index))
 
-        with self.pop_server as server:
-            end = server.stat()[0]
+    def iter_headers(self, start_index: Optional[int] = None, end_index: Optional[int] = None) \
+            -> Iterator[CaseInsensitiveDict]:
+        """Like get_headers, but fetch, parse and yield headers one by one."""
+        with self.mailbox_server as server:
+            end = server.count()
             intersection = get_intersection((1, end), (start_index, end_index))  # type:List[int]
-            mail_hdrs = server.get_headers(intersection)
-
-        for index, mail_header in enumerate(mail_hdrs):
+            if self.header_cache is not None:
+                uids = server.get_uids()
+                if uids is not None:
+                    yield from self._get_cached_headers(server, intersection, uids)
+                    return
+
+            mail_hdrs = server.iter_headers(intersection)
+            try:
+                for which, mail_header in zip(intersection, mail_hdrs):
+                    _, _headers, *__ = parse_headers(mail_header)
+                    _headers.update(id=which)
+                    yield _headers
+            finally:
+                mail_hdrs.close()
+
+    def _get_cache_account(self) -> str:
+        """Key of the mailbox in header_cache, unique-ids of POP3 and IMAP differ for one account."""
+        host = self.imap_host if self.backend == 'imap' else self.pop_host
+        return '{}@{}:{}'.format(self.username, host, self.backend)
+
+    def _get_cached_headers(self, server, which_list: List[int], uids: dict) -> List[CaseInsensitiveDict]:
+        """Get mails headers, only fetch headers of mails which are not in header_cache."""
+        account = self._get_cache_account()
+        cached = self.header_cache.get_many(account, (uids[which] for which in which_list))
+        missing = [which for which in which_list if uids[which] not in cached]
+
+        fetched = {}
+        for which, mail_header in zip(missing, server.get_headers(missing)):
             _, _headers, *__ = parse_headers(mail_header)
-            _headers.update(id=intersection[index])
+            fetched[uids[which]] = _headers
+
+        self.header_cache.set_many(account, fetched)
+        self.header_cache.prune(account, uids.values())
+
+        headers = []
+        for which in which_list:
+            uid = uids[which]
+            _headers = fetched[uid] if uid in fetched else cached[uid]
+            _headers.update(id=which)
             headers.append(_headers)
 
         return headers
 
+    def watch(self, duration: Optional[float] = None, idle_interval: float = IDLE_INTERVAL,
+              poll_interval: float = DEFAULT_POLL_INTERVAL, max_poll_interval: float = MAX_POLL_INTERVAL) \
+            -> Iterator[CaseInsensitiveDict]:
+        """Yield mails arriving in mailbox from now on, for duration seconds or forever.
+
+        If backend is 'imap', one connection is kept open and the server pushes new mails by
+        IDLE, which is re-issued every idle_interval seconds. Otherwise mailbox is polled by UIDL
+        every poll_interval seconds, the interval is doubled up to max_poll_interval while no
+        mail arrives.
+
+        Note: POP3 servers only report new mails after logout, do not watch within a session.
+        """
+        deadline = None if duration is None else time.monotonic() + duration
+        if self.backend == 'imap':
+            return self._watch_imap(deadline, idle_interval, poll_interval)
+        return self._watch_pop(deadline, poll_interval, max_poll_interval)
+
+    def _watch_imap(self, deadline, idle_interval, poll_interval):
+        server = self.imap_server
+        server.open_session()
+        try:
+            with server:
+                can_idle = server.can_idle()
+                last_uid = server.last_uid()
+                uidvalidity = server._uidvalidity
+
+            while True:
+                remaining = _remaining(deadline)
+                if remaining is not None and remaining <= 0:
+                    return
+                if not can_idle:
+                    time.sleep(poll_interval if remaining is None else min(poll_interval, remaining))
+
+                try:
+                    with server:
+                        if server._uidvalidity != uidvalidity:
+                            # UIDs were reset while reconnecting, start over from the latest mail.
+                            last_uid = server.last_uid()
+                            uidvalidity = server._uidvalidity
+                        if can_idle:
+                            server.idle(idle_interval if remaining is None else min(idle_interval, remaining))
+                        uids = server.search_uids(last_uid + 1)
+                        mails = [parse_mail(mail, which, self.debug, self.log)
+                                 for which, mail in server.iter_mails_by_uid(uids)]
+                except Exception as e:
+                    if not server._is_connection_error(e):
+                        raise
+                    self.log_debug('IMAP connection lost ({!r}), reconnecting.'.format(e))
+                    time.sleep(poll_interval if remaining is None else min(poll_interval, remaining))
+                    continue
+
+                if uids:
+                    last_uid = uids[-1]
+                yield from mails
+        finally:
+            server.close_session()
+
+    def _watch_pop(self, deadline, poll_interval, max_poll_interval):
+        server = self.pop_server
+        with server:
+            uids = server.get_uids()
+            count = server.count()
+        seen = set(uids.values()) if uids is not None else None
+
+        interval = poll_interval
+        while True:
+            remaining = _remaining(deadline)
+            if remaining is not None and remaining <= 0:
+                return
+            time.sleep(interval if remaining is None else min(interval, remaining))
+
+            with server:
+                if seen is not None:
+                    uids = server.get_uids()
+                    mail_id = sorted(which for which, uid in uids.items() if uid not in seen)
+                    seen = set(uids.values())
+                else:
+                    # Without UIDL, assume new mails are appended.
+                    total = server.count()
+                    mail_id = list(range(count + 1, total + 1))
+                    count = total
+                mails = [parse_mail(mail, which, self.debug, self.log)
+                         for which, mail in zip(mail_id, server.iter_mails(mail_id))]
+
+            interval = poll_interval if mails else min(interval * 2, max_poll_interval)
+            yield from mails
+
+    @contextmanager
+    def session(self):
+        """Keep mailbox and SMTP connections logged in across calls within the block.
+
+        Note: POP3 servers only remove deleted mails and report new mails after logout,
+        so mails deleted within a session are removed when the session ends.
+        """
+        self.mailbox_server.open_session()
+        self.smtp_server.open_session()
+        try:
+            yield self
+        finally:
+            try:
+                self.smtp_server.close_session()
+            finally:
+                self.mailbox_server.close_session()
+
+    def keep_alive(self):
+        """Send NOOP to the connections of active session, call it periodically to keep them alive."""
+        for server in (self.mailbox_server, self.smtp_server):
+            if server.in_session() and server.is_login():
+                server.keep_alive(force=True)
+
     def log_debug(self, *args, **kwargs):
         self.log.debug(*args, **kwargs)
 
@@ -209,9 +617,26 @@ class MailServer:
     def pop_able(self) -> bool:
         return self.pop_server.check_available()
 
+    def imap_able(self) -> bool:
+        return self.imap_server is not None and self.imap_server.check_available()
+
 
 class SMTPServer(BaseServer):
-    """Base SMTPServer, which encapsulates python3 standard library to a SMTPServer."""
+    """Base SMTPServer, which encapsulates python3 standard library to a SMTPServer.
+
+    If the server advertises PIPELINING (RFC 2920) the envelope is sent in one write,
+    if it advertises CHUNKING (RFC 3030) the message is sent by BDAT in chunks of
+    `chunk_size` bytes without dot-stuffing.
+    If it advertises 8BITMIME (RFC 6152) text parts are sent as 8bit instead of base64,
+    and SMTPUTF8 (RFC 6531) is asked for when an address is not ASCII.
+    """
+
+    def __init__(self, *args, pipelining: bool = True, chunk_size: int = DEFAULT_CHUNK_SIZE,
+                 eight_bit: bool = True, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.pipelining = pipelining
+        self.chunk_size = chunk_size
+        self.eight_bit = eight_bit
 
     def _make_server(self):
         """Init Server if possible."""
@@ -270,18 +695,147 @@ class SMTPServer(BaseServer):
         self.server.starttls()
         self.server.ehlo()
 
+    def noop(self):
+        code, message = self.server.noop()
+        if code == 421:
+            raise smtplib.SMTPServerDisconnected(message)
+        if code != 250:
+            raise smtplib.SMTPResponseException(code, message)
+
+    def _is_connection_error(self, e: BaseException) -> bool:
+        # smtplib.SMTPException is a subclass of OSError, only disconnection is a connection error.
+        if isinstance(e, smtplib.SMTPException):
+            return isinstance(e, smtplib.SMTPServerDisconnected)
+        return super()._is_connection_error(e)
+
     # Methods
     def send(self, recipients: Iterable[str], mail: Mail,
-             timeout: int or float or None):
+             timeout: int or float or None) -> dict:
+        """Send mail, return refused recipients as a dict like smtplib.SMTP.sendmail.
 
+        The message is generated piece by piece while being written to the socket,
+        so memory used does not grow with the size of attachments.
+        """
         if timeout is not None:
             self.server.timeout = timeout
 
-        self.server.sendmail(self.username, recipients, mail.get_mime_as_string())
+        self.server.ehlo_or_helo_if_needed()
+        pipelining = self.pipelining and self.server.has_extn('pipelining')
+        chunking = self.server.has_extn('chunking')
+
+        eight_bit = self.eight_bit and self.server.has_extn('8bitmime')
+
+        recipients = list(recipients)
+        mail_options = ['BODY=8BITMIME'] if eight_bit else []
+        if self.server.has_extn('smtputf8') and not all(_is_ascii(a) for a in [self.username] + recipients):
+            mail_options.append('SMTPUTF8')
+
+        encoding = self.server.command_encoding
+        if 'SMTPUTF8' in mail_options:
+            self.server.command_encoding = 'utf-8'
+        try:
+            refused = self._send_envelope(recipients, pipelining, with_data=not chunking, mail_options=mail_options)
+        finally:
+            self.server.command_encoding = encoding
+
+        if chunking:
+            self._send_bdat(mail.iter_mime_bytes(eight_bit=eight_bit))
+        else:
+            self._send_data(mail.iter_mime_bytes(eight_bit=eight_bit))
+
+        return refused
+
+    def _send_envelope(self, recipients: List[str], pipelining: bool, with_data: bool,
+                       mail_options: Iterable[str] = ()) -> dict:
+        """Send MAIL FROM, RCPT TO (and DATA), in one write if pipelining."""
+        commands = [' '.join(['MAIL FROM:{}'.format(smtplib.quoteaddr(self.username))] + list(mail_options))]
+        commands += ['RCPT TO:{}'.format(smtplib.quoteaddr(recipient)) for recipient in recipients]
+        if with_data:
+            commands.append('DATA')
+
+        if pipelining:
+            self.server.send(''.join(cmd + '\r\n' for cmd in commands))
+            replies = [self.server.getreply() for _ in commands]
+        else:
+            replies = []
+            for cmd in commands:
+                if cmd == 'DATA' and all(code not in (250, 251) for code, _ in replies[1:]):
+                    break
+                self.server.putcmd(cmd)
+                replies.append(self.server.getreply())
+                if replies[0][0] != 250:
+                    break
+
+        code, message = replies[0]
+        if code != 250:
+            self._abort_transaction(replies, with_data)
+            raise smtplib.SMTPSenderRefused(code, message, self.username)
+
+        refused = {recipient: reply for recipient, reply in zip(recipients, replies[1:])
+                   if reply[0] not in (250, 251)}
+        if len(refused) == len(recipients):
+            self._abort_transaction(replies, with_data)
+            raise smtplib.SMTPRecipientsRefused(refused)
+
+        if with_data and replies[-1][0] != 354:
+            self._abort_transaction(replies, with_data)
+            raise smtplib.SMTPDataError(*replies[-1])
+
+        return refused
+
+    def _abort_transaction(self, replies: List[tuple], with_data: bool):
+        if any(code == 421 for code, _ in replies):
+            self.server.close()
+            return
+        if with_data and len(replies) > 1 and replies[-1][0] == 354:
+            # DATA was accepted although the transaction failed, end it with an empty message.
+            self.server.send(b'.' + CRLF)
+            self.server.getreply()
+        self.server._rset()
+
+    def _send_data(self, chunks: Iterable[bytes]):
+        """Send message after DATA was accepted, dot-stuffing it on the fly."""
+        for data in iter_data(chunks):
+            self.server.send(data)
+        self._check_data_reply(*self.server.getreply())
+
+    def _send_bdat(self, chunks: Iterable[bytes]):
+        """Send message by BDAT in chunks of chunk_size bytes."""
+        buffer = bytearray()
+        for chunk in chunks:
+            buffer += chunk
+            while len(buffer) >= self.chunk_size:
+                self._send_bdat_chunk(buffer[:self.chunk_size], last=False)
+                del buffer[:self.chunk_size]
+        self._send_bdat_chunk(buffer, last=True)
+
+    def _send_bdat_chunk(self, chunk: bytearray, last: bool):
+        # One write per chunk, a separate write of the small command would be delayed by Nagle.
+        command = 'BDAT {}{}\r\n'.format(len(chunk), ' LAST' if last else '').encode('ascii')
+        self.server.send(b''.join((command, chunk)))
+        self._check_data_reply(*self.server.getreply())
+
+    def _check_data_reply(self, code: int, message: bytes):
+        if code != 250:
+            if code == 421:
+                self.server.close()
+            else:
+                self.server._rset()
+            raise smtplib.SMTPDataError(code, message)
 
 
 class POPServer(BaseServer):
-    """Base POPServer, which encapsulates python3 standard library to a POPServer."""
+    """Base POPServer, which encapsulates python3 standard library to a POPServer.
+
+    If the server advertises PIPELINING (RFC 2449), bulk TOP/RETR requests keep up to
+    `pipeline_window` commands in flight instead of waiting a round trip per message.
+    """
+
+    def __init__(self, *args, pipelining: bool = True, pipeline_window: int = DEFAULT_PIPELINE_WINDOW, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.pipelining = pipelining
+        self.pipeline_window = pipeline_window
+        self._capabilities = None  # type:dict or None
 
     def _make_server(self):
         """Init Server."""
@@ -290,9 +844,23 @@ class POPServer(BaseServer):
                 self.server = poplib.POP3_SSL(self.host, self.port, timeout=self.timeout)
             else:
                 self.server = poplib.POP3(self.host, self.port, timeout=self.timeout)
+            self._install_reader()
+
+    def _install_reader(self):
+        """Read multi-line responses in blocks instead of line by line, which poplib does."""
+        self.server.file.close()
+        self.server.file = self.server.sock.makefile('rb', POP_BUFFER_SIZE)
+        self.server._getlongresp = functools.partial(_pop_getlongresp, self.server)
 
     def _remove_server(self):
         self.server = None
+        self._capabilities = None
+
+    def _is_connection_error(self, e: BaseException) -> bool:
+        # poplib raises error_proto('-ERR EOF') when the server has closed the connection.
+        if isinstance(e, poplib.error_proto):
+            return bool(e.args) and e.args[0] in ('-ERR EOF', b'-ERR EOF')
+        return super()._is_connection_error(e)
 
     def login(self):
         """Note: the mailbox on the server is locked until logout() is called."""
@@ -330,6 +898,50 @@ class POPServer(BaseServer):
 
     def stls(self):
         self.server.stls()
+        # poplib makes a new file of the TLS socket.
+        self._install_reader()
+
+    def noop(self):
+        self.server.noop()
+
+    def capabilities(self) -> dict:
+        """Get server capabilities (RFC 2449), an empty dict if CAPA is not supported."""
+        if self._capabilities is None:
+            try:
+                self._capabilities = self.server.capa()
+            except poplib.error_proto:
+                self._capabilities = {}
+        return self._capabilities
+
+    def can_pipeline(self) -> bool:
+        """Whether commands can be pipelined on this connection."""
+        return self.pipelining and 'PIPELINING' in self.capabilities()
+
+    def _iter_pipeline(self, commands: List[str]) -> Iterator[list]:
+        """Send commands ahead in a window and yield their multi-line responses in order."""
+        window = self.pipeline_window
+        total = len(commands)
+        sent = received = 0
+
+        try:
+            while received < total:
+                # Refill the window once half of it has been consumed.
+                if sent < total and sent - received <= window // 2:
+                    batch = commands[sent:received + window]
+                    self.server._putline(poplib.CRLF.join(bytes(cmd, self.server.encoding) for cmd in batch))
+                    sent += len(batch)
+                try:
+                    response = self.server._getlongresp()[1]
+                finally:
+                    received += 1
+                yield response
+        finally:
+            # Read responses still in flight to stay in sync with the server.
+            for _ in range(sent - received):
+                try:
+                    self.server._getlongresp()
+                except poplib.error_proto:
+                    pass
 
     # Methods
 
@@ -337,25 +949,41 @@ class POPServer(BaseServer):
         """Get mailbox status. The result is a tuple of 2 integers: (message count, mailbox size)."""
         return self.server.stat()
 
+    def count(self) -> int:
+        """Get message count."""
+        return self.stat()[0]
+
     def get_header(self, which: int) -> list:
         """Use 'top' to get mail headers."""
         return self.server.top(which, 0)[1]
 
     def get_headers(self, which_list: Optional[list] = None) -> list:
         """Get all mails headers."""
-        num = self.stat()[0]
-        result = []
+        return list(self.iter_headers(which_list))
 
+    def iter_headers(self, which_list: Optional[list] = None) -> Iterator[list]:
+        """Yield mails headers one by one."""
         if which_list is None:
-            _range = range(1, num + 1)
-        else:
-            _range = which_list
+            which_list = range(1, self.stat()[0] + 1)
 
-        for count in _range:
-            header_as_bytes = self.get_header(count)
-            result.append(header_as_bytes)
+        if len(which_list) > 1 and self.can_pipeline():
+            return self._iter_pipeline(['TOP {} 0'.format(which) for which in which_list])
 
-        return result
+        return (self.get_header(which) for which in which_list)
+
+    def get_uids(self) -> dict or None:
+        """Get unique-id of all mails as a dict (id -> uid), None if UIDL is not supported."""
+        try:
+            lines = self.server.uidl()[1]
+        except poplib.error_proto:
+            self.log_debug('{} UIDL is not supported.'.format(self.__repr__()))
+            return None
+
+        uids = {}
+        for line in lines:
+            which, uid = line.split(None, 1)
+            uids[int(which)] = uid.decode('ascii', 'replace')
+        return uids
 
     def get_mail(self, which: int) -> list:
         """Get a mail by its id."""
@@ -363,7 +991,370 @@ class POPServer(BaseServer):
 
     def get_mails(self, which_list: list) -> list:
         """Get a list of mails by its id."""
-        return [self.server.retr(which)[1] for which in which_list]
+        return list(self.iter_mails(which_list))
+
+    def iter_mails(self, which_list: list) -> Iterator[list]:
+        """Yield mails one by one by its id."""
+        if len(which_list) > 1 and self.can_pipeline():
+            return self._iter_pipeline(['RETR {}'.format(which) for which in which_list])
+
+        return (self.get_mail(which) for which in which_list)
 
     def delete(self, which: int):
         self.server.dele(which)
+
+
+class IMAPServer(BaseServer):
+    """Base IMAPServer, which encapsulates python3 standard library to a IMAPServer.
+
+    It works with message sequence numbers of the selected mailbox like POPServer
+    works with message numbers, mails are fetched by BODY.PEEK so they are not marked as seen.
+    Deleted mails are expunged on logout, as POP3 does.
+    """
+
+    def __init__(self, *args, mailbox: str = 'INBOX', fetch_batch: int = DEFAULT_FETCH_BATCH, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.mailbox = mailbox
+        self.fetch_batch = fetch_batch
+        self._exists = None  # type:int or None
+        self._uidvalidity = ''
+
+    def _make_server(self):
+        """Init Server."""
+        if self.server is None:
+            if not PY_39:
+                # imaplib has no timeout argument before Python 3.9, only later reads time out.
+                self.server = (imaplib.IMAP4_SSL if self.ssl else imaplib.IMAP4)(self.host, self.port)
+                self.server.sock.settimeout(self.timeout)
+            elif self.ssl:
+                self.server = imaplib.IMAP4_SSL(self.host, self.port, timeout=self.timeout)
+            else:
+                self.server = imaplib.IMAP4(self.host, self.port, timeout=self.timeout)
+
+    def _remove_server(self):
+        self.server = None
+        self._exists = None
+
+    def login(self):
+        if self._login:
+            self.log_exception('{} duplicate login!'.format(self.__repr__()))
+            return
+
+        if self.debug:
+            self.log_access('login')
+
+        self._make_server()
+
+        if self.tls:
+            self.stls()
+
+        self.server.login(self.username, self.password)
+        self.select()
+
+        self._login = True
+
+    def logout(self):
+        if not self._login:
+            self.log_exception('{} Logout before login!'.format(self.__repr__()))
+            return
+
+        if self.debug:
+            self.log_access('logout')
+
+        try:
+            # CLOSE expunges mails flagged as deleted.
+            self.server.close()
+        finally:
+            self.server.logout()
+
+        self._remove_server()
+
+        self._login = False
+
+    def stls(self):
+        self.server.starttls()
+
+    def noop(self):
+        self._check(self.server.noop())
+
+    def _is_connection_error(self, e: BaseException) -> bool:
+        return isinstance(e, imaplib.IMAP4.abort) or super()._is_connection_error(e)
+
+    def select(self):
+        typ, data = self._check(self.server.select(_quote(self.mailbox)))
+        self._exists = int(data[0])
+        validity = self.server.response('UIDVALIDITY')[1]
+        self._uidvalidity = validity[-1].decode('ascii') if validity and validity[-1] else ''
+
+    def _check(self, response: tuple) -> tuple:
+        typ, data = response
+        if typ != 'OK':
+            raise imaplib.IMAP4.error('{} {}'.format(typ, data))
+        return response
+
+    def _fetch(self, which_list: List[int], item: str) -> Iterator[bytes]:
+        """Fetch an item of mails in batches, yield it in the order of which_list."""
+        for start in range(0, len(which_list), self.fetch_batch):
+            batch = which_list[start:start + self.fetch_batch]
+            _, data = self._check(self.server.fetch(','.join(str(which) for which in batch), '({})'.format(item)))
+            fetched = {}
+            for response in data:
+                if isinstance(response, tuple):
+                    fetched[int(response[0].split(None, 1)[0])] = response[1]
+            for which in batch:
+                if which not in fetched:
+                    raise imaplib.IMAP4.error('Mail {} not found.'.format(which))
+                yield fetched[which]
+
+    # Methods
+
+    def stat(self) -> tuple:
+        """Get mailbox status. The result is a tuple of 2 integers: (message count, mailbox size)."""
+        count = self.count()
+        if not count:
+            return 0, 0
+        _, data = self._check(self.server.fetch('1:*', '(RFC822.SIZE)'))
+        sizes = (RFC822_SIZE.search(line) for line in data if isinstance(line, bytes))
+        return count, sum(int(match.group(1)) for match in sizes if match)
+
+    def count(self) -> int:
+        """Get message count."""
+        self._check(self.server.noop())
+        exists = self.server.response('EXISTS')[1]
+        if exists and exists[-1] is not None:
+            self._exists = int(exists[-1])
+        return self._exists
+
+    def search(self, criteria: List[str], literal: Optional[bytes] = None) -> List[int]:
+        """Search mails by IMAP SEARCH criteria, return a sorted list of their sequence numbers."""
+        if literal is not None:
+            self.server.literal = literal
+            typ, data = self._check(self.server.search('UTF-8', *criteria))
+        else:
+            typ, data = self._check(self.server.search(None, *criteria))
+        return sorted(int(which) for which in b' '.join(data).split())
+
+    def get_header(self, which: int) -> list:
+        return next(self.iter_headers([which]))
+
+    def get_headers(self, which_list: Optional[list] = None) -> list:
+        return list(self.iter_headers(which_list))
+
+    def iter_headers(self, which_list: Optional[list] = None) -> Iterator[list]:
+        """Yield mails headers one by one, fetched in batches."""
+        if which_list is None:
+            which_list = range(1, self.count() + 1)
+        return (_split_lines(header) for header in self._fetch(list(which_list), 'BODY.PEEK[HEADER]'))
+
+    def get_uids(self) -> dict:
+        """Get unique-id of all mails as a dict (id -> 'uidvalidity.uid')."""
+        if not self.count():
+            return {}
+        _, data = self._check(self.server.fetch('1:*', '(UID)'))
+        uids = {}
+        for line in data:
+            match = isinstance(line, bytes) and FETCH_UID.match(line)
+            if match:
+                uids[int(match.group(1))] = '{}.{}'.format(self._uidvalidity, match.group(2).decode('ascii'))
+        return uids
+
+    def get_mail(self, which: int) -> list:
+        return next(self.iter_mails([which]))
+
+    def get_mails(self, which_list: list) -> list:
+        return list(self.iter_mails(which_list))
+
+    def iter_mails(self, which_list: list) -> Iterator[list]:
+        """Yield mails one by one, fetched in batches of fetch_batch."""
+        return (_split_lines(mail) for mail in self._fetch(list(which_list), 'BODY.PEEK[]'))
+
+    def fetch_sections(self, which: int, sections: List[str], uid: bool = False) -> dict:
+        """Fetch BODY[section] of a mail by sequence number or UID, return a dict (section -> bytes)."""
+        items = '({})'.format(' '.join('BODY.PEEK[{}]'.format(section) for section in sections))
+        if uid:
+            _, data = self._check(self.server.uid('FETCH', str(which), items))
+        else:
+            _, data = self._check(self.server.fetch(str(which), items))
+        response = parse_imap_response(data)
+        attrs = response[1] if len(response) > 1 and isinstance(response[1], list) else []
+        result = {}
+        for key, value in zip(attrs[::2], attrs[1::2]):
+            match = BODY_SECTION.match(key)
+            if match:
+                result[match.group(1).decode('ascii')] = value or b''
+        return result
+
+    def get_lazy_mail(self, which: int, debug=False, log=None) -> CaseInsensitiveDict:
+        """Get a parsed mail without downloading its attachments.
+
+        BODYSTRUCTURE is read first, then only MIME headers of parts and the text parts are
+        fetched, in one FETCH. Attachments are LazyAttachment, downloaded by UID on access.
+        """
+        _, data = self._check(self.server.fetch(str(which), '(UID BODYSTRUCTURE BODY.PEEK[HEADER])'))
+        attrs = parse_imap_response(data)[1]
+        attrs = dict(zip((key.upper() for key in attrs[::2]), attrs[1::2]))
+        uid = int(attrs[b'UID'])
+        parts = parse_bodystructure(attrs[b'BODYSTRUCTURE'])
+        header_lines = _split_lines(attrs[b'BODY[HEADER]'])
+
+        text_parts = [p for p in parts
+                      if (p.main_type, p.sub_type) in (TYPE_TEXT_PLAIN, TYPE_TEXT_HTML) and p.disposition != 'attachment']
+        sections = [p.mime_section for p in parts if p.mime_section != 'HEADER'] + [p.section for p in text_parts]
+        fetched = self.fetch_sections(which, sections) if sections else {}
+        fetched['HEADER'] = attrs[b'BODY[HEADER]']
+
+        raw_headers, headers, *_, charsets, _ = parse_headers(header_lines, debug, log)
+        mail = CaseInsensitiveDict()
+        mail['content_text'] = []
+        mail['content_html'] = []
+        mail['attachments'] = []
+        for part in parts:
+            mime_lines = _split_lines(fetched.get(part.mime_section, b''))
+            if mime_lines and mime_lines[-1] != b'':
+                mime_lines.append(b'')
+            if part in text_parts:
+                decoded = parse(mime_lines + _split_lines(fetched.get(part.section, b'')), debug, log)
+                mail['content_text'] += decoded['content_text']
+                mail['content_html'] += decoded['content_html']
+            else:
+                name = parse(mime_lines, debug, log)['attachments'][0][0]
+                loader = functools.partial(self._load_attachment, uid, part.section, mime_lines, debug, log)
+                mail['attachments'].append(LazyAttachment(name, part.size, loader))
+
+        mail['headers'] = headers
+        mail['raw_headers'] = raw_headers
+        mail['charsets'] = charsets
+        mail['subject'] = headers.get('subject')
+        mail['date'] = headers.get('date')
+        mail['from'] = headers.get('from')
+        mail['to'] = headers.get('to')
+        mail['id'] = which
+        mail['uid'] = uid
+        # Not downloaded.
+        mail['raw'] = None
+        return mail
+
+    def _load_attachment(self, uid: int, section: str, mime_lines: List[bytes], debug, log) -> bytes:
+        with self:
+            body = self.fetch_sections(uid, [section], uid=True).get(section, b'')
+        return parse(mime_lines + _split_lines(body), debug, log)['attachments'][0][1]
+
+    def can_idle(self) -> bool:
+        return 'IDLE' in self.server.capabilities
+
+    def idle(self, timeout: float):
+        """Wait in IDLE (RFC 2177) until the server reports a change of mailbox or timeout."""
+        # imaplib does not support IDLE before python 3.14.
+        tag = self.server._new_tag()
+        self.server.send(tag + b' IDLE' + CRLF)
+        line = self.server.readline()
+        if not line.startswith(b'+'):
+            raise imaplib.IMAP4.error('IDLE failed: {}'.format(line.rstrip()))
+
+        if not self._has_response():
+            select.select([self.server.socket()], [], [], timeout)
+
+        self.server.send(b'DONE' + CRLF)
+        self._check(self.server._command_complete('IDLE', tag))
+
+        exists = self.server.response('EXISTS')[1]
+        if exists and exists[-1] is not None:
+            self._exists = int(exists[-1])
+        for name in ('EXPUNGE', 'RECENT', 'FETCH'):
+            self.server.untagged_responses.pop(name, None)
+
+    def _has_response(self) -> bool:
+        """Whether a response can be read without blocking.
+
+        Responses sent with the last line read may be in the buffer of imaplib's file already,
+        where select() does not see them.
+        """
+        sock = self.server.socket()
+        timeout = sock.gettimeout()
+        sock.settimeout(0)
+        try:
+            return bool(self.server.file.peek(1))
+        except (BlockingIOError, ssl.SSLWantReadError):
+            return False
+        finally:
+            sock.settimeout(timeout)
+
+    def last_uid(self) -> int:
+        """UID of the latest mail, 0 if mailbox is empty."""
+        count = self.count()
+        if not count:
+            return 0
+        _, data = self._check(self.server.fetch(str(count), '(UID)'))
+        for line in data:
+            match = isinstance(line, bytes) and FETCH_UID.match(line)
+            if match:
+                return int(match.group(2))
+        return 0
+
+    def search_uids(self, first_uid: int) -> List[int]:
+        """Get a sorted list of UIDs not less than first_uid."""
+        _, data = self._check(self.server.uid('SEARCH', 'UID', '{}:*'.format(first_uid)))
+        # n:* always matches the latest mail, even if its UID is less than n.
+        return sorted(uid for uid in (int(uid) for uid in b' '.join(data).split()) if uid >= first_uid)
+
+    def iter_mails_by_uid(self, uid_list: List[int]) -> Iterator[Tuple[int, list]]:
+        """Yield (id, mail) of mails by their UIDs, fetched in batches of fetch_batch."""
+        for start in range(0, len(uid_list), self.fetch_batch):
+            batch = uid_list[start:start + self.fetch_batch]
+            _, data = self._check(self.server.uid('FETCH', ','.join(str(uid) for uid in batch), '(BODY.PEEK[])'))
+            for response in data:
+                if isinstance(response, tuple):
+                    yield int(response[0].split(None, 1)[0]), _split_lines(response[1])
+
+    def delete(self, which: int):
+        self._check(self.server.store(str(which), '+FLAGS', '(\\Deleted)'))
+
+
+def read_multiline(file) -> bytes:
+    """Read the body of a POP3 multi-line response from a buffered file.
+
+    The buffer is scanned for the terminating CRLF.CRLF block by block, only bytes up to it
+    are consumed so pipelined responses are kept. Lines are dot-unstuffed and keep their CRLF.
+    """
+    # Start with CRLF so the terminator and stuffed dots of the first line are found too.
+    data = bytearray(CRLF)
+    start = 0
+    while True:
+        block = file.peek(POP_BUFFER_SIZE)
+        if not block:
+            raise poplib.error_proto('-ERR EOF')
+        data += block
+        end = data.find(b'\r\n.\r\n', start)
+        if end >= 0:
+            file.read(len(block) - (len(data) - end - 5))
+            del data[end + 2:]
+            break
+        file.read(len(block))
+        start = max(0, len(data) - 4)
+
+    data = data.replace(b'\r\n..', b'\r\n.')
+    del data[:2]
+    return bytes(data)
+
+
+def _pop_getlongresp(server: poplib.POP3) -> tuple:
+    """Replacement of poplib.POP3._getlongresp using read_multiline."""
+    resp = server._getresp()
+    data = read_multiline(server.file)
+    return resp, _split_lines(data), len(data)
+
+
+def _remaining(deadline: Optional[float]) -> Optional[float]:
+    return None if deadline is None else deadline - time.monotonic()
+
+
+def _split_lines(data: bytes) -> List[bytes]:
+    """Split data to lines like poplib does."""
+    lines = data.split(CRLF)
+    if lines[-1] == b'':
+        lines.pop()
+    return lines
+
+
+def _quote(s: str) -> str:
+    return '"{}"'.format(s.replace('\\', '\\\\').replace('"', '\\"'))
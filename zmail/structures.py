@@ -3,6 +3,8 @@ zmail.structures
 ~~~~~~~~~~~~~~~~
 Data structures that power zmail.
 """
+from collections import namedtuple
+
 from .compat import Mapping, MutableMapping, OrderedDict
 
 
@@ -56,3 +58,61 @@ class CaseInsensitiveDict(MutableMapping):
 
     def __repr__(self):
         return str(dict(self.items()))
+
+
+# Result of sending one mail in a batch.
+# refused: recipients refused by server as a dict (address -> (code, message)).
+# error: exception raised while sending, None on success.
+SendResult = namedtuple('SendResult', ('recipients', 'success', 'refused', 'error'))
+
+# Result of a MailServerGroup call on one server.
+# result: return value of the call, or one mail of iter_mails, None on failure.
+# error: exception raised by the call, None on success.
+GroupResult = namedtuple('GroupResult', ('server', 'result', 'error'))
+
+# Result of reading one file by read_many.
+# mail: parsed mail, or only the selected fields of it, None on failure.
+# error: exception raised while reading, None on success.
+ReadResult = namedtuple('ReadResult', ('path', 'mail', 'error'))
+
+
+class LazyAttachment:
+    """An attachment which is downloaded when its content is accessed.
+
+    It behaves like the (name, content) tuple of parsed mails: it can be unpacked,
+    indexed and compared with tuples, but only `name` is known without downloading.
+    """
+
+    def __init__(self, name: str, size: int, loader):
+        self.name = name
+        # Size of the encoded content on the server.
+        self.size = size
+        self._loader = loader
+        self._content = None  # type:bytes or None
+
+    @property
+    def content(self) -> bytes:
+        if self._content is None:
+            self._content = self._loader()
+        return self._content
+
+    def is_loaded(self) -> bool:
+        return self._content is not None
+
+    def __iter__(self):
+        yield self.name
+        yield self.content
+
+    def __getitem__(self, idx):
+        return tuple(self)[idx] if not isinstance(idx, int) or idx not in (0, -2) else self.name
+
+    def __len__(self):
+        return 2
+
+    def __eq__(self, other):
+        if isinstance(other, (tuple, LazyAttachment)):
+            return tuple(self) == tuple(other)
+        return NotImplemented
+
+    def __repr__(self):
+        return '<LazyAttachment {} {} bytes{}>'.format(self.name, self.size, '' if self.is_loaded() else ' not loaded')
@@ -0,0 +1,165 @@
+"""
+zmail.template
+~~~~~~~~~~~~
+This module provides a MailTemplate to render one mail for many recipients.
+"""
+import logging
+import uuid
+from collections import namedtuple
+from email.generator import Generator
+from string import Template
+from typing import Iterator, List, Optional
+
+from .exceptions import InvalidArguments
+from .helpers import make_list
+from .mime import CRLF, SMTP_POLICY, AttachmentPart, Mail, TextPart, iter_part_bytes
+from .structures import CaseInsensitiveDict
+
+# Subtypes of text parts, in the order Mail attaches them.
+_TEXT_FIELDS = (('content_html', 'html'), ('content_text', 'plain'))
+
+# A static text part encoded for servers without and with 8BITMIME.
+EncodedText = namedtuple('EncodedText', ('default', 'eight_bit'))
+
+
+class MailTemplate:
+    """A mail made and encoded once, then rendered for every recipient.
+
+    Subject, From, extra header values, content_text and content_html may contain
+    string.Template placeholders like $name or ${name} ($$ for a literal $ in a value
+    with placeholders). Only values with placeholders are rendered by render(),
+    the MIME structure, other headers, other parts and attachments are generated and
+    encoded when the template is made.
+
+    Usage:
+        template = MailTemplate({'subject': 'Hi $name', 'content_text': 'Dear $name', 'attachments': 'a.pdf'})
+        server.send_mails((address, template.render(name=name)) for address, name in rows)
+    """
+
+    def __init__(self, mail: dict or CaseInsensitiveDict, boundary: Optional[str] = None,
+                 debug: bool = False, log: logging.Logger = None):
+        self.mail = CaseInsensitiveDict(mail)
+        self.debug = debug
+        self.log = log
+        self.fields = set()
+
+        # Make a skeleton mail whose templated values are unique markers, then cut it at them.
+        prefix = 'zmail-template-{}-'.format(uuid.uuid4().hex)
+        templates = {}
+
+        def mark(value):
+            if isinstance(value, str):
+                names = get_identifiers(value)
+                if names:
+                    self.fields.update(names)
+                    marker = prefix + str(len(templates))
+                    templates[marker] = Template(value)
+                    return marker
+            return value
+
+        skeleton = CaseInsensitiveDict(self.mail)
+        for k in ('subject', 'from'):
+            if k in skeleton:
+                skeleton[k] = mark(skeleton[k])
+        if isinstance(skeleton.get('headers'), dict):
+            skeleton['headers'] = {k: mark(v) for k, v in skeleton['headers'].items()}
+        for k, _ in _TEXT_FIELDS:
+            if skeleton.get(k) is not None:
+                skeleton[k] = [mark('{}'.format(v)) for v in make_list(skeleton[k])]
+
+        mime = Mail(skeleton, boundary, debug=debug, log=log).get_mime_raw()
+        subparts = mime.get_payload()
+
+        # Encode static parts now, attachments which are not cached are streamed on every render.
+        static_parts = {}
+        for idx, part in enumerate(subparts):
+            if isinstance(part, TextPart):
+                if part.text not in templates:
+                    static_parts[idx] = EncodedText(part.as_bytes(policy=SMTP_POLICY),
+                                                    part.as_8bit_bytes(SMTP_POLICY))
+            elif not isinstance(part, AttachmentPart) or part.cache_key() is not None:
+                static_parts[idx] = b''.join(iter_part_bytes(part))
+
+        if not mime.get_boundary():
+            mime.set_boundary(Generator._make_boundary(CRLF.join(
+                b'\n'.join(p) if isinstance(p, EncodedText) else p for p in static_parts.values()
+            ).decode('ascii', 'surrogateescape')))
+        delimiter = b'--' + mime.get_boundary().encode('ascii')
+
+        self._headers = [(k, templates[v]) if v in templates else SMTP_POLICY.fold_binary(k, v)
+                         for k, v in mime.raw_items()]  # type:List[bytes or tuple]
+
+        self._body = [CRLF + delimiter + CRLF]  # type:List[bytes or EncodedText or tuple or AttachmentPart]
+        for idx, part in enumerate(subparts):
+            if idx:
+                self._body.append(CRLF + delimiter + CRLF)
+            if idx in static_parts:
+                self._body.append(static_parts[idx])
+            elif isinstance(part, AttachmentPart):
+                self._body.append(part)
+            else:
+                self._body.append((part.get_content_subtype(), templates[part.text]))
+        self._body.append(CRLF + delimiter + b'--' + CRLF)
+        self._body = _merge_bytes(self._body)
+
+    def render(self, fields: Optional[dict] = None, **kwargs) -> 'RenderedMail':
+        """Substitute fields, return a mail which can be sent by MailServer.send_mail and send_mails."""
+        fields = dict(fields or {}, **kwargs)
+        missing = self.fields.difference(fields)
+        if missing:
+            raise InvalidArguments('Template fields {} are missing.'.format(sorted(missing)))
+
+        headers = [SMTP_POLICY.fold_binary(h[0], h[1].safe_substitute(fields)) if isinstance(h, tuple) else h
+                   for h in self._headers]
+        body = [TextPart(s[1].safe_substitute(fields), s[0])
+                if isinstance(s, tuple) and not isinstance(s, EncodedText) else s
+                for s in self._body]
+        return RenderedMail(self.mail, headers, body)
+
+    def __repr__(self):
+        return '<MailTemplate {}>'.format(self.mail.get('subject'))
+
+
+class RenderedMail:
+    """A mail rendered from a MailTemplate, kept as encoded segments.
+
+    It is sent the same way as a Mail, through iter_mime_bytes.
+    """
+
+    def __init__(self, mail: CaseInsensitiveDict, headers: List[bytes], body: list):
+        self.mail = mail
+        self.headers = headers
+        self.body = body
+
+    def set_mime_header(self, k, v) -> None:
+        self.headers.append(SMTP_POLICY.fold_binary(k, v))
+
+    def iter_mime_bytes(self, eight_bit: bool = False) -> Iterator[bytes]:
+        yield b''.join(self.headers)
+        for segment in self.body:
+            if isinstance(segment, EncodedText):
+                yield segment.eight_bit if eight_bit else segment.default
+            elif isinstance(segment, (AttachmentPart, TextPart)):
+                yield from iter_part_bytes(segment, eight_bit=eight_bit)
+            else:
+                yield segment
+
+    def get_mime_as_bytes(self) -> bytes:
+        return b''.join(self.iter_mime_bytes())
+
+
+def get_identifiers(value: str) -> set:
+    """Names of placeholders in a string.Template."""
+    return {m.group('named') or m.group('braced') for m in Template.pattern.finditer(value)
+            if m.group('named') or m.group('braced')}
+
+
+def _merge_bytes(segments: list) -> list:
+    """Join adjacent bytes segments."""
+    merged = []
+    for segment in segments:
+        if isinstance(segment, bytes) and merged and isinstance(merged[-1], bytes):
+            merged[-1] += segment
+        else:
+            merged.append(segment)
+    return merged
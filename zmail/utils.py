@@ -4,12 +4,25 @@ zmail.utils
 This module contains some useful function power zmail.
 """
 
+import itertools
+import mmap
 import os
-from typing import Optional
+import re
+from concurrent.futures import FIRST_COMPLETED, Executor, ProcessPoolExecutor, wait
+from contextlib import contextmanager
+from typing import Iterable, Iterator, List, Optional
 
+from .exceptions import InvalidArguments
 from .helpers import get_abs_path, make_list
+from .mime import Mail
 from .parser import parse_mail
-from .structures import CaseInsensitiveDict
+from .structures import CaseInsensitiveDict, LazyAttachment, ReadResult
+
+# Number of files read by one task of read_many.
+DEFAULT_CHUNKSIZE = 64
+
+# Body lines escaped by mboxrd writers.
+MBOX_ESCAPED_FROM = re.compile(rb'^>(>*From )', re.MULTILINE)
 
 
 def save_attachment(mail: CaseInsensitiveDict, target_path: Optional[str] = None, overwrite=False):
@@ -39,7 +52,9 @@ def show(mails: list or CaseInsensitiveDict) -> None:
             else:
                 _ = ''
                 for idx, v in enumerate(mail['attachments']):
-                    _ += str(idx + 1) + '.' + 'Name:' + v[0] + ' ' + 'Size:' + str(len(v[1])) + ' '
+                    # Do not download an attachment to show its size.
+                    size = v.size if isinstance(v, LazyAttachment) and not v.is_loaded() else len(v[1])
+                    _ += str(idx + 1) + '.' + 'Name:' + v[0] + ' ' + 'Size:' + str(size) + ' '
 
                 print(k.capitalize() + ' ', _)
 
@@ -54,20 +69,147 @@ def read_html(html_path: str):
     return content
 
 
-def read(file_path: str, SEP=b'\r\n') -> CaseInsensitiveDict:
-    """Read a mail."""
+def read(file_path: str, SEP=b'\r\n', lazy=False) -> CaseInsensitiveDict:
+    """Read a mail, if lazy, its parts are decoded on first access."""
     abs_path = get_abs_path(file_path)
 
     with open(abs_path, 'rb') as f:
         raw_lines = f.read().split(SEP)
 
-    return parse_mail(raw_lines, 0)
+    return parse_mail(raw_lines, 0, lazy=lazy)
+
+
+def read_many(paths: Iterable[str], workers: Optional[int or Executor] = None, fields: Optional[Iterable[str]] = None,
+              chunksize: int = DEFAULT_CHUNKSIZE) -> Iterator[ReadResult]:
+    """Read mails in a process pool, yield a ReadResult for every file in completion order.
+
+    workers is the size of the pool, the number of CPUs by default, or an Executor.
+    Files are sent to workers chunksize at a time. If fields is given, e.g. ('subject', 'from'),
+    only these fields are decoded and sent back, other parts and raw are never pickled.
+    """
+    if workers is not None and not isinstance(workers, Executor) and (not isinstance(workers, int) or workers < 1):
+        raise InvalidArguments('workers excepted positive int or Executor got {}'.format(workers))
+    if not isinstance(chunksize, int) or chunksize < 1:
+        raise InvalidArguments('chunksize excepted positive int got {}'.format(chunksize))
+    fields = tuple(fields) if fields is not None else None
+    return _read_in_pool(paths, workers, fields, chunksize)
+
+
+def _read_in_pool(paths: Iterable[str], workers: Optional[int or Executor], fields: Optional[tuple],
+                  chunksize: int) -> Iterator[ReadResult]:
+    pool = workers if isinstance(workers, Executor) else ProcessPoolExecutor(workers)
+    # Keep every worker busy without submitting all paths at once.
+    max_pending = (workers if isinstance(workers, int) else os.cpu_count() or 1) * 2
+    paths = iter(paths)
+    pending = set()
+    try:
+        while True:
+            while len(pending) < max_pending:
+                chunk = list(itertools.islice(paths, chunksize))
+                if not chunk:
+                    break
+                pending.add(pool.submit(_read_chunk, chunk, fields))
+            if not pending:
+                return
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield from future.result()
+    finally:
+        for future in pending:
+            future.cancel()
+        if pool is not workers:
+            pool.shutdown()
+
+
+def _read_chunk(paths: List[str], fields: Optional[tuple]) -> List[ReadResult]:
+    results = []
+    for path in paths:
+        try:
+            mail = read(path, lazy=fields is not None)
+            if fields is not None:
+                mail = CaseInsensitiveDict((k, mail[k]) for k in fields if k in mail)
+        except Exception as e:
+            results.append(ReadResult(path, None, e))
+        else:
+            results.append(ReadResult(path, mail, None))
+    return results
+
+
+def index_mbox(file_path: str) -> List[int]:
+    """Get byte offsets of the mails of an mbox archive, read_mbox seeks to a mail by them."""
+    with _map_file(get_abs_path(file_path)) as m:
+        return list(_iter_mbox_offsets(m))
+
+
+def read_mbox(file_path: str, start_index: Optional[int] = None, end_index: Optional[int] = None,
+              index: Optional[List[int]] = None, lazy=False) -> Iterator[CaseInsensitiveDict]:
+    """Yield mails of an mbox archive one by one, mail['id'] is its position in the archive from 1.
+
+    The archive is memory-mapped and scanned for 'From ' separator lines, only the mail being
+    parsed is copied into memory. With an index of index_mbox, mails before start_index are
+    not scanned.
+    """
+    which = start_index or 1
+    with _map_file(get_abs_path(file_path)) as m:
+        if index is not None:
+            offsets = iter(index[which - 1:])
+        else:
+            offsets = itertools.islice(_iter_mbox_offsets(m), which - 1, None)
+
+        begin = next(offsets, None)
+        while begin is not None and (end_index is None or which <= end_index):
+            end = next(offsets, None)
+            yield parse_mail(_get_mbox_message(m, begin, len(m) if end is None else end), which, lazy=lazy)
+            which += 1
+            begin = end
+
+
+@contextmanager
+def _map_file(abs_path: str):
+    with open(abs_path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            # Empty files can not be mapped.
+            yield b''
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            yield m
+
+
+def _iter_mbox_offsets(m: mmap.mmap or bytes) -> Iterator[int]:
+    """Offsets of 'From ' lines, found by mmap.find, which unlike re does not hold the buffer."""
+    if m[:5] == b'From ':
+        yield 0
+    pos = m.find(b'\nFrom ')
+    while pos >= 0:
+        yield pos + 1
+        pos = m.find(b'\nFrom ', pos + 1)
+
+
+def _get_mbox_message(m: mmap.mmap or bytes, begin: int, end: int) -> bytes:
+    """Copy a mail between separators, without its 'From ' line and the line break before the next one."""
+    begin = m.find(b'\n', begin, end) + 1 or end
+    if end > begin and m[end - 1] == ord('\n'):
+        end -= 1
+        if end > begin and m[end - 1] == ord('\r'):
+            end -= 1
+
+    data = m[begin:end]
+    if MBOX_ESCAPED_FROM.search(data):
+        data = MBOX_ESCAPED_FROM.sub(rb'\1', data)
+    return data
 
 
 def save(mail, name=None, target_path=None, overwrite=False) -> bool:
-    """Save a mail."""
+    """Save a mail, either a parsed mail or a Mail to be sent.
+
+    A Mail is generated piece by piece, so attachments are never held in memory as a whole.
+    """
+    if not isinstance(mail, Mail) and mail.get('raw') is None:
+        raise InvalidArguments('mail was fetched lazily without its raw bytes, get it with lazy=False to save it.')
+
     if name is None:
-        name = str(mail['subject'] + '.eml') if mail.get('subject') else 'Untitled'
+        subject = mail.mail.get('subject') if isinstance(mail, Mail) else mail.get('subject')
+        name = str(subject + '.eml') if subject else 'Untitled'
 
     if target_path is None:
         target_path = os.getcwd()
@@ -78,6 +220,11 @@ def save(mail, name=None, target_path=None, overwrite=False) -> bool:
         raise FileExistsError("{} already exists, set overwrite to True to avoid this error.")
 
     with open(file_path, 'wb') as f:
-        f.write(b'\r\n'.join(mail['raw']))
+        if isinstance(mail, Mail):
+            for chunk in mail.iter_mime_bytes():
+                f.write(chunk)
+        else:
+            raw = mail['raw']
+            f.write(b'\r\n'.join(raw) if isinstance(raw, list) else raw)
 
     return True